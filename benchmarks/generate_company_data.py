@@ -0,0 +1,348 @@
+"""
+Generator of synthetic company datasets, used by the pipeline benchmark.
+
+It writes three csv files, as if they were given by three providers, and a training file for Dedupe:
+- 'provider_a.csv' and 'provider_b.csv' have companies from several jurisdictions; a part of the
+  companies (the overlap) is in both files, the other ones are only in one of them
+- 'provider_c.csv' has companies from the first jurisdiction only, partly the same as the ones of the
+  other two files, so it can be matched against the companies of that jurisdiction from the database
+- 'training_file.json' has pairs of records labeled as match or distinct, in the format Dedupe reads
+
+Every company is generated from its index and the seed, so the same company looks alike in every file,
+and every row is a noisy variant of its company: the legal form is written in different ways (e.g. 'AS',
+'A/S'), the street types are abbreviated, the casing changes, there are typos, dropped words and missing
+postcodes. A few companies have more than one row in the same file. The column 'company_number' is the
+same for all the rows of a company, so it can be used as the ground truth (the label column) of the evaluation.
+
+The files are the same for the same arguments, e.g.:
+python generate_company_data.py --rows 100000 --output-dir data_100k --seed 1
+"""
+import os
+import csv
+import json
+import random
+import argparse
+
+from collections import OrderedDict
+
+COLUMN_NAMES = ['company_number', 'legal_name', 'thoroughfare', 'locality', 'postcode', 'jurisdiction']
+
+# the jurisdictions and how often they appear in the datasets; the first one is the jurisdiction of 'provider_c.csv'
+JURISDICTION_WEIGHTS = OrderedDict([('no', 0.4), ('gb', 0.25), ('se', 0.15), ('dk', 0.1), ('fi', 0.1)])
+
+NAME_WORDS = ['Nordic', 'Atlantic', 'Fjord', 'Polar', 'Granite', 'Harbour', 'Summit', 'Crown', 'Silver', 'Oak',
+              'Maple', 'Viking', 'Coastal', 'Northern', 'United', 'Global', 'Green', 'Blue', 'Royal', 'Pioneer',
+              'Alpha', 'Delta', 'Vector', 'Fusion', 'Bright', 'Solid', 'Prime', 'Metro', 'Urban', 'Rapid',
+              'Aurora', 'Boreal', 'Cedar', 'Harald', 'Olsen', 'Hansen', 'Berg', 'Lund', 'Smith', 'Taylor']
+
+ACTIVITY_WORDS = ['Consulting', 'Shipping', 'Seafood', 'Logistics', 'Construction', 'Software', 'Holding',
+                  'Invest', 'Energy', 'Trading', 'Property', 'Engineering', 'Media', 'Transport', 'Electro',
+                  'Marine', 'Design', 'Capital', 'Solutions', 'Systems', 'Bakery', 'Dental', 'Robotics']
+
+# the legal forms of every jurisdiction, each one with the other ways it is written
+LEGAL_FORMS = {
+    'no': [('AS', ['A/S', 'A.S.', 'Aksjeselskap']), ('ASA', ['A.S.A.'])],
+    'gb': [('Limited', ['Ltd', 'Ltd.', 'LTD']), ('PLC', ['Plc', 'P.L.C.'])],
+    'se': [('AB', ['Aktiebolag', 'A.B.'])],
+    'dk': [('ApS', ['Aps', 'A.p.S.']), ('A/S', ['AS'])],
+    'fi': [('Oy', ['OY', 'Osakeyhtio']), ('Oyj', ['OYJ'])],
+}
+
+STREET_NAMES = {
+    'no': ['Kirke', 'Stor', 'Strand', 'Park', 'Industri', 'Skole', 'Sjo', 'Fjell', 'Brygge', 'Torg'],
+    'gb': ['High', 'Station', 'Church', 'Mill', 'Victoria', 'Queen', 'King', 'Park', 'Bridge', 'London'],
+    'se': ['Kyrko', 'Stor', 'Strand', 'Skol', 'Drottning', 'Kungs', 'Hamn', 'Torg', 'Sjo', 'Berg'],
+    'dk': ['Kirke', 'Strand', 'Skole', 'Havne', 'Torve', 'Molle', 'Bygade', 'Park', 'Norre', 'Vester'],
+    'fi': ['Kirkko', 'Koulu', 'Ranta', 'Satama', 'Tori', 'Puisto', 'Mannerheimin', 'Aleksanterin', 'Mylly', 'Asema'],
+}
+
+# the street types of every jurisdiction, each one with its abbreviation, and whether they are
+# written together with the name of the street (e.g. 'Kirkegata') or as a separate word ('High Street')
+STREET_TYPES = {
+    'no': ([('gata', 'gt.'), ('veien', 'vn.'), ('vegen', 'vg.')], True),
+    'gb': ([('Street', 'St'), ('Road', 'Rd'), ('Avenue', 'Ave'), ('Lane', 'Ln')], False),
+    'se': ([('gatan', 'g.'), ('vagen', 'v.')], True),
+    'dk': ([('gade', 'g.'), ('vej', 'v.'), ('alle', 'al.')], True),
+    'fi': ([('katu', 'k.'), ('tie', 't.')], True),
+}
+
+CITIES = {
+    'no': [('Oslo', '0{:03d}'), ('Bergen', '5{:03d}'), ('Trondheim', '7{:03d}'), ('Stavanger', '4{:03d}'),
+           ('Tromso', '9{:03d}')],
+    'gb': [('London', 'EC{} 1AA'), ('Manchester', 'M{} 2BB'), ('Leeds', 'LS{} 3CC'), ('Bristol', 'BS{} 4DD')],
+    'se': [('Stockholm', '11{:03d}'), ('Goteborg', '41{:03d}'), ('Malmo', '21{:03d}'), ('Uppsala', '75{:03d}')],
+    'dk': [('Kobenhavn', '1{:03d}'), ('Aarhus', '8{:03d}'), ('Odense', '5{:03d}')],
+    'fi': [('Helsinki', '00{:03d}'), ('Espoo', '02{:03d}'), ('Tampere', '33{:03d}'), ('Turku', '20{:03d}')],
+}
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def generate_company(seed, company_idx):
+    """
+    This function returns the company having the given index, as a dictionary; the same seed and index
+    always give the same company
+
+    Input: 'seed' - int data type, the seed of the datasets
+           'company_idx' - int data type, the index of the company
+    """
+    rng = random.Random((seed << 32) + company_idx)
+
+    jurisdiction = rng.choices(list(JURISDICTION_WEIGHTS), weights=list(JURISDICTION_WEIGHTS.values()))[0]
+    city, postcode_format = rng.choice(CITIES[jurisdiction])
+    street_types, is_street_type_joined = STREET_TYPES[jurisdiction]
+
+    name_words = rng.sample(NAME_WORDS, rng.choice([1, 1, 2])) + [rng.choice(ACTIVITY_WORDS)]
+
+    return {'company_number': str(900000000 + company_idx),
+            'name_words': name_words,
+            'legal_form': rng.choice(LEGAL_FORMS[jurisdiction]),
+            'street_name': rng.choice(STREET_NAMES[jurisdiction]),
+            'street_type': rng.choice(street_types),
+            'is_street_type_joined': is_street_type_joined,
+            'street_number': rng.randint(1, 250),
+            'locality': city,
+            'postcode': postcode_format.format(rng.randint(1, 99 if '{}' in postcode_format else 999)),
+            'jurisdiction': jurisdiction}
+
+
+def add_typo(value, rng):
+    """
+    This function returns the given value with one character deleted, inserted, replaced or swapped with the next one
+    """
+    if len(value) < 4:
+        return value
+
+    idx = rng.randrange(1, len(value) - 1)
+    typo = rng.choice(['delete', 'insert', 'replace', 'swap'])
+
+    if typo == 'delete':
+        return value[:idx] + value[idx + 1:]
+    if typo == 'insert':
+        return value[:idx] + rng.choice(LETTERS) + value[idx:]
+    if typo == 'replace':
+        return value[:idx] + rng.choice(LETTERS) + value[idx + 1:]
+
+    return value[:idx - 1] + value[idx] + value[idx - 1] + value[idx + 1:]
+
+
+def change_case(value, rng):
+    casing = rng.random()
+    if casing < 0.1:
+        return value.upper()
+    if casing < 0.2:
+        return value.lower()
+
+    return value
+
+
+def generate_row(company, rng, noise):
+    """
+    This function returns a row (a list having the values of COLUMN_NAMES) that is a noisy variant of the given company
+
+    Input: 'company' - dictionary returned by 'generate_company'
+           'rng' - the random number generator of the dataset
+           'noise' - float between 0 and 1, the probability of every kind of noise
+    """
+    name_words = list(company['name_words'])
+    if len(name_words) > 2 and rng.random() < noise / 2:
+        del name_words[rng.randrange(len(name_words) - 1)]
+
+    legal_form, other_legal_forms = company['legal_form']
+    if rng.random() < noise * 2:
+        legal_form = rng.choice(other_legal_forms)
+
+    legal_name = ' '.join(name_words + [legal_form])
+    if rng.random() < noise:
+        legal_name = add_typo(legal_name, rng)
+
+    street_type, street_type_abbreviation = company['street_type']
+    if rng.random() < noise * 2:
+        street_type = street_type_abbreviation
+
+    if company['is_street_type_joined']:
+        street = company['street_name'] + street_type
+    else:
+        street = company['street_name'] + ' ' + street_type
+
+    thoroughfare = '{} {}'.format(street, company['street_number'])
+    if rng.random() < noise:
+        thoroughfare = add_typo(thoroughfare, rng)
+
+    locality = company['locality']
+    if rng.random() < noise / 2:
+        locality = add_typo(locality, rng)
+
+    postcode = '' if rng.random() < noise / 2 else company['postcode']
+
+    return [company['company_number'], change_case(legal_name, rng), change_case(thoroughfare, rng),
+            change_case(locality, rng), postcode, company['jurisdiction']]
+
+
+def preprocess(value):
+    """
+    This function cleans a value like the notebook of the algorithm does before giving it to Dedupe
+    """
+    value = ' '.join(value.split()).strip('"').strip("'").lower().strip()
+
+    return value if value else None
+
+
+def write_dataset(file_name, company_indexes, seed, rng, noise, duplicate_ratio):
+    """
+    This function writes a csv file having one row for every given company (in a random order) and,
+    for some of them, a second row. It returns the number of rows written.
+
+    Input: 'file_name' - string object containing the name of the csv file
+           'company_indexes' - list of int data types, the indexes of the companies of the dataset
+           'seed' - int data type, the seed of the datasets
+           'rng' - the random number generator of the dataset
+           'noise' - float between 0 and 1, the probability of every kind of noise
+           'duplicate_ratio' - float between 0 and 1, the part of the companies that have a second row
+    """
+    rng.shuffle(company_indexes)
+
+    nr_of_rows = 0
+    with open(file_name, 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(COLUMN_NAMES)
+
+        for company_idx in company_indexes:
+            company = generate_company(seed, company_idx)
+
+            writer.writerow(generate_row(company, rng, noise))
+            nr_of_rows += 1
+
+            if rng.random() < duplicate_ratio:
+                writer.writerow(generate_row(company, rng, noise))
+                nr_of_rows += 1
+
+    return nr_of_rows
+
+
+def get_company_indexes_of_jurisdiction(seed, company_indexes, jurisdiction, nr_of_companies):
+    """
+    This function returns the first 'nr_of_companies' indexes, from the given ones, of the companies of the given jurisdiction
+    """
+    result = []
+    for company_idx in company_indexes:
+        if len(result) == nr_of_companies:
+            break
+
+        if generate_company(seed, company_idx)['jurisdiction'] == jurisdiction:
+            result.append(company_idx)
+
+    return result
+
+
+def write_training_file(file_name, nr_of_companies, seed, rng, noise, nr_of_pairs):
+    """
+    This function writes a training file for Dedupe, having 'nr_of_pairs' pairs labeled as match (two
+    variants of the same company) and as many pairs labeled as distinct (two companies of the same jurisdiction)
+
+    Input: 'file_name' - string object containing the name of the training file
+           'nr_of_companies' - int data type, the pairs are made of the companies having the indexes lower than it
+           'seed' - int data type, the seed of the datasets
+           'rng' - the random number generator of the training file
+           'noise' - float between 0 and 1, the probability of every kind of noise
+           'nr_of_pairs' - int data type, the number of pairs of every label
+    """
+    def get_record(company):
+        return dict((column_name, preprocess(value))
+                    for column_name, value in zip(COLUMN_NAMES, generate_row(company, rng, noise)))
+
+    def get_pair(company_1, company_2):
+        return {'__class__': 'tuple', '__value__': [get_record(company_1), get_record(company_2)]}
+
+    training_data = {'distinct': [], 'match': []}
+
+    while len(training_data['match']) < nr_of_pairs or len(training_data['distinct']) < nr_of_pairs:
+        company_1 = generate_company(seed, rng.randrange(nr_of_companies))
+        company_2 = generate_company(seed, rng.randrange(nr_of_companies))
+
+        if len(training_data['match']) < nr_of_pairs:
+            training_data['match'].append(get_pair(company_1, company_1))
+
+        if len(training_data['distinct']) < nr_of_pairs and company_1['company_number'] != company_2['company_number'] \
+                and company_1['jurisdiction'] == company_2['jurisdiction']:
+            training_data['distinct'].append(get_pair(company_1, company_2))
+
+    with open(file_name, 'w') as training_file:
+        json.dump(training_data, training_file)
+
+
+def generate_datasets(output_dir, nr_of_rows, seed=0, overlap=0.5, noise=0.1, duplicate_ratio=0.02,
+                      nr_of_training_pairs=200):
+    """
+    This function writes the datasets of the three providers and the training file into the given directory,
+    together with a 'manifest.json' file having the arguments and the numbers of rows, which it also returns
+
+    Input: 'output_dir' - string object containing the name of the directory; it is created if it does not exist
+           'nr_of_rows' - int data type, the number of companies of 'provider_a.csv' and 'provider_b.csv'
+           'seed' - int data type, the seed of the random number generators
+           'overlap' - float between 0 and 1, the part of the companies that are in both 'provider_a.csv' and
+                       'provider_b.csv' (and, if they are from the first jurisdiction, in 'provider_c.csv')
+           'noise' - float between 0 and 1, the probability of every kind of noise
+           'duplicate_ratio' - float between 0 and 1, the part of the companies that have a second row in a dataset
+           'nr_of_training_pairs' - int data type, the number of pairs of every label of the training file
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    nr_of_shared_companies = int(nr_of_rows * overlap)
+    nr_of_own_companies = nr_of_rows - nr_of_shared_companies
+    shared_company_indexes = range(nr_of_shared_companies)
+
+    # every provider has its own range of indexes, after the ones of the shared companies
+    def get_own_company_indexes(provider_idx):
+        first_company_idx = nr_of_shared_companies + provider_idx * nr_of_own_companies
+        return range(first_company_idx, first_company_idx + nr_of_own_companies)
+
+    first_jurisdiction = next(iter(JURISDICTION_WEIGHTS))
+    company_indexes_of_providers = OrderedDict([
+        ('provider_a.csv', list(shared_company_indexes) + list(get_own_company_indexes(0))),
+        ('provider_b.csv', list(shared_company_indexes) + list(get_own_company_indexes(1))),
+        ('provider_c.csv',
+         get_company_indexes_of_jurisdiction(seed, shared_company_indexes, first_jurisdiction, nr_of_rows) +
+         get_company_indexes_of_jurisdiction(seed, get_own_company_indexes(2), first_jurisdiction, nr_of_rows))])
+
+    manifest = OrderedDict([('nr_of_rows', nr_of_rows),
+                            ('seed', seed),
+                            ('overlap', overlap),
+                            ('noise', noise),
+                            ('duplicate_ratio', duplicate_ratio),
+                            ('nr_of_training_pairs', nr_of_training_pairs),
+                            ('jurisdictions', list(JURISDICTION_WEIGHTS)),
+                            ('files', OrderedDict())])
+
+    for file_name, company_indexes in company_indexes_of_providers.items():
+        rng = random.Random('{}:{}'.format(seed, file_name))
+        manifest['files'][file_name] = write_dataset(os.path.join(output_dir, file_name), company_indexes,
+                                                     seed, rng, noise, duplicate_ratio)
+
+    write_training_file(os.path.join(output_dir, 'training_file.json'), max(nr_of_shared_companies, 1), seed,
+                        random.Random('{}:training_file.json'.format(seed)), noise, nr_of_training_pairs)
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic company datasets for the pipeline benchmark')
+    parser.add_argument('--rows', type=int, required=True,
+                        help="number of companies of 'provider_a.csv' and 'provider_b.csv'")
+    parser.add_argument('--output-dir', required=True, help='directory where the files are written')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--overlap', type=float, default=0.5,
+                        help='part of the companies that are in more than one dataset')
+    parser.add_argument('--noise', type=float, default=0.1, help='probability of every kind of noise')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.02,
+                        help='part of the companies that have a second row in a dataset')
+    parser.add_argument('--training-pairs', type=int, default=200,
+                        help='number of pairs of every label in the training file')
+    args = parser.parse_args()
+
+    print(json.dumps(generate_datasets(args.output_dir, args.rows, args.seed, args.overlap, args.noise,
+                                       args.duplicate_ratio, args.training_pairs), indent=2))
@@ -0,0 +1,383 @@
+"""
+Benchmark of the pipeline (the '/run_algorithm' job) on synthetic company datasets.
+
+For every size, the datasets are generated (read more about them in 'generate_company_data') and the
+algorithm is run, through the Flask test client, in two scenarios, against a local Postgres database
+that is used only for the benchmark (it is emptied before every size):
+- 'initial_load': 'provider_a.csv' is matched with 'provider_b.csv' and both are loaded into the database
+- 'match_against_database': 'provider_c.csv' is matched with the companies of its jurisdiction that
+  are in the database, so the companies are extracted from the database and the cluster_ids are remapped
+
+The time and the peak memory of every stage of the runs (preprocessing, training, threshold, match,
+output, cluster remap, backbone_index insert, COPY load, search index, ...) are taken from the job
+reports and written as JSON. If a baseline (the JSON of an earlier benchmark) is given, every stage is
+compared with it and the stages that got slower, or used more memory, than the tolerance allows are
+reported as regressions.
+
+Every size runs in its own process, so the peak memory of a size doesn't depend on the sizes run before it, e.g.:
+python run_pipeline_benchmark.py --sizes 10000 100000 --database-name backbone_benchmark --reset-database
+    --output results.json --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+
+from collections import OrderedDict
+
+from generate_company_data import JURISDICTION_WEIGHTS, generate_datasets
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_APP_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'server_app')
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+# a stage is a regression if it got slower (or used more memory) than the baseline by more than
+# the tolerance (e.g. 0.2 for 20%) and by more than the given minimum, so the noise of the short
+# stages is not reported
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_MIN_SECONDS = 0.5
+DEFAULT_MIN_MEMORY_MB = 20
+
+# the part of the configuration file of the benchmark runs that is the same for every scenario
+BASE_CONFIGURATION = OrderedDict([
+    ('training', OrderedDict([
+        ('nr_of_examples_for_training', 500),
+        ('field_definitions', [{'field': 'legal_name', 'type': 'String'},
+                               {'field': 'thoroughfare', 'type': 'String'},
+                               {'field': 'locality', 'type': 'ShortString'}]),
+        ('create_training_file_by_client', False),
+        ('training_file', 'training_file.json'),
+        ('settings_file', None),
+        ('budget', OrderedDict([('max_seconds', None),
+                                ('max_memory_mb', None),
+                                ('max_records_for_sampling', 20000),
+                                ('stratify_by', 'jurisdiction')]))])),
+    ('threshold', None),
+    ('compute_threshold', OrderedDict([('recall_weight', 1),
+                                       ('nr_of_sample_data_for_threshold', 1000),
+                                       ('recompute', 'recompute'),
+                                       ('seed', 0)])),
+    ('blocking', OrderedDict([('max_block_pairs', None), ('oversized_blocks', 'split')])),
+    ('memory_budget', OrderedDict([('max_memory_mb', None), ('spill_ratio', 0.8), ('chunk_size', 50000),
+                                   ('nr_of_top_allocations', 0)])),
+    ('evaluation', OrderedDict([('label_column_name', 'company_number')])),
+])
+
+# the scenarios run for every size: name -> (1st input file, 2nd input file, jurisdiction)
+SCENARIOS = OrderedDict([
+    ('initial_load', ('provider_a.csv', 'provider_b.csv', None)),
+    ('match_against_database', ('provider_c.csv', None, next(iter(JURISDICTION_WEIGHTS)))),
+])
+
+
+def reset_database(database_config):
+    """
+    This function drops the provider tables and the search index from the benchmark database and
+    (re)creates an empty 'backbone_index' table
+    """
+    import utilities
+
+    db_connection = utilities.create_database_connection(database_config)
+    db_cursor = db_connection.cursor()
+
+    for table_name in utilities.get_all_table_names_from_schema(database_config, 'public'):
+        db_cursor.execute("DROP TABLE " + table_name.split()[0])
+
+    db_cursor.execute("DROP TABLE IF EXISTS search_index")
+    db_cursor.execute("DROP TABLE IF EXISTS backbone_index")
+    db_cursor.execute("CREATE TABLE backbone_index (idx INTEGER PRIMARY KEY)")
+
+    db_cursor.close()
+    db_connection.close()
+
+
+def get_data_dir(work_dir, size, seed):
+    return os.path.join(work_dir, 'data_{}_seed_{}'.format(size, seed))
+
+
+def prepare_datasets(data_dir, size, seed):
+    """
+    This function generates the datasets of the given size into the given directory, unless they were
+    generated before with the same arguments, and returns the manifest of the datasets and the number
+    of seconds it took to generate them (0 if they were generated before)
+    """
+    manifest_file_name = os.path.join(data_dir, 'manifest.json')
+    if os.path.isfile(manifest_file_name):
+        with open(manifest_file_name) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if manifest['nr_of_rows'] == size and manifest['seed'] == seed:
+            return manifest, 0.0
+
+    start_time = time.perf_counter()
+    manifest = generate_datasets(data_dir, size, seed)
+
+    return manifest, round(time.perf_counter() - start_time, 3)
+
+
+def run_scenario(app, data_dir, run_dir, database_config, scenario_name):
+    """
+    This function copies the files of the given scenario into the run directory (the working directory
+    of the server), writes the configuration file, runs the algorithm and returns its job report
+    """
+    input_file_1, input_file_2, jurisdiction = SCENARIOS[scenario_name]
+
+    for file_name in [input_file_1, input_file_2, 'training_file.json']:
+        if file_name:
+            shutil.copyfile(os.path.join(data_dir, file_name), os.path.join(run_dir, file_name))
+
+    configuration = OrderedDict([
+        ('input_file_1', input_file_1),
+        ('provider_1_name', 'benchmark_' + os.path.splitext(input_file_1)[0]),
+        ('input_file_2', input_file_2),
+        ('provider_2_name', 'benchmark_' + os.path.splitext(input_file_2)[0] if input_file_2 else None),
+        ('jurisdiction', jurisdiction)])
+    configuration.update(BASE_CONFIGURATION)
+    configuration['database_config'] = database_config
+
+    with open(os.path.join(run_dir, 'configuration_file_bs.json'), 'w') as configuration_file:
+        json.dump(configuration, configuration_file, indent=4)
+
+    response = app.test_client().post('/run_algorithm')
+    if response.status_code != 200:
+        raise RuntimeError('{} failed: {}'.format(scenario_name, response.get_data(as_text=True)))
+
+    return json.loads(response.get_data(as_text=True))['report']
+
+
+def summarize_job_report(job_report):
+    """
+    This function returns the part of the job report that is kept in the results: the times and the
+    peak memory of the job and of its stages, and the times of the database calls
+    """
+    stages = OrderedDict()
+    for stage_name, stage_report in job_report['stages'].items():
+        stages[stage_name] = OrderedDict([('seconds', stage_report['seconds']),
+                                          ('peak_memory_mb', stage_report.get('peak_memory_mb'))])
+
+    return OrderedDict([('seconds', job_report['seconds']),
+                        ('peak_memory_mb', max([stage['peak_memory_mb'] or 0 for stage in stages.values()] or [0])),
+                        ('stages', stages),
+                        ('db_calls', job_report['db_calls']),
+                        ('memory_budget', job_report.get('memory_budget'))])
+
+
+def run_size(size, seed, work_dir, database_config):
+    """
+    This function runs all the scenarios on the datasets of the given size and returns their results.
+    It changes the working directory and imports the server, so it is run in its own process.
+    """
+    data_dir = get_data_dir(work_dir, size, seed)
+    manifest, generation_seconds = prepare_datasets(data_dir, size, seed)
+
+    run_dir = os.path.join(work_dir, 'run_{}'.format(size))
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+
+    # the server reads the notebook and writes its files in its working directory
+    shutil.copyfile(os.path.join(SERVER_APP_DIR, 'dedupe_interlinking_data.ipynb'),
+                    os.path.join(run_dir, 'dedupe_interlinking_data.ipynb'))
+    os.chdir(run_dir)
+    sys.path.insert(0, SERVER_APP_DIR)
+
+    import api
+
+    # the errors of the runs are raised, instead of being turned into responses
+    api.app.testing = True
+
+    reset_database(database_config)
+
+    results = OrderedDict([('rows', manifest['files']),
+                           ('generation_seconds', generation_seconds),
+                           ('scenarios', OrderedDict())])
+
+    for scenario_name in SCENARIOS:
+        logging.info('size {}: running {}'.format(size, scenario_name))
+        results['scenarios'][scenario_name] = summarize_job_report(
+            run_scenario(api.app, data_dir, run_dir, database_config, scenario_name))
+
+    return results
+
+
+def run_size_in_subprocess(size, args, database_config_file_name):
+    """
+    This function runs the given size in a new process of this script and returns its results
+    """
+    results_file_name = os.path.join(args.work_dir, 'results_{}.json'.format(size))
+
+    subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                           '--run-size', str(size),
+                           '--seed', str(args.seed),
+                           '--work-dir', args.work_dir,
+                           '--database-config', database_config_file_name,
+                           '--output', results_file_name])
+
+    with open(results_file_name) as results_file:
+        return json.load(results_file, object_pairs_hook=OrderedDict)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE, min_seconds=DEFAULT_MIN_SECONDS,
+                          min_memory_mb=DEFAULT_MIN_MEMORY_MB):
+    """
+    This function compares the times and the peak memory of the jobs and of their stages with the ones
+    of the baseline, for the sizes and the scenarios that are in both, and returns a list of dictionaries,
+    one per compared value, having the keys: 'size', 'scenario', 'stage' (None for the whole job),
+    'metric', 'baseline', 'current', 'ratio' and 'regression'
+
+    Input: 'results' - dictionary having the results of the benchmark, as returned by 'run_benchmark'
+           'baseline' - dictionary having the results of an earlier benchmark
+           'tolerance' - float data type, how much slower (or bigger) than the baseline a value can get
+           'min_seconds' - the minimum number of seconds a stage has to get slower to be a regression
+           'min_memory_mb' - the minimum memory (in MB) a stage has to grow to be a regression
+    """
+    comparison = []
+
+    def compare(size, scenario_name, stage_name, current, previous):
+        for metric, min_difference in [('seconds', min_seconds), ('peak_memory_mb', min_memory_mb)]:
+            if current.get(metric) is None or previous.get(metric) is None:
+                continue
+
+            difference = current[metric] - previous[metric]
+            comparison.append(OrderedDict([
+                ('size', size),
+                ('scenario', scenario_name),
+                ('stage', stage_name),
+                ('metric', metric),
+                ('baseline', previous[metric]),
+                ('current', current[metric]),
+                ('ratio', round(current[metric] / previous[metric], 3) if previous[metric] else None),
+                ('regression', difference > min_difference and difference > tolerance * previous[metric])]))
+
+    for size, size_results in results['sizes'].items():
+        baseline_size_results = baseline.get('sizes', {}).get(size)
+        if not baseline_size_results:
+            continue
+
+        for scenario_name, scenario_results in size_results['scenarios'].items():
+            baseline_scenario_results = baseline_size_results['scenarios'].get(scenario_name)
+            if not baseline_scenario_results:
+                continue
+
+            compare(size, scenario_name, None, scenario_results, baseline_scenario_results)
+
+            for stage_name, stage_results in scenario_results['stages'].items():
+                if stage_name in baseline_scenario_results['stages']:
+                    compare(size, scenario_name, stage_name, stage_results,
+                            baseline_scenario_results['stages'][stage_name])
+
+    return comparison
+
+
+def run_benchmark(args):
+    """
+    This function runs every size in its own process and returns the results of the benchmark
+    """
+    database_config = OrderedDict([('database_name', args.database_name),
+                                   ('username', args.username),
+                                   ('password', args.password),
+                                   ('host', args.host),
+                                   ('port', args.port)])
+
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    database_config_file_name = os.path.join(args.work_dir, 'database_config.json')
+    with open(database_config_file_name, 'w') as database_config_file:
+        json.dump(database_config, database_config_file)
+
+    results = OrderedDict([('created_at', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+                           ('git_commit', get_git_commit()),
+                           ('environment', OrderedDict([('python', platform.python_version()),
+                                                        ('platform', platform.platform()),
+                                                        ('cpu_count', os.cpu_count())])),
+                           ('seed', args.seed),
+                           ('sizes', OrderedDict())])
+
+    for size in args.sizes:
+        results['sizes'][str(size)] = run_size_in_subprocess(size, args, database_config_file_name)
+
+    return results
+
+
+def print_comparison(comparison):
+    for entry in comparison:
+        print('{:>8} {:<24} {:<22} {:<15} {:>10} -> {:>10} {}'.format(
+            entry['size'], entry['scenario'], entry['stage'] or '(job)', entry['metric'], entry['baseline'],
+            entry['current'], 'REGRESSION' if entry['regression'] else ''))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline on synthetic company datasets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of companies of the datasets (default: 10000 100000 1000000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=os.path.abspath('benchmark_work'),
+                        help='directory of the generated datasets and of the runs')
+    parser.add_argument('--database-name', default='backbone_benchmark')
+    parser.add_argument('--username', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--reset-database', action='store_true',
+                        help='confirms that the database is used only for the benchmark, since it is emptied')
+    parser.add_argument('--output', default='benchmark_results.json', help='file where the results are written')
+    parser.add_argument('--baseline', help='results of an earlier benchmark, which the results are compared with')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--min-seconds', type=float, default=DEFAULT_MIN_SECONDS)
+    parser.add_argument('--min-memory-mb', type=float, default=DEFAULT_MIN_MEMORY_MB)
+    # used when a size runs in its own process
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--database-config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.work_dir = os.path.abspath(args.work_dir)
+    args.output = os.path.abspath(args.output)
+
+    if args.run_size:
+        with open(args.database_config) as database_config_file:
+            size_results = run_size(args.run_size, args.seed, args.work_dir,
+                                    json.load(database_config_file, object_pairs_hook=OrderedDict))
+
+        with open(args.output, 'w') as output_file:
+            json.dump(size_results, output_file, indent=2)
+        sys.exit(0)
+
+    if not args.reset_database:
+        parser.error('the database is emptied before every size; give --reset-database to confirm '
+                     'that it is used only for the benchmark')
+
+    benchmark_results = run_benchmark(args)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            benchmark_results['comparison'] = compare_with_baseline(
+                benchmark_results, json.load(baseline_file), args.tolerance, args.min_seconds, args.min_memory_mb)
+
+        print_comparison(benchmark_results['comparison'])
+
+        if any(entry['regression'] for entry in benchmark_results['comparison']):
+            exit_code = 1
+
+    with open(args.output, 'w') as output_file:
+        json.dump(benchmark_results, output_file, indent=2)
+
+    print('results written to {}'.format(args.output))
+    sys.exit(exit_code)
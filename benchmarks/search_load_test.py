@@ -0,0 +1,388 @@
+"""
+Load test of the search API ('/search/company/legal_name/<legal_name>' and '/search/company/thoroughfare/<thoroughfare>').
+
+The benchmark database (a local Postgres database used only for the load test, since it is emptied) is
+seeded with the given number of provider tables and companies: every company gets a cluster_id and is
+in one of the tables and, with the given probability (the overlap), in every other table, as a noisy
+variant (read more about the variants in 'generate_company_data'). Then the server is started in its
+own process (unless the url of a running server is given) and a mix of queries is sent to it by the
+given number of concurrent clients, each one sending its next query as soon as it got the answer to
+the previous one. The kinds of queries are:
+- 'hot': a word that many company names (or street names) have, so the answer has many companies
+- 'rare': the whole name (or address) of a company, so the answer has a few companies
+- 'short': a substring of 2 or 3 characters of a name (or address), which no index helps with
+
+The report has the 50th, 95th and 99th percentiles of the latency, the throughput and, from the
+difference of the '/metrics' of the server before and after the queries, the number of statements
+sent to the database and of connections opened per request. With more than one worker process, every
+'/metrics' request is answered by one of the workers, so the database numbers are only reported for
+one worker. E.g.:
+python search_load_test.py --tables 5 --companies 100000 --requests 2000 --concurrency 8 --reset-database
+"""
+import os
+import sys
+import csv
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import argparse
+import itertools
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from generate_company_data import (COLUMN_NAMES, NAME_WORDS, ACTIVITY_WORDS, STREET_NAMES, generate_company,
+                                   generate_row)
+from run_pipeline_benchmark import SERVER_APP_DIR, BASE_CONFIGURATION, reset_database
+
+QUERY_KINDS = ('hot', 'rare', 'short')
+DEFAULT_QUERY_MIX = 'hot=0.4,rare=0.5,short=0.1'
+
+SEARCH_FIELDS = ('legal_name', 'thoroughfare')
+
+# the cluster_id of a company is found from its number, which is made from its index
+FIRST_COMPANY_NUMBER = 900000000
+
+SERVER_START_TIMEOUT_SECONDS = 120
+
+
+def seed_database(database_config, work_dir, nr_of_tables, nr_of_companies, overlap, seed, noise=0.1):
+    """
+    This function empties the database and fills it with the given number of provider tables and companies,
+    and builds the search index
+
+    Input: 'database_config' - dictionary containing the database parameters, like in the configuration file
+           'work_dir' - string object containing the name of the directory where the datasets are written
+           'nr_of_tables' - int data type, the number of provider tables
+           'nr_of_companies' - int data type, the number of companies (clusters)
+           'overlap' - float between 0 and 1, the probability of a company to be in every other table
+           'seed' - int data type, the seed of the random number generators
+           'noise' - float between 0 and 1, the probability of every kind of noise of the rows
+    """
+    import utilities
+
+    reset_database(database_config)
+    utilities.insert_cluster_id_range_into_backbone_index_table(database_config, 1, nr_of_companies)
+
+    rng = random.Random('{}:seed_database'.format(seed))
+    provider_names = ['load_test_provider_{}'.format(table_idx) for table_idx in range(nr_of_tables)]
+    file_names = [os.path.join(work_dir, provider_name + '.csv') for provider_name in provider_names]
+
+    output_files = [open(file_name, 'w', newline='') for file_name in file_names]
+    try:
+        writers = [csv.writer(output_file) for output_file in output_files]
+        for writer in writers:
+            writer.writerow(COLUMN_NAMES)
+
+        for company_idx in range(nr_of_companies):
+            company = generate_company(seed, company_idx)
+
+            for table_idx, writer in enumerate(writers):
+                if company_idx % nr_of_tables == table_idx or rng.random() < overlap:
+                    writer.writerow(generate_row(company, rng, noise))
+    finally:
+        for output_file in output_files:
+            output_file.close()
+
+    def generate_rows_with_cluster_ids(file_name):
+        with open(file_name) as input_file:
+            reader = csv.reader(input_file)
+            yield next(reader) + ['cluster_id', 'link_score']
+
+            for row in reader:
+                yield row + [int(row[0]) - FIRST_COMPANY_NUMBER + 1, 1.0]
+
+    for provider_name, file_name in zip(provider_names, file_names):
+        utilities.create_table_and_insert_rows_resulted_from_dedupe(database_config, provider_name, file_name,
+                                                                     generate_rows_with_cluster_ids(file_name))
+        utilities.index_provider_table_for_search(database_config, provider_name)
+
+
+def parse_query_mix(query_mix):
+    """
+    This function returns a dictionary having as keys the kinds of queries and as values their shares
+    of the queries, from a string like 'hot=0.4,rare=0.5,short=0.1'
+    """
+    shares = OrderedDict()
+    for part in query_mix.split(','):
+        kind, share = part.split('=')
+        if kind.strip() not in QUERY_KINDS:
+            raise ValueError("The kind of a query must be one of: " + ', '.join(QUERY_KINDS))
+        shares[kind.strip()] = float(share)
+
+    return shares
+
+
+def generate_queries(nr_of_queries, query_mix, fields, nr_of_companies, seed):
+    """
+    This function returns a list of tuples (kind, field, value), the queries sent by the load test
+
+    Input: 'nr_of_queries' - int data type, the number of queries
+           'query_mix' - dictionary returned by 'parse_query_mix'
+           'fields' - list of string objects containing the searched fields
+           'nr_of_companies' - int data type, the number of companies in the database
+           'seed' - int data type, the seed of the random number generators
+    """
+    rng = random.Random('{}:queries'.format(seed))
+    street_names = sorted(set(itertools.chain.from_iterable(STREET_NAMES.values())))
+
+    queries = []
+    for kind in rng.choices(list(query_mix), weights=list(query_mix.values()), k=nr_of_queries):
+        field = rng.choice(fields)
+
+        if kind == 'hot':
+            value = rng.choice(NAME_WORDS + ACTIVITY_WORDS if field == 'legal_name' else street_names)
+        else:
+            company = generate_company(seed, rng.randrange(nr_of_companies))
+
+            # a '/' (e.g. in 'A/S') can't be given in the path of the url
+            value = generate_row(company, rng, 0)[COLUMN_NAMES.index(field)].replace('/', ' ')
+
+            if kind == 'short':
+                length = rng.choice([2, 3])
+                start = rng.randrange(max(len(value) - length, 0) + 1)
+                value = value[start:start + length].strip() or value
+
+        queries.append((kind, field, value.strip()))
+
+    return queries
+
+
+def send_query(base_url, query, timeout):
+    """
+    This function sends the given query to the server and returns a tuple (kind, seconds, is_successful)
+    """
+    kind, field, value = query
+    url = '{}/search/company/{}/{}'.format(base_url, field, urllib.parse.quote(value, safe=''))
+
+    start_time = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            is_successful = response.status == 200
+    except (urllib.error.URLError, OSError) as e:
+        logging.debug('query {} failed: {}'.format(url, e))
+        is_successful = False
+
+    return kind, time.perf_counter() - start_time, is_successful
+
+
+def send_queries(base_url, queries, concurrency, timeout):
+    """
+    This function sends the queries with the given number of concurrent clients (closed loop: every
+    client sends its next query when it got the answer to the previous one) and returns a list of the
+    tuples returned by 'send_query' and the number of seconds it took
+    """
+    next_query_idx = itertools.count()
+    lock = threading.Lock()
+
+    def client():
+        results = []
+        while True:
+            with lock:
+                query_idx = next(next_query_idx)
+            if query_idx >= len(queries):
+                return results
+
+            results.append(send_query(base_url, queries[query_idx], timeout))
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(client) for idx in range(concurrency)]
+        results = list(itertools.chain.from_iterable(future.result() for future in futures))
+
+    return results, time.perf_counter() - start_time
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    This function returns the given percentile (e.g. 95) of the sorted values (nearest rank), or None
+    """
+    if not sorted_values:
+        return None
+
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize_latencies(results):
+    latencies = sorted(seconds for kind, seconds, is_successful in results if is_successful)
+
+    return OrderedDict([('requests', len(results)),
+                        ('errors', sum(1 for kind, seconds, is_successful in results if not is_successful))] +
+                       [('p{}_ms'.format(percentile), round(get_percentile(latencies, percentile) * 1000, 1)
+                         if latencies else None) for percentile in (50, 95, 99)])
+
+
+def read_server_metrics(base_url):
+    """
+    This function returns a dictionary having as keys the names of the metrics of the server (with
+    their labels) and as values their values, read from '/metrics'
+    """
+    with urllib.request.urlopen(base_url + '/metrics', timeout=30) as response:
+        text = response.read().decode()
+
+    server_metrics = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            server_metrics[name] = float(value)
+
+    return server_metrics
+
+
+def start_server(run_dir, database_config, nr_of_workers):
+    """
+    This function starts the server in a new process, in the given directory, and returns the process
+    """
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+
+    # every search request reads the database configuration (and the notebook) from the working directory
+    configuration = OrderedDict([('input_file_1', 'load_test.csv'),
+                                 ('provider_1_name', 'load_test'),
+                                 ('input_file_2', None),
+                                 ('provider_2_name', None),
+                                 ('jurisdiction', None)])
+    configuration.update(BASE_CONFIGURATION)
+    configuration['database_config'] = database_config
+
+    with open(os.path.join(run_dir, 'configuration_file_bs.json'), 'w') as configuration_file:
+        json.dump(configuration, configuration_file, indent=4)
+
+    shutil.copyfile(os.path.join(SERVER_APP_DIR, 'dedupe_interlinking_data.ipynb'),
+                    os.path.join(run_dir, 'dedupe_interlinking_data.ipynb'))
+
+    environment = dict(os.environ, BACKBONE_WORKERS=str(nr_of_workers))
+
+    return subprocess.Popen([sys.executable, os.path.join(SERVER_APP_DIR, 'api.py')], cwd=run_dir, env=environment)
+
+
+def wait_for_server(base_url, server_process):
+    deadline = time.time() + SERVER_START_TIMEOUT_SECONDS
+
+    while time.time() < deadline:
+        if server_process is not None and server_process.poll() is not None:
+            raise RuntimeError('the server stopped with the exit code {}'.format(server_process.returncode))
+
+        try:
+            with urllib.request.urlopen(base_url + '/status/startup', timeout=5):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+
+    raise RuntimeError('the server did not start in {} s'.format(SERVER_START_TIMEOUT_SECONDS))
+
+
+def run_load_test(args, base_url):
+    """
+    This function sends the warm up queries and the measured queries to the server and returns the report
+    """
+    query_mix = parse_query_mix(args.query_mix)
+    queries = generate_queries(args.warmup_requests + args.requests, query_mix, args.fields, args.companies,
+                               args.seed)
+
+    send_queries(base_url, queries[:args.warmup_requests], args.concurrency, args.timeout)
+
+    metrics_before = read_server_metrics(base_url)
+    results, seconds = send_queries(base_url, queries[args.warmup_requests:], args.concurrency, args.timeout)
+    metrics_after = read_server_metrics(base_url)
+
+    def get_per_request(metric_name):
+        if args.workers > 1 or not results:
+            return None
+
+        difference = metrics_after.get(metric_name, 0) - metrics_before.get(metric_name, 0)
+
+        return round(difference / len(results), 2)
+
+    report = OrderedDict([('tables', args.tables),
+                          ('companies', args.companies),
+                          ('concurrency', args.concurrency),
+                          ('workers', args.workers),
+                          ('query_mix', query_mix),
+                          ('seconds', round(seconds, 3)),
+                          ('throughput_per_second', round(sum(1 for result in results if result[2]) / seconds, 1)
+                           if seconds else None)])
+    report.update(summarize_latencies(results))
+    report['db_statements_per_request'] = get_per_request('backbone_db_statements_total')
+    report['db_connections_per_request'] = get_per_request('backbone_db_connections_total')
+    report['kinds'] = OrderedDict((kind, summarize_latencies([result for result in results if result[0] == kind]))
+                                  for kind in query_mix)
+
+    return report
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Load test of the search API')
+    parser.add_argument('--tables', type=int, default=5, help='number of provider tables')
+    parser.add_argument('--companies', type=int, default=100000, help='number of companies (clusters)')
+    parser.add_argument('--overlap', type=float, default=0.3,
+                        help='probability of a company to be in every other table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--query-mix', default=DEFAULT_QUERY_MIX, help='shares of the kinds of queries')
+    parser.add_argument('--fields', nargs='+', choices=SEARCH_FIELDS, default=list(SEARCH_FIELDS))
+    parser.add_argument('--requests', type=int, default=1000, help='number of measured requests')
+    parser.add_argument('--warmup-requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--timeout', type=float, default=60, help='timeout of a request, in seconds')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes of the server')
+    parser.add_argument('--url', help='url of a running server; if it is not given, the server is started')
+    parser.add_argument('--skip-seeding', action='store_true', help='uses the companies seeded by an earlier run')
+    parser.add_argument('--work-dir', default=os.path.abspath('load_test_work'))
+    parser.add_argument('--database-name', default='backbone_benchmark')
+    parser.add_argument('--username', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--reset-database', action='store_true',
+                        help='confirms that the database is used only for the load test, since it is emptied')
+    parser.add_argument('--output', default='load_test_results.json', help='file where the report is written')
+    args = parser.parse_args()
+
+    if not args.skip_seeding and not args.reset_database:
+        parser.error('the database is emptied before it is seeded; give --reset-database to confirm '
+                     'that it is used only for the load test (or --skip-seeding)')
+
+    database_config = OrderedDict([('database_name', args.database_name),
+                                   ('username', args.username),
+                                   ('password', args.password),
+                                   ('host', args.host),
+                                   ('port', args.port)])
+
+    args.work_dir = os.path.abspath(args.work_dir)
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    if not args.skip_seeding:
+        sys.path.insert(0, SERVER_APP_DIR)
+        logging.info('seeding {} companies into {} tables'.format(args.companies, args.tables))
+        seed_database(database_config, args.work_dir, args.tables, args.companies, args.overlap, args.seed)
+
+    server_process = None if args.url else start_server(os.path.join(args.work_dir, 'server'), database_config,
+                                                        args.workers)
+    base_url = (args.url or 'http://localhost:5000').rstrip('/')
+
+    try:
+        wait_for_server(base_url, server_process)
+        load_test_report = run_load_test(args, base_url)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    with open(args.output, 'w') as output_file:
+        json.dump(load_test_report, output_file, indent=2)
+
+    print(json.dumps(load_test_report, indent=2))
@@ -0,0 +1,201 @@
+import os
+import time
+import hashlib
+import threading
+
+import requests
+
+# how many bytes are read from the file at once when its checksum is computed
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class ChunkedUploader:
+    """
+    Uploads a file to the server in chunks, in a background thread, using the resumable uploads of
+    the server ('/upload/sessions'). Before uploading, the uploader sends the checksum of the file to
+    the server, and if the server already has a file with the same content (in its upload store), the
+    file is not uploaded again ('is_taken_from_store' is then True). Every chunk is sent with its
+    offset and its SHA-256 checksum; if a chunk fails (e.g. the connection dropped), the uploader asks
+    the server from which offset it has to continue and sends the file from there, so the upload never
+    restarts from zero. The progress can be read, from any thread, with 'get_progress'.
+    """
+
+    def __init__(self, root_url, file_path, max_nr_of_retries=10, retry_delay_seconds=2, timeout_seconds=60):
+        """
+        Constructor
+
+        :param root_url: string object containing the url of the server
+        :param file_path: string object containing the path of the file to be uploaded
+        :param max_nr_of_retries: int data type, how many times in a row a failed request is sent again
+        :param retry_delay_seconds: how many seconds the uploader waits before the first retry; the delay
+                                    is doubled after every failed retry
+        :param timeout_seconds: how many seconds the uploader waits for the response to a request
+        """
+        self.sessions_url = root_url + '/upload/sessions'
+        self.store_url = root_url + '/upload/store'
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        self.size = os.path.getsize(file_path)
+        self.max_nr_of_retries = max_nr_of_retries
+        self.retry_delay_seconds = retry_delay_seconds
+        self.timeout_seconds = timeout_seconds
+
+        self.status = 'waiting'
+        self.offset = 0
+        self.error = None
+        self.is_taken_from_store = False
+
+        self.__is_cancelled = False
+        self.__thread = None
+
+    def start(self):
+        """
+        Starts the upload in a background thread
+        """
+        self.__thread = threading.Thread(target=self.__upload, name='upload of ' + self.file_name, daemon=True)
+        self.__thread.start()
+
+    def cancel(self):
+        """
+        Stops the upload after the chunk that is being sent; the server keeps what it received, so
+        the upload can be resumed later by a new uploader of the same file
+        """
+        self.__is_cancelled = True
+
+    def is_finished(self):
+        return self.status in ('completed', 'failed', 'cancelled')
+
+    def get_progress(self):
+        """
+        Returns the status of the upload ('waiting', 'checksum', 'uploading', 'completed', 'failed' or
+        'cancelled'), the number of bytes the server received and the size of the file
+        """
+        return self.status, self.offset, self.size
+
+    def __upload(self):
+        try:
+            self.status = 'checksum'
+            checksum = self.__get_file_checksum()
+
+            if self.__take_file_from_store(checksum):
+                self.offset = self.size
+                self.is_taken_from_store = True
+                self.status = 'completed'
+                return
+
+            self.status = 'uploading'
+            session = self.__send(lambda: requests.post(
+                self.sessions_url, json={'file_name': self.file_name, 'size': self.size, 'checksum': checksum},
+                timeout=self.timeout_seconds))
+
+            upload_url = self.sessions_url + '/' + session['upload_id']
+            self.offset = session['offset']
+
+            # the chunks sent again without the server getting further in the file (e.g. their checksums are
+            # always wrong); the upload fails if there are too many of them
+            nr_of_chunks_without_progress = 0
+
+            with open(self.file_path, 'rb') as file:
+                while not session['completed']:
+                    if self.__is_cancelled:
+                        self.status = 'cancelled'
+                        return
+                    if nr_of_chunks_without_progress > self.max_nr_of_retries:
+                        raise RuntimeError('The server did not accept the chunk at offset {}'.format(self.offset))
+
+                    session = self.__send_chunk(file, upload_url, session['offset'], session['chunk_size'])
+
+                    nr_of_chunks_without_progress = 0 if session['offset'] > self.offset else \
+                        nr_of_chunks_without_progress + 1
+                    self.offset = session['offset']
+
+            self.status = 'completed'
+        except Exception as e:
+            self.error = str(e)
+            self.status = 'failed'
+
+    def __get_file_checksum(self):
+        file_hash = hashlib.sha256()
+
+        with open(self.file_path, 'rb') as file:
+            for block in iter(lambda: file.read(READ_BLOCK_SIZE), b''):
+                file_hash.update(block)
+
+        return file_hash.hexdigest()
+
+    def __take_file_from_store(self, checksum):
+        """
+        Asks the server to take the file with the given checksum from its upload store; returns True if the
+        server had it (and placed it under the name of the file), or False if the file has to be uploaded
+        """
+        try:
+            response = requests.post(self.store_url, json={'file_name': self.file_name, 'checksum': checksum},
+                                     timeout=self.timeout_seconds)
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+
+        return response.status_code == 200
+
+    def __send_chunk(self, file, upload_url, offset, chunk_size):
+        """
+        Sends the chunk of the file that starts at the given offset and returns the session as the server
+        returned it. If the server rejected the chunk because it expected another offset (e.g. the response
+        to a chunk it received was lost), the session with that offset is returned, so the next chunk is
+        sent from there.
+        """
+        file.seek(offset)
+        chunk = file.read(chunk_size)
+
+        def send_request():
+            return requests.put(upload_url, data=chunk, timeout=self.timeout_seconds, headers={
+                'Upload-Offset': str(offset),
+                'Chunk-Checksum': hashlib.sha256(chunk).hexdigest(),
+                'Content-Type': 'application/octet-stream'})
+
+        def get_session():
+            return requests.get(upload_url, timeout=self.timeout_seconds)
+
+        # the server ends the session when it received the last chunk, so if the response to the last chunk
+        # was lost, the session is not found anymore
+        if offset + len(chunk) == self.size:
+            completed_session = {'offset': self.size, 'chunk_size': chunk_size, 'completed': True}
+        else:
+            completed_session = None
+
+        return self.__send(send_request, get_session, completed_session)
+
+    def __send(self, send_request, get_session=None, completed_session=None):
+        """
+        Sends a request and returns its JSON response. A request that failed (the connection dropped or the
+        server returned an error) is sent again, after a delay, at most 'max_nr_of_retries' times. If the
+        failure was a chunk, the session is asked for again instead, so the upload continues from the
+        offset the server has; if the session is not found anymore, 'completed_session' is returned (if given).
+        A chunk rejected with '400 Bad Request' (e.g. it was corrupted on the way) is sent again, but any
+        other request rejected with it is not, since it would be rejected again.
+        """
+        delay_seconds = self.retry_delay_seconds
+
+        for retry_idx in range(self.max_nr_of_retries + 1):
+            try:
+                is_retry_of_chunk = retry_idx > 0 and get_session is not None
+                response = (get_session if is_retry_of_chunk else send_request)()
+
+                if response.status_code == 404 and is_retry_of_chunk and completed_session is not None:
+                    return completed_session
+                if response.status_code == 409 and get_session is not None:
+                    response = get_session()
+                if response.status_code in (200, 201):
+                    return response.json()
+                if response.status_code not in (429, 500, 502, 503, 504) and \
+                        not (response.status_code == 400 and get_session is not None):
+                    raise RuntimeError('The upload of {} failed: {}'.format(self.file_name, response.text))
+
+                error = 'the server returned {}'.format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+
+            if retry_idx < self.max_nr_of_retries:
+                time.sleep(delay_seconds)
+                delay_seconds = min(delay_seconds * 2, 60)
+
+        raise RuntimeError('The upload of {} failed: {}'.format(self.file_name, error))
@@ -1,5 +1,7 @@
 import sys
 import os
+import hashlib
+import threading
 
 from tkinter import Frame, Tk, BOTH, Button, Label, messagebox, scrolledtext, Entry, END
 from tkinter import filedialog
@@ -9,13 +11,19 @@ import requests
 import pickle
 
 from console_label import ConsoleLabel
+from chunked_uploader import ChunkedUploader
 from io import BytesIO
+from urllib.parse import quote
 
 if os.getenv('HTTP_HOST'):
     root_url = os.getenv('HTTP_HOST')
 else:
     root_url = 'http://localhost:5000'
 
+# the searches can be sent to the asynchronous search server (read more about it in the README)
+search_root_url = os.getenv('SEARCH_HTTP_HOST', root_url)
+
+
 class ClientApp(Tk):
 
     def __init__(self):
@@ -106,7 +114,8 @@ class MainView(Frame):
 
 
 class UploadFileView(Frame):
-    upload_url = root_url + '/upload'
+    # how often (in milliseconds) the progress of an upload is shown
+    upload_progress_interval_ms = 250
 
     def __init__(self, master):
         """
@@ -114,6 +123,9 @@ class UploadFileView(Frame):
         """
         Frame.__init__(self, master)
 
+        self.uploader = None
+        self.upload_progress_job = None
+
         self.init_ui()
 
     def init_ui(self):
@@ -135,6 +147,9 @@ class UploadFileView(Frame):
         self.btn_upload_file = Button(self, text="Upload file", command=self.upload_file)
         self.btn_upload_file.place(x=80, y=130)
 
+        self.upload_progress = Label(self, text="")
+        self.upload_progress.place(x=60, y=165)
+
         self.btn_back = Button(self, text="Back", command=self.go_back)
         self.btn_back.place(x=10, y=10)
 
@@ -156,7 +171,7 @@ class UploadFileView(Frame):
         name
         """
 
-        ftypes = [('CSV', '.csv'), ('JSON', '.json'), ('All files', '*')]
+        ftypes = [('CSV', '.csv'), ('Compressed CSV', ('.csv.gz', '.csv.zst')), ('JSON', '.json'), ('All files', '*')]
         dlg = filedialog.Open(self, filetypes=ftypes)
 
         absolute_file_path = dlg.show()
@@ -178,37 +193,68 @@ class UploadFileView(Frame):
     def upload_file(self):
         """
             This function is called when the 'Upload file' button was pressed.
-            It makes a POST request for uploading the previously selected file
-            and updates the label to '<Selected file name>' and also
-            updates the 'full_path_of_file' instance variable to 
-            'None', if the file was successfully uploaded 
+            It starts uploading the previously selected file, in chunks, in the
+            background (so large files can be uploaded without freezing the window
+            and an interrupted upload continues where it stopped), and then shows
+            the progress of the upload until it finishes
+        """
+        if getattr(self, 'full_path_of_file', None) is None:
+            # the 'Upload file' button was pressed but no file was selected, or the
+            # selected file was already uploaded
+            return
+
+        if self.uploader is not None and not self.uploader.is_finished():
+            messagebox.showinfo("Information", "Wait until the current upload finishes")
+            return
+
+        self.uploader = ChunkedUploader(root_url, self.full_path_of_file)
+        self.uploader.start()
+
+        self.show_upload_progress()
+
+    def show_upload_progress(self):
         """
-        
-        try:
-            with open(self.full_path_of_file, 'rb') as f:
-                r = requests.post(self.upload_url, files={'file': f})
+            This function shows the progress of the current upload and schedules itself
+            until the upload finishes; then it updates the label to '<Selected file name>',
+            the 'full_path_of_file' instance variable to 'None' (if the file was
+            successfully uploaded) and tells the user how the upload ended
+        """
+        status, nr_of_sent_bytes, size = self.uploader.get_progress()
 
-            self.selected_file_name.configure(text="<Selected file name>")
+        if not self.uploader.is_finished():
+            if status == 'uploading':
+                self.upload_progress.configure(text="Uploaded {:.0%} ({:.1f} of {:.1f} MB)".format(
+                    nr_of_sent_bytes / size if size else 1, nr_of_sent_bytes / 2 ** 20, size / 2 ** 20))
+            else:
+                self.upload_progress.configure(text="Preparing the upload...")
 
-            if r.status_code == requests.codes.ok:
-                self.__set_full_path_of_file(None)
-                messagebox.showinfo("Information", "File uploaded successfully!")
+            self.upload_progress_job = self.after(self.upload_progress_interval_ms, self.show_upload_progress)
+            return
+
+        self.upload_progress_job = None
+
+        self.upload_progress.configure(text="")
+        self.selected_file_name.configure(text="<Selected file name>")
+
+        if status == 'completed':
+            self.__set_full_path_of_file(None)
+            if self.uploader.is_taken_from_store:
+                messagebox.showinfo("Information", "The server already had this file; it was not uploaded again!")
             else:
-                messagebox.showerror("Error", "Could not upload file")
-        except AttributeError:
-            # this exceptions is raised when the 'Upload file' button was pressed but
-            # no file was previously selected
-            pass
-        except TypeError:
-            # this exceptions is raised when the 'Upload file' button was pressed 
-            # after the user already uploaded a file. Now a new file shoud be selected
-            # and uploaded or just go Back to the main menu
-            pass
+                messagebox.showinfo("Information", "File uploaded successfully!")
+        elif status == 'failed':
+            messagebox.showerror("Error", "Could not upload file: " + self.uploader.error)
 
     def go_back(self):
         """
-            This function changes the current frame to the "main" frame.
+            This function changes the current frame to the "main" frame. An upload that is
+            running is stopped; it continues where it stopped when the same file is uploaded again
         """
+        if self.uploader is not None:
+            self.uploader.cancel()
+        if self.upload_progress_job is not None:
+            self.after_cancel(self.upload_progress_job)
+
         self.master.switch_frame(MainView)
 
 
@@ -233,6 +279,7 @@ class TrainingFileView(Frame):
     create_uncertain_pairs_file_url = root_url + '/create_uncertain_pairs_file'
     get_uncertain_pairs_file_url = root_url + '/files/uncertain_pairs_file'
     upload_url = root_url + '/upload'
+    store_url = root_url + '/upload/store'
 
     def __init__(self, master):
         """Constructor"""
@@ -335,6 +382,15 @@ class TrainingFileView(Frame):
 
         file_path = os.getcwd() + "/" + self.console_label.training_file_name
 
+        with open(file_path, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+
+        # the file is not uploaded again if the server already has the same training file
+        r = requests.post(self.store_url, json={'file_name': self.console_label.training_file_name,
+                                                'checksum': checksum})
+        if r.status_code == requests.codes.ok:
+            return
+
         with open(file_path, 'r') as f:
             r = requests.post(self.upload_url, files={'file': f})
 
@@ -343,15 +399,27 @@ class TrainingFileView(Frame):
 
 
 class ResultsView(Frame):
-    companies_url = root_url + "/search/company/"
+    companies_url = search_root_url + "/search/company/"
+    autocomplete_url = root_url + "/autocomplete/legal_name/"
     combobox_values = ("legal_name", "thoroughfare")
 
+    # the suggestions are requested only after the user typed at least this many characters
+    min_autocomplete_prefix_length = 2
+
+    # the suggestions are requested only after the user stopped typing for this many milliseconds, and
+    # the window checks this often (in milliseconds) whether they arrived
+    autocomplete_delay_ms = 300
+    autocomplete_poll_interval_ms = 50
+    autocomplete_timeout_seconds = 5
+
     def __init__(self, master):
         """
             Constructor
         """
         Frame.__init__(self, master)
 
+        self.autocomplete_job = None
+
         self.init_UI()
 
     def init_UI(self):
@@ -372,7 +440,9 @@ class ResultsView(Frame):
         self.label_input = Label(self, text="Entry the value")
         self.label_input.pack()
 
-        self.user_input = Entry(self, width=40)
+        # the entry is a combobox, so that it can show the suggested company names while the user types
+        self.user_input = Combobox(self, width=40)
+        self.user_input.bind("<KeyRelease>", self.suggest_legal_names)
         self.user_input.pack()
 
         self.btn_submit = Button(self, text="Submit", command=self.submit)
@@ -390,8 +460,77 @@ class ResultsView(Frame):
         """
             This function changes the current frame to the "main" frame.
         """
+        if self.autocomplete_job is not None:
+            self.after_cancel(self.autocomplete_job)
+
         self.master.switch_frame(MainView)
 
+    def suggest_legal_names(self, event):
+        """
+            This function is called every time the user types something in the search box. The
+            suggestions are requested only when the user stops typing, so a request is not sent for
+            every key that was pressed.
+
+            :param event: the key release event
+        """
+        if self.autocomplete_job is not None:
+            self.after_cancel(self.autocomplete_job)
+
+        self.autocomplete_job = self.after(self.autocomplete_delay_ms, self.request_suggestions)
+
+    def request_suggestions(self):
+        """
+            If the search is done by 'legal_name', this function makes a GET request, in a background
+            thread (so the window doesn't freeze while the server answers), for the company names that
+            start with what the user typed so far, and then shows them when they arrive
+        """
+        self.autocomplete_job = None
+
+        prefix = self.user_input.get()
+
+        if self.combo_searching_options.get() != "legal_name" or \
+                len(prefix.strip()) < self.min_autocomplete_prefix_length:
+            self.user_input['values'] = ()
+            return
+
+        suggestions_request = {'prefix': prefix}
+
+        def get_suggestions():
+            try:
+                r = requests.get(self.autocomplete_url + quote(prefix, safe=''),
+                                 timeout=self.autocomplete_timeout_seconds)
+
+                if r.status_code == requests.codes.ok:
+                    suggestions_request['suggestions'] = [suggestion['legal_name']
+                                                          for suggestion in pickle.load(BytesIO(r.content))]
+            except requests.exceptions.RequestException:
+                # the suggestions are optional, the user can still submit the search
+                pass
+
+            suggestions_request['is_finished'] = True
+
+        threading.Thread(target=get_suggestions, daemon=True).start()
+
+        self.show_suggestions(suggestions_request)
+
+    def show_suggestions(self, suggestions_request):
+        """
+            This function shows the suggestions of the given request in the drop-down list of the search box,
+            when they arrive and if the user didn't type something else in the meantime; until then, it
+            schedules itself
+
+            :param suggestions_request: dictionary where the background thread puts the suggestions
+        """
+        if not suggestions_request.get('is_finished'):
+            self.autocomplete_job = self.after(self.autocomplete_poll_interval_ms, self.show_suggestions,
+                                               suggestions_request)
+            return
+
+        self.autocomplete_job = None
+
+        if 'suggestions' in suggestions_request and suggestions_request['prefix'] == self.user_input.get():
+            self.user_input['values'] = suggestions_request['suggestions']
+
     def submit(self):
         """
             This function makes a GET request in order to get the queried results. The results represent a
@@ -0,0 +1,265 @@
+"""
+Admission control of the requests served by the server.
+
+The requests are put in classes: the jobs (e.g. a run of the algorithm), which take minutes and use
+all the cores and the database, and the searches and lookups, which should be answered in milliseconds.
+Every class has its own limit of requests served at once and of requests waiting for their turn, so
+the jobs can never take the capacity of the searches: a job that comes when the limit of the jobs is
+reached waits (if there is room in the queue, for at most the queue timeout) or is rejected with
+'429 Too Many Requests' and a 'Retry-After' header, which estimates when a slot will be free from
+the mean duration of the requests of the class. The searches are limited the same way, so a burst of
+searches is rejected quickly instead of making all the searches slow.
+
+The slots of the jobs are lock files, so the limit holds for all the worker processes of the pre-forked
+mode (two runs of the algorithm in the same working directory would overwrite each other's files). The
+jobs also run with a lower CPU priority (a higher niceness) than the searches, and so do the processes
+they start (e.g. the ones that match partitions in parallel).
+
+The limits are given with environment variables (read more about them in 'AdmissionLimit.from_environment').
+"""
+import os
+import math
+import time
+import ctypes
+import fcntl
+import logging
+import platform
+import functools
+import threading
+
+from collections import OrderedDict
+
+# how often (in seconds) a request waiting for a slot that is held by another process checks it again
+LOCK_POLL_INTERVAL_SECONDS = 0.1
+
+# the bounds of the 'Retry-After' header, in seconds
+MIN_RETRY_AFTER_SECONDS = 1
+MAX_RETRY_AFTER_SECONDS = 3600
+
+# the weight of the duration of the last request in the mean duration of its class
+DURATION_SMOOTHING = 0.2
+
+# the number of the Linux 'gettid' system call, for the architectures where the server runs; it is used to
+# find the id of a thread on Python versions older than 3.8, which don't have 'threading.get_native_id'
+GETTID_SYSCALL_NUMBERS = {'x86_64': 186, 'i386': 224, 'i686': 224, 'aarch64': 178, 'armv7l': 224}
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request can't be served because the limit of its class is reached
+
+    :param retry_after_seconds: int data type, after how many seconds the client should try again
+    """
+
+    def __init__(self, request_class_name, retry_after_seconds):
+        super().__init__("Too many {} requests; try again in {} s".format(request_class_name, retry_after_seconds))
+        self.retry_after_seconds = retry_after_seconds
+
+
+class AdmissionLimit:
+    """
+    Limits the number of requests of a class that are served at once and that wait for their turn
+    """
+
+    def __init__(self, name, max_concurrent, max_queued=0, queue_timeout_seconds=0, lock_file_prefix=None,
+                 default_duration_seconds=1.0, niceness=0):
+        """
+        Constructor
+
+        :param name: string object containing the name of the class of requests, e.g. 'job'
+        :param max_concurrent: int data type, the maximum number of requests served at once
+        :param max_queued: int data type, the maximum number of requests waiting for a slot
+        :param queue_timeout_seconds: the maximum number of seconds a request waits for a slot
+        :param lock_file_prefix: string object containing the prefix of the lock files of the slots, if the
+                                 limit is shared by all the processes of the server, or None
+        :param default_duration_seconds: the duration of a request assumed before any was served, used for
+                                         the 'Retry-After' header
+        :param niceness: int data type, how much the CPU priority of the requests (and of the processes they
+                         start) is lowered; 0 keeps the priority of the server
+        """
+        self.name = name
+        self.max_concurrent = max(max_concurrent, 1)
+        self.max_queued = max(max_queued, 0)
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.lock_file_prefix = lock_file_prefix
+        self.niceness = niceness
+
+        self.mean_duration_seconds = default_duration_seconds
+        self.nr_of_served_requests = 0
+        self.nr_of_rejected_requests = 0
+
+        self.__nr_of_running_requests = 0
+        self.__nr_of_queued_requests = 0
+        self.__condition = threading.Condition()
+
+    @classmethod
+    def from_environment(cls, name, default_max_concurrent, default_max_queued, default_queue_timeout_seconds,
+                         **kwargs):
+        """
+        Creates the limit of the given class from the environment variables BACKBONE_<NAME>_MAX_CONCURRENT,
+        BACKBONE_<NAME>_MAX_QUEUED and BACKBONE_<NAME>_QUEUE_TIMEOUT_SECONDS (e.g. BACKBONE_JOB_MAX_CONCURRENT),
+        or from the given defaults
+        """
+        prefix = 'BACKBONE_' + name.upper()
+        return cls(name,
+                   int(os.getenv(prefix + '_MAX_CONCURRENT', default_max_concurrent)),
+                   int(os.getenv(prefix + '_MAX_QUEUED', default_max_queued)),
+                   float(os.getenv(prefix + '_QUEUE_TIMEOUT_SECONDS', default_queue_timeout_seconds)),
+                   **kwargs)
+
+    def acquire(self):
+        """
+        Waits for a slot and returns it; if there is no room in the queue or no slot is free before
+        the queue timeout, 'AdmissionRejected' is raised
+        """
+        deadline = time.time() + self.queue_timeout_seconds
+
+        with self.__condition:
+            if self.__nr_of_running_requests + self.__nr_of_queued_requests >= self.max_concurrent + self.max_queued:
+                self.__reject()
+
+            self.__nr_of_queued_requests += 1
+            try:
+                while True:
+                    slot = self.__take_free_slot()
+                    if slot is not None:
+                        self.__nr_of_running_requests += 1
+                        return slot
+
+                    remaining_seconds = deadline - time.time()
+                    if remaining_seconds <= 0:
+                        self.__reject()
+
+                    # the slots held by other processes are not notified, so they are checked again regularly
+                    self.__condition.wait(min(remaining_seconds, LOCK_POLL_INTERVAL_SECONDS)
+                                          if self.lock_file_prefix else remaining_seconds)
+            finally:
+                self.__nr_of_queued_requests -= 1
+
+    def release(self, slot, duration_seconds):
+        """
+        Frees the given slot, taken by a request that was served in the given number of seconds
+        """
+        if slot is not True:
+            slot.close()
+
+        with self.__condition:
+            self.__nr_of_running_requests -= 1
+            self.nr_of_served_requests += 1
+            self.mean_duration_seconds += DURATION_SMOOTHING * (duration_seconds - self.mean_duration_seconds)
+
+            self.__condition.notify()
+
+    def get_retry_after_seconds(self):
+        """
+        Returns the estimated number of seconds after which a slot is free for a new request
+        """
+        waves = (self.__nr_of_queued_requests + 1) / float(self.max_concurrent)
+        retry_after_seconds = int(math.ceil(self.mean_duration_seconds * waves))
+
+        return min(max(retry_after_seconds, MIN_RETRY_AFTER_SECONDS), MAX_RETRY_AFTER_SECONDS)
+
+    def get_report(self):
+        with self.__condition:
+            return OrderedDict([('max_concurrent', self.max_concurrent),
+                                ('max_queued', self.max_queued),
+                                ('queue_timeout_seconds', self.queue_timeout_seconds),
+                                ('running', self.__nr_of_running_requests),
+                                ('queued', self.__nr_of_queued_requests),
+                                ('served', self.nr_of_served_requests),
+                                ('rejected', self.nr_of_rejected_requests),
+                                ('mean_seconds', round(self.mean_duration_seconds, 3))])
+
+    def __take_free_slot(self):
+        """
+        Returns a free slot (True, or the open lock file of the slot if the limit is shared by the
+        processes of the server), or None if all the slots are taken
+        """
+        if self.__nr_of_running_requests >= self.max_concurrent:
+            return None
+
+        if not self.lock_file_prefix:
+            return True
+
+        for slot_idx in range(self.max_concurrent):
+            lock_file = open('{}{}.lock'.format(self.lock_file_prefix, slot_idx), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except OSError:
+                lock_file.close()
+
+        return None
+
+    def __reject(self):
+        self.nr_of_rejected_requests += 1
+        retry_after_seconds = self.get_retry_after_seconds()
+
+        logging.warning('{} request rejected: {} running, {} queued; retry after {} s'.format(
+            self.name, self.__nr_of_running_requests, self.__nr_of_queued_requests, retry_after_seconds))
+
+        raise AdmissionRejected(self.name, retry_after_seconds)
+
+
+def get_native_thread_id():
+    """
+    This function returns the id the kernel gave to the current thread, or None if it can't be found
+    """
+    get_native_id = getattr(threading, 'get_native_id', None)
+    if get_native_id is not None:
+        return get_native_id()
+
+    gettid_syscall_number = GETTID_SYSCALL_NUMBERS.get(platform.machine())
+    if platform.system() != 'Linux' or gettid_syscall_number is None:
+        return None
+
+    thread_id = ctypes.CDLL(None, use_errno=True).syscall(gettid_syscall_number)
+
+    return thread_id if thread_id > 0 else None
+
+
+def lower_priority_of_current_thread(niceness):
+    """
+    This function raises the niceness of the current thread (on Linux every thread has its own), so
+    the processes it starts also inherit the lower priority. The main thread is never changed, since
+    the priority can't be raised again and the main thread serves all the requests of a server that
+    doesn't use threads.
+    """
+    if not niceness or threading.current_thread() is threading.main_thread():
+        return
+
+    try:
+        thread_id = get_native_thread_id()
+        if thread_id is None:
+            logging.debug('could not lower the priority of the thread: its id is unknown')
+            return
+
+        os.setpriority(os.PRIO_PROCESS, thread_id, os.getpriority(os.PRIO_PROCESS, thread_id) + niceness)
+    except (AttributeError, OSError) as e:
+        logging.debug('could not lower the priority of the thread: {}'.format(e))
+
+
+def admitted(admission_limit, rejected_response):
+    """
+    Decorator of the views whose requests are limited by the given AdmissionLimit. When a request is
+    rejected, the view returns what 'rejected_response' returns for the AdmissionRejected exception.
+    """
+    def decorator(view_function):
+        @functools.wraps(view_function)
+        def wrapper(*args, **kwargs):
+            try:
+                slot = admission_limit.acquire()
+            except AdmissionRejected as e:
+                return rejected_response(e)
+
+            start_time = time.perf_counter()
+            try:
+                lower_priority_of_current_thread(admission_limit.niceness)
+
+                return view_function(*args, **kwargs)
+            finally:
+                admission_limit.release(slot, time.perf_counter() - start_time)
+
+        return wrapper
+
+    return decorator
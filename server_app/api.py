@@ -1,106 +1,459 @@
 import os
-
+import csv
+import pickle
+import shutil
+import logging
+import functools
+
+# imported before the other modules of the application, so that it can measure
+# how long the heavy modules take to be imported
+import prefork
+import metrics
 import utilities
+import sql_tracing
+import upload_store
+import chunked_upload
+import memory_budget
+import admission_control
 
-from flask import Flask, flash, request, redirect, send_from_directory
+from flask import Flask, flash, request, redirect, send_from_directory, jsonify, Response
 from werkzeug.utils import secure_filename
 
+from autocomplete_index import AutocompleteIndex
 from backbone import Backbone
+from resident_matcher import ResidentMatcher
+from multi_source_linker import MultiSourceLinker, generate_output_rows_of_source
 
 app = Flask(__name__)
+
+# the number of companies returned by the ranked search, if the client did not ask for a given number,
+# and the maximum number of companies that the client can ask for
+default_ranked_search_limit = 10
+max_ranked_search_limit = 100
+
+# in-memory index of the company names, used for type-ahead searches; it is built when the
+# server starts (or at the first request, if the database was not reachable) and rebuilt
+# every time the algorithm loads new companies
+legal_name_autocomplete_index = AutocompleteIndex('legal_name')
+default_autocomplete_limit = 10
+max_autocomplete_limit = 50
+
+# maximum number of values (names, addresses or cluster_ids) that can be resolved with one batch request
+max_batch_search_size = 10000
+# the range of the bigint columns of the database (e.g. 'cluster_id')
+min_bigint = -2 ** 63
+max_bigint = 2 ** 63 - 1
+
+# the trained model of the last run, kept in memory for matching single records in real time
+resident_matcher = ResidentMatcher(Backbone.resident_model_settings_file_name)
+max_records_to_match = 100
+default_nr_of_matches = 1
+default_match_threshold = 0.5
+
+# modification time of the data version file when the in-memory indexes of this process were last checked
+loaded_data_version = None
+
+# the limits of the jobs and of the searches and lookups, which are served at the same time, with separate
+# capacities (read more about this in the 'admission_control' module); by default one job runs at once,
+# with a lower CPU priority, and a job that comes while another one runs is rejected
+job_admission_limit = admission_control.AdmissionLimit.from_environment(
+    'job', 1, 0, 0,
+    lock_file_prefix='job_slot_',
+    default_duration_seconds=600,
+    niceness=int(os.getenv('BACKBONE_JOB_NICENESS', '10')))
+search_admission_limit = admission_control.AdmissionLimit.from_environment(
+    'search', 16, 64, 5,
+    default_duration_seconds=0.2)
+
+
+def get_data_version():
+    """
+    This function returns the modification time of the data version file, or None if
+    the algorithm never loaded companies into the database
+    """
+    try:
+        return os.stat(Backbone.data_version_file_name).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def invalidate_in_memory_indexes_if_data_changed():
+    """
+    This function marks the autocomplete index and the resident model as outdated if the
+    algorithm loaded new companies since the last check. It is needed in the pre-forked mode,
+    where the run of the algorithm can only refresh the indexes of the worker that ran it.
+    """
+    global loaded_data_version
+
+    data_version = get_data_version()
+
+    if data_version != loaded_data_version:
+        if loaded_data_version is not None:
+            legal_name_autocomplete_index.invalidate()
+            resident_matcher.reset()
+
+        loaded_data_version = data_version
  
 
+def reject_request(rejection):
+    """
+    This function returns the response to a request that was rejected by the admission control:
+    '429 Too Many Requests', with a 'Retry-After' header
+
+    :param rejection: AdmissionRejected exception
+    """
+    return str(rejection), 429, {'Retry-After': str(rejection.retry_after_seconds)}
+
+
+admitted_job = admission_control.admitted(job_admission_limit, reject_request)
+admitted_search = admission_control.admitted(search_admission_limit, reject_request)
+
+
+def reported_job(view_function):
+    """
+    Decorator of the views that run a job (e.g. the algorithm): the stages and the database calls of
+    the job are timed (read more about this in the 'metrics' module) and, if the job ends successfully,
+    the client gets, as JSON, the message returned by the view together with the job report
+    """
+    @functools.wraps(view_function)
+    def wrapper(*args, **kwargs):
+        with metrics.JobReport(view_function.__name__) as job_report:
+            result = view_function(*args, **kwargs)
+
+        if isinstance(result, str):
+            return jsonify(message=result, report=job_report.report)
+
+        return result
+
+    return wrapper
+
+
+def load_rows_resulted_from_dedupe_into_database(backbone):
+    """
+    This function inserts the new cluster_ids created by Dedupe into the 'backbone_index' table
+    and streams the rows resulted from Dedupe into the table(s) of the provider(s). It can only be
+    called after all the cells of the Jupyter notebook were executed.
+
+    :param backbone: the Backbone object that ran the algorithm
+    """
+    database_config = backbone.data_from_config_file['database_config']
+
+    # the rows resulted from Dedupe are generated on demand and streamed into the database,
+    # so no output file has to be written and read again
+    if backbone.is_partitioned_by_jurisdiction():
+        output_rows_1 = backbone.generate_output_rows_of_partitions()
+    else:
+        output_rows_1 = backbone.generate_output_rows(1)
+
+    # if the 2nd dataset contained rows from the database, those examples from the 2nd dataset
+    # already had assigned a cluster_id (backbone index), but when Dedupe created new clusters,
+    # which were made of 1 example from the 1st dataset and one from the 2nd dataset,
+    # it gave that cluster a unique cluster_id (one that did not exist in the backbone_index table).
+    # So, we have to update the cluster_ids of those clusters with the cluster_ids that the examples 
+    # from the 2nd dataset originally had.
+    if backbone.is_partitioned_by_jurisdiction():
+        # the rows of the partitions already have the cluster_ids from the database
+        last_new_cluster_id = backbone.last_cluster_id_in_db + backbone.get_nr_of_rows_without_cluster_in_partitions()
+    elif backbone.is_tmp_file_used():
+        with metrics.stage('cluster_remap'):
+            # the map is kept on disk if it would not fit in the memory budget
+            if backbone.memory_budget.should_spill(
+                    'output',
+                    lambda: len(backbone.notebook_namespace['second_dataset']) * memory_budget.BYTES_PER_REMAPPED_ROW):
+                cluster_ids_from_database = backbone.create_spilled_map_of_cluster_ids_given_by_dedupe()
+            else:
+                cluster_ids_from_database = {}
+
+            utilities.get_cluster_ids_from_database_of_matched_rows(backbone.generate_output_rows(2),
+                                                                     cluster_ids_from_database)
+
+        output_rows_1 = utilities.generate_rows_with_cluster_ids_from_database(
+            output_rows_1,
+            cluster_ids_from_database,
+            backbone.last_cluster_id_in_db)
+
+        last_new_cluster_id = (backbone.last_cluster_id_in_db +
+                               backbone.get_nr_of_rows_without_cluster_in_first_dataset())
+    else:
+        last_new_cluster_id = backbone.get_last_cluster_id_given_by_dedupe()
+
+    # insert the new cluster_ids created by Dedupe into the backbone_index table
+    with metrics.stage('backbone_index_insert'):
+        utilities.insert_cluster_id_range_into_backbone_index_table(
+            database_config,
+            backbone.last_cluster_id_in_db + 1,
+            last_new_cluster_id)
+
+    # the output files are only written if the user asked for them
+    if backbone.is_output_export_requested():
+        output_rows_1 = utilities.generate_rows_and_write_them_to_csv_file(output_rows_1, backbone.output_file_1)
+
+    # the rows are generated while they are streamed, so the time of the COPY load
+    # also includes generating the rows (and writing the output files, if they were asked for)
+    with metrics.stage('copy_load'):
+        if backbone.is_delta_used:
+            # only the new and the changed rows were matched; they are added to the rows that did not change
+            utilities.insert_rows_resulted_from_dedupe_into_existing_table(
+                database_config,
+                backbone.data_from_config_file['provider_1_name'],
+                backbone.input_file_1,
+                output_rows_1)
+        else:
+            # create a new table having FK on cluster_id (referencing the PK 'idx' of the backbone_index table)
+            # and insert the resulted dataset from Dedupe in the table
+            # the resulted dataset is formed from the input dataset + 3 new columns: 'cluster_id', 'link_score'
+            # and 'row_hash'
+            utilities.create_table_and_insert_rows_resulted_from_dedupe(
+                database_config,
+                backbone.data_from_config_file['provider_1_name'],
+                backbone.input_file_1,
+                output_rows_1)
+
+    # if we were provided with a 2nd input dataset, insert it in the DB also
+    if not backbone.is_tmp_file_used():
+        output_rows_2 = backbone.generate_output_rows(2)
+
+        if backbone.is_output_export_requested():
+            output_rows_2 = utilities.generate_rows_and_write_them_to_csv_file(output_rows_2, backbone.output_file_2)
+
+        with metrics.stage('copy_load'):
+            utilities.create_table_and_insert_rows_resulted_from_dedupe(
+                database_config,
+                backbone.data_from_config_file['provider_2_name'],
+                backbone.input_file_2,
+                output_rows_2)
+    elif backbone.is_output_export_requested() and not backbone.is_partitioned_by_jurisdiction():
+        with open(backbone.output_file_2, 'w') as output_file_2:
+            csv.writer(output_file_2).writerows(backbone.generate_output_rows(2))
+
+
+def update_indexes_after_loading_companies(database_config, provider_names, last_cluster_id_in_db):
+    """
+    This function updates the search index and the autocomplete index with the companies from the
+    tables of the given providers, drops the indexes of the real-time matching and lets the other
+    server processes know that their in-memory indexes are outdated.
+
+    :param database_config: dictionary containing the database parameters needed for creating
+                            a connection; the dictionary is the one given in the configuration file
+    :param provider_names: list of string objects containing the names of the providers whose
+                           tables were (re)created or changed
+    :param last_cluster_id_in_db: the last cluster_id that was in the database before the companies were loaded
+    """
+    # the rows of the new table(s) got new 'company_id' values, so their entries
+    # from the search index have to be rebuilt
+    with metrics.stage('search_index'):
+        for provider_name in provider_names:
+            utilities.index_provider_table_for_search(database_config, provider_name)
+
+        legal_name_autocomplete_index.build(database_config)
+
+    resident_matcher.reset()
+
+    # let the other server processes know that their in-memory indexes are outdated
+    global loaded_data_version
+    with open(Backbone.data_version_file_name, 'w') as data_version_file:
+        data_version_file.write(str(last_cluster_id_in_db))
+    loaded_data_version = get_data_version()
+
+
 @app.route('/run_algorithm', methods=['POST'])
+@admitted_job
+@reported_job
 def run_algorithm():
     """
     This function represents the main algorithm of the service. It assumes all the
     neccessary files were uploaded by the user.
     The execution flow is the next one:
     1) Create Backbone object, which will create the configuration file for Dedupe
-    2) If the user has not provided the 2nd input dataset, then a temporary file,
+    2) If the user has not provided the 2nd input dataset and the provider of the 1st
+       dataset sent its dataset before, only the new and the changed rows of the dataset
+       will be matched (the other ones keep their cluster_ids)
+    3) If the user has not provided the 2nd input dataset, then a temporary file,
        that will contain rows extracted by 'jurisdiction' from the database, 
-       will be created using the Backbone object
-    3) Execute all the cells in the jupyter notebook
-    4) If a temporary file was created update the given cluster_ids (read more about
+       will be created using the Backbone object. If several jurisdictions were
+       given, the 1st dataset is partitioned by jurisdiction, the rows of all these
+       jurisdictions are extracted at once and the partitions are matched in parallel
+       (instead of step 4)
+    4) Execute all the cells in the jupyter notebook
+    5) If a temporary file was created update the given cluster_ids (read more about
        this in a comment below)
-    5) Insert the new cluster_ids into the 'backbone_index' table
-    6) Create table(s) in the database and insert the dataset(s) resulted from the
-       Dedupe algorithm.
-    7) Remove all the files that were used in the process, except for the configuration
+    6) Insert the new cluster_ids into the 'backbone_index' table
+    7) Create table(s) in the database and stream the rows resulted from the
+       Dedupe algorithm into them (or, if only the new and the changed rows were matched,
+       delete the rows that were removed or changed and add the new rows to the table).
+       The output files are only written if the 'export_output_files' parameter from
+       the configuration file is true
+    8) Update the search index and the autocomplete index with the companies from the new table(s)
+    9) Keep a copy of the trained model for the real-time matching
+    10) Remove all the files that were used in the process, except for the configuration
        file provided by the user. We do not remove this file, because if the user
        would like to see some results, that are stored in the database, it will need
        to provide again the configuration file (since the system needs the database
        configuration data). So, we leave it there for convenience
+    The client gets, as JSON, a report of the run, with the time and the peak memory of every stage,
+    the time of every database call, the stages that were switched to their spill-to-disk mode (because
+    of the memory budget) and the reports of the training and of the blocking.
     """
 
     # Backbone object that will do all the work
     backbone = Backbone()
 
-    # run the backbone script file
-    if backbone.is_tmp_file_used():
-        backbone.extract_data_from_db_and_create_second_input_dataset()
+    job_report = metrics.get_current_job_report()
+    job_report.trace_allocations(backbone.memory_budget.nr_of_top_allocations)
 
-    # execute all the cells in the Jupyter notebook
-    backbone.execute_jupyter_notebook_cells(idx_first_cell=0)
+    database_config = backbone.data_from_config_file['database_config']
 
-    # if the 2nd dataset contained rows from the database, those examples from the 2nd dataset
-    # already had assigned a cluster_id (backbone index), but when Dedupe created new clusters,
-    # which were made of 1 example from the 1st dataset and one from the 2nd dataset,
-    # it gave that cluster a unique cluster_id (one that did not exist in the backbone_index table).
-    # So, we have to update the cluster_ids of those clusters with the cluster_ids that the examples 
-    # from the 2nd dataset originally had.
     if backbone.is_tmp_file_used():
-        utilities.update_cluster_ids_of_output_file_1(
-            backbone.output_file_1,
-            backbone.output_file_2,
-            backbone.input_file_2
-        )
-
-    # insert the new cluster_ids created by Dedupe into the backbone_index table
-    if backbone.is_tmp_file_used():
-        utilities.insert_new_cluster_ids_into_backbone_index_table(
-            backbone.data_from_config_file['database_config'],
-            backbone.output_file_1,
-            output_file_2=None,
-            last_cluster_id=backbone.last_cluster_id_in_db)
-    else:
-        utilities.insert_new_cluster_ids_into_backbone_index_table(
-            backbone.data_from_config_file['database_config'],
-            backbone.output_file_1,
-            backbone.output_file_2,
-            backbone.last_cluster_id_in_db)
-
-    # create a new table having FK on cluster_id (referencing the PK 'idx' of the backbone_index table) 
-    # and insert the resulted dataset from Dedupe in the table
-    # the resulted dataset is formed from the input dataset + 2 new columns: 'cluster_id' and 'link_score'
-    utilities.create_table_and_insert_dataset_resulted_from_dedupe(
-        backbone.data_from_config_file['database_config'],
-        backbone.data_from_config_file['provider_1_name'],
-        backbone.output_file_1)
-
-    # if we were provided with a 2nd input dataset, insert it in the DB also
+        with metrics.stage('delta'):
+            backbone.create_delta_of_first_input_dataset()
+
+    # Dedupe is run only if there is something to match
+    if backbone.has_rows_to_match():
+        if backbone.is_partitioned_by_jurisdiction():
+            # the 1st dataset is split by jurisdiction and the partitions are matched in parallel
+            backbone.match_partitions_in_parallel()
+        else:
+            # run the backbone script file
+            if backbone.is_tmp_file_used():
+                with metrics.stage('extraction'):
+                    backbone.extract_data_from_db_and_create_second_input_dataset()
+
+            # execute all the cells in the Jupyter notebook
+            backbone.execute_jupyter_notebook_cells(idx_first_cell=0)
+
+            job_report.report['training'] = backbone.notebook_namespace.get('training_report')
+            job_report.report['blocking'] = backbone.notebook_namespace.get('blocking_report')
+
+        load_rows_resulted_from_dedupe_into_database(backbone)
+
+        # the real-time matching uses the model of the last run, and the companies that were just loaded
+        # (if none of the partitions had rows to match with, no model was trained)
+        settings_file_name = backbone.settings_file_name if backbone.settings_file_name else "settings_file"
+        if os.path.isfile(settings_file_name):
+            shutil.copyfile(settings_file_name, Backbone.resident_model_settings_file_name)
+
+    # the old versions of the changed rows are deleted only now, so that, while matching, a changed
+    # row could still be matched with the cluster its old version belongs to
+    if backbone.is_delta_used:
+        utilities.delete_rows_with_row_hashes(
+            database_config,
+            backbone.data_from_config_file['provider_1_name'],
+            backbone.removed_row_hashes)
+
+    provider_names = [backbone.data_from_config_file['provider_1_name']]
     if not backbone.is_tmp_file_used():
-        utilities.create_table_and_insert_dataset_resulted_from_dedupe(
-            backbone.data_from_config_file['database_config'],
-            backbone.data_from_config_file['provider_2_name'],
-            backbone.output_file_2)
+        provider_names.append(backbone.data_from_config_file['provider_2_name'])
+
+    update_indexes_after_loading_companies(database_config, provider_names, backbone.last_cluster_id_in_db)
 
     os.remove(backbone.input_file_1)
-    os.remove(backbone.input_file_2)
+    if backbone.is_delta_used:
+        os.remove(backbone.full_input_file_1)
+    if os.path.isfile(backbone.input_file_2):
+        os.remove(backbone.input_file_2)
     os.remove(backbone.training_file_name)
-    os.remove(backbone.output_file_1)
-    os.remove(backbone.output_file_2)
     os.remove(backbone.configuration_file_name_for_dedupe)
+    backbone.remove_partition_files()
+
+    job_report.report['memory_budget'] = backbone.get_memory_budget_report()
+    backbone.remove_spill_files()
 
     if backbone.settings_file_name:
         os.remove(backbone.settings_file_name)
-    else:
+    elif os.path.isfile("settings_file"):
         os.remove("settings_file")
 
     return "Algorithm ran successfully"
 
 
+@app.route('/run_multi_source_algorithm', methods=['POST'])
+@admitted_job
+@reported_job
+def run_multi_source_algorithm():
+    """
+    This function links several datasets (sources), from different providers, against each other
+    and against the companies of a jurisdiction that are already in the database, in one job.
+    It assumes the datasets and the configuration file were uploaded by the user. The configuration
+    file has, instead of the two input files, a list of sources, e.g.:
+    "input_files": [{"input_file": "file1.csv", "provider_name": "provider1"}, ...]
+    The sources are matched with the model from the settings file given in the configuration file
+    or, if none was given, with the model of the last run of the algorithm.
+    The execution flow is the next one:
+    1) Index one company per cluster of the jurisdiction, from the database
+    2) Link the sources one after the other (read more about this in the 'multi_source_linker' module)
+    3) Insert the new cluster_ids into the 'backbone_index' table
+    4) Create a table for every source and stream its rows, with their cluster_ids, into it
+    5) Update the search index and the autocomplete index with the companies from the new tables
+    6) Remove the datasets
+    """
+    config_data = Backbone.read_configuration_file()
+    database_config = config_data['database_config']
+
+    if not config_data.get('jurisdiction') or not isinstance(config_data['jurisdiction'], str):
+        return "The configuration file must have a 'jurisdiction'", 400
+
+    input_files = config_data.get('input_files')
+    if not input_files or not isinstance(input_files, list) or \
+            not all(isinstance(source, dict) and source.get('input_file') and source.get('provider_name') and
+                    isinstance(source['input_file'], str) and isinstance(source['provider_name'], str)
+                    for source in input_files):
+        return "The configuration file must have a list of 'input_files', where every source has an " \
+               "'input_file' and a 'provider_name'", 400
+
+    sources = [(secure_filename(source['input_file']), source['provider_name']) for source in input_files]
+
+    missing_input_file_names = [source['input_file'] for source, (input_file_name, provider_name)
+                                in zip(input_files, sources) if not os.path.isfile(input_file_name)]
+    if missing_input_file_names:
+        return "The input files were not uploaded: " + ', '.join(missing_input_file_names), 400
+
+    settings_file_name = config_data.get('training', {}).get('settings_file')
+    settings_file_name = secure_filename(settings_file_name) if settings_file_name else \
+        Backbone.resident_model_settings_file_name
+    if not os.path.isfile(settings_file_name):
+        return "No trained model is available; give a settings file or run the algorithm first", 400
+
+    with metrics.stage('extraction'):
+        linker = MultiSourceLinker(settings_file_name, config_data.get('threshold') or default_match_threshold)
+        linker.index_clusters_from_database(database_config, config_data['jurisdiction'])
+
+    last_cluster_id_in_db = utilities.get_maximum_cluster_id_from_backbone_index_table(database_config)
+
+    # all the sources are linked before anything is loaded, so the new cluster_ids are known
+    assignments_of_sources = []
+    next_cluster_id = last_cluster_id_in_db + 1
+    with metrics.stage('match'):
+        for input_file_name, provider_name in sources:
+            assignments, next_cluster_id = linker.link_source(input_file_name, next_cluster_id)
+            assignments_of_sources.append(assignments)
+
+    with metrics.stage('backbone_index_insert'):
+        utilities.insert_cluster_id_range_into_backbone_index_table(
+            database_config,
+            last_cluster_id_in_db + 1,
+            next_cluster_id - 1)
+
+    with metrics.stage('copy_load'):
+        for (input_file_name, provider_name), assignments in zip(sources, assignments_of_sources):
+            utilities.create_table_and_insert_rows_resulted_from_dedupe(
+                database_config,
+                provider_name,
+                input_file_name,
+                generate_output_rows_of_source(input_file_name, assignments))
+
+    update_indexes_after_loading_companies(
+        database_config,
+        [provider_name for input_file_name, provider_name in sources],
+        last_cluster_id_in_db)
+
+    for input_file_name, provider_name in sources:
+        os.remove(input_file_name)
+
+    return "Algorithm ran successfully"
+
+
 @app.route('/create_uncertain_pairs_file', methods=['POST'])
+@admitted_job
 def create_uncertain_pairs_file():
     """
     This function is called if the user wants to create a training file on the
@@ -128,6 +481,7 @@ def create_uncertain_pairs_file():
 
 
 @app.route('/search/company/legal_name/<legal_name>', methods=['GET'])
+@admitted_search
 def search_by_legal_name(legal_name):
     """
     This GET request function queries the database for companies that contain
@@ -144,6 +498,7 @@ def search_by_legal_name(legal_name):
 
 
 @app.route('/search/company/thoroughfare/<thoroughfare>', methods=['GET'])
+@admitted_search
 def search_by_thoroughfare(thoroughfare):
     """
     This GET request function queries the database for companies that contain
@@ -158,6 +513,197 @@ def search_by_thoroughfare(thoroughfare):
     return backbone.search_field_in_db_by_value_and_return_serialized_result("thoroughfare", thoroughfare)
 
 
+@app.route('/search/company/ranked/<field>/<value>', methods=['GET'])
+@admitted_search
+def search_ranked(field, value):
+    """
+    This GET request function queries the database for the companies whose 'field'
+    (legal_name or thoroughfare) is the most similar to the given value, using full-text
+    and trigram similarity ranking. The number of returned companies can be given with
+    the 'limit' query parameter (e.g. '?limit=20'). For more info look into the 'utilities'
+    module at the 'search_field_in_db_by_value_ranked' function.
+
+    :param field: string object containing the name of the field that is searched
+    :param value: string object containing the value we search for
+    """
+    if field not in utilities.SEARCHABLE_FIELDS:
+        return "Field '" + field + "' can not be searched", 404
+
+    limit = min(request.args.get('limit', default_ranked_search_limit, type=int), max_ranked_search_limit)
+
+    return pickle.dumps(utilities.search_field_in_db_by_value_ranked(
+        Backbone.read_database_config(), field, value, max(limit, 1)))
+
+
+def get_values_from_batch_request(key):
+    """
+    This function returns the list of values given in the JSON body of a batch request,
+    under the given key (e.g. {"values": ["name 1", "name 2"]}), or None if the body
+    doesn't contain such a list or the list is too long.
+
+    :param key: string object containing the key of the list in the JSON body
+    """
+    body = request.get_json(force=True, silent=True)
+
+    if not isinstance(body, dict) or not isinstance(body.get(key), list):
+        return None
+
+    if len(body[key]) > max_batch_search_size:
+        return None
+
+    return body[key]
+
+
+@app.route('/search/batch/company/<field>', methods=['POST'])
+@admitted_search
+def search_batch(field):
+    """
+    This POST request function resolves many names or addresses at once. The values are
+    given in the JSON body, e.g. {"values": ["name 1", "name 2"]}, and the result is a
+    dictionary where each given value has the clusters (and their companies, grouped by
+    provider table) it was found in. For more info look into the 'utilities' module at the
+    'search_field_in_db_by_values' function.
+
+    :param field: string object containing the name of the field that is searched
+                  (legal_name or thoroughfare)
+    """
+    if field not in utilities.SEARCHABLE_FIELDS:
+        return "Field '" + field + "' can not be searched", 404
+
+    values = get_values_from_batch_request('values')
+    if values is None:
+        return "The body must be a JSON object having a list of at most " + str(max_batch_search_size) + \
+               " elements under the key 'values'", 400
+
+    return pickle.dumps(utilities.search_field_in_db_by_values(Backbone.read_database_config(), field, values))
+
+
+@app.route('/search/batch/cluster', methods=['POST'])
+@admitted_search
+def search_batch_clusters():
+    """
+    This POST request function returns the companies of many clusters at once. The
+    cluster_ids are given in the JSON body, e.g. {"cluster_ids": [14, 55]}, and the
+    result is a dictionary where each given cluster_id has its companies grouped by
+    provider table. For more info look into the 'utilities' module at the
+    'search_clusters_in_db_by_cluster_ids' function.
+    """
+    cluster_ids = get_values_from_batch_request('cluster_ids')
+    if cluster_ids is None or not all(isinstance(cluster_id, int) and not isinstance(cluster_id, bool) and
+                                      min_bigint <= cluster_id <= max_bigint for cluster_id in cluster_ids):
+        return "The body must be a JSON object having a list of at most " + str(max_batch_search_size) + \
+               " integers (within the range of bigint) under the key 'cluster_ids'", 400
+
+    return pickle.dumps(utilities.search_clusters_in_db_by_cluster_ids(Backbone.read_database_config(), cluster_ids))
+
+
+@app.route('/match', methods=['POST'])
+@admitted_search
+def match_records():
+    """
+    This POST request function matches a few company records against the clusters that are
+    already in the database, without running the whole algorithm. The JSON body contains the
+    jurisdiction of the clusters and the records, e.g.:
+    {"jurisdiction": "no", "records": [{"legal_name": "...", "thoroughfare": "..."}],
+     "n_matches": 3, "threshold": 0.5}
+    ('n_matches' and 'threshold' are optional). The result is a list that has, for every
+    record, a list of dictionaries with the best matching 'cluster_id' values and their 'score'.
+    The model used is the one of the last run of the algorithm. For more info look into
+    the 'resident_matcher' module.
+    """
+    body = request.get_json(force=True, silent=True)
+
+    if not isinstance(body, dict) or not body.get('jurisdiction') or not isinstance(body.get('records'), list) \
+            or not all(isinstance(record, dict) for record in body['records']) \
+            or len(body['records']) > max_records_to_match:
+        return "The body must be a JSON object having a 'jurisdiction' and a list of at most " + \
+               str(max_records_to_match) + " records (JSON objects) under the key 'records'", 400
+
+    n_matches = default_nr_of_matches if body.get('n_matches') is None else body['n_matches']
+    threshold = default_match_threshold if body.get('threshold') is None else body['threshold']
+
+    if not isinstance(n_matches, int) or isinstance(n_matches, bool) or n_matches < 1:
+        return "The 'n_matches' of the body must be a positive integer", 400
+    if not isinstance(threshold, (int, float)) or isinstance(threshold, bool) or not 0 <= threshold <= 1:
+        return "The 'threshold' of the body must be a number between 0 and 1", 400
+
+    invalidate_in_memory_indexes_if_data_changed()
+
+    if not resident_matcher.is_model_available():
+        return "There is no trained model yet; run the algorithm first", 409
+
+    return pickle.dumps(resident_matcher.match(
+        Backbone.read_database_config(),
+        body['jurisdiction'],
+        body['records'],
+        n_matches,
+        float(threshold)))
+
+
+@app.route('/autocomplete/legal_name/<path:prefix>', methods=['GET'])
+@admitted_search
+def autocomplete_legal_name(prefix):
+    """
+    This GET request function returns the company names (and their cluster_ids) that start
+    with the given prefix. The names are served from an in-memory index, so the database
+    is not queried. The number of returned names can be given with the 'limit' query
+    parameter (e.g. '?limit=5'). For more info look into the 'autocomplete_index' module.
+
+    :param prefix: string object containing what the user typed so far
+    """
+    invalidate_in_memory_indexes_if_data_changed()
+
+    if not legal_name_autocomplete_index.is_built:
+        legal_name_autocomplete_index.build_if_needed(Backbone.read_database_config())
+
+    limit = min(request.args.get('limit', default_autocomplete_limit, type=int), max_autocomplete_limit)
+
+    return pickle.dumps(legal_name_autocomplete_index.complete(prefix, limit))
+
+
+@app.route('/status/startup', methods=['GET'])
+def startup_status():
+    """
+    This GET request function returns, as JSON, how long the server took to start: the import
+    time of every heavy module, the time needed to load the trained model and to index the
+    preloaded jurisdictions, the total start up time and the number of worker processes.
+    """
+    return jsonify(prefork.startup_report)
+
+
+@app.route('/status/admission', methods=['GET'])
+def admission_status():
+    """
+    This GET request function returns, as JSON, the limits of the jobs and of the searches and the numbers of
+    their requests that are running, waiting, were served and were rejected, in this server (worker) process
+    """
+    return jsonify(job=job_admission_limit.get_report(), search=search_admission_limit.get_report())
+
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """
+    This GET request function returns, in the Prometheus text format, the time spent in every stage
+    of the algorithm and in every database function, the rows processed, the statements sent and the
+    connections opened by the database functions and the number of jobs, since the server (worker) started
+    """
+    return Response(metrics.render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/sql_traces', methods=['GET'])
+def export_sql_traces():
+    """
+    This GET request function returns, as JSON, the traces of the SQL statements sent by the server
+    (worker) since it started: the totals of every statement shape (the slowest first), the last slow
+    statements, with their plans, and the last statements. The number of entries of every list can be
+    limited with the 'limit' query parameter (e.g. '?limit=20'). For more info look into the
+    'sql_tracing' module.
+    """
+    limit = request.args.get('limit', type=int)
+
+    return jsonify(sql_tracing.get_traces_report(max(limit, 1) if limit else None))
+
+
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_files():
     """
@@ -186,8 +732,9 @@ def upload_files():
                 flash('No selected file')
                 return redirect(request.url)
             if file:
+                # the file is kept in the upload store, under the hash of its content, and placed under its name
                 filename = secure_filename(file.filename)
-                file.save(filename)
+                upload_store.place_file(upload_store.add_file_from_stream(file.stream), filename)
 
         if len(files) > 1:
             return "All the files were uploaded successfully!"
@@ -204,6 +751,109 @@ def upload_files():
     '''
 
 
+def get_upload_session_response(session, status_code=200):
+    """
+    This function returns, as JSON, the state of the given upload session: its id, the name and size of the
+    file, the offset the client should continue from, the size of the chunks and whether it is completed
+    """
+    return jsonify(upload_id=session['upload_id'], file_name=session['file_name'], size=session['size'],
+                   offset=session['offset'], chunk_size=chunked_upload.DEFAULT_CHUNK_SIZE,
+                   completed=session['completed']), status_code
+
+
+def reject_upload_request(error):
+    """
+    This function returns the response to a request of an upload session that could not be served, with the
+    offset the client should continue from (if it is known)
+
+    :param error: ChunkedUploadError exception
+    """
+    return jsonify(message=str(error), offset=error.offset), error.status_code
+
+
+@app.route('/upload/sessions', methods=['POST'])
+def start_upload_session():
+    """
+    This POST request function starts the resumable upload of a large file, in chunks, or returns the
+    upload that was already started for the same file. The JSON body contains the name, the size and,
+    optionally, the SHA-256 checksum of the file, e.g. {"file_name": "file1.csv", "size": 1048576,
+    "checksum": "..."}. The response has the id of the upload and the offset from which the client has
+    to send the file. For more info look into the 'chunked_upload' module.
+    """
+    body = request.get_json(force=True, silent=True)
+
+    if not isinstance(body, dict):
+        return jsonify(message="The body must be a JSON object having a 'file_name' and a 'size'"), 400
+
+    try:
+        session = chunked_upload.start_session(body.get('file_name'), body.get('size'), body.get('checksum'))
+    except chunked_upload.ChunkedUploadError as e:
+        return reject_upload_request(e)
+
+    return get_upload_session_response(session, 200 if session['offset'] or session['completed'] else 201)
+
+
+@app.route('/upload/store', methods=['POST'])
+def place_stored_file():
+    """
+    This POST request function is called by the client before it uploads a file: the JSON body contains
+    the name of the file and the SHA-256 checksum of its content, e.g. {"file_name": "file1.csv",
+    "checksum": "..."}. If the server already has a file with that content in its upload store, the file
+    is placed under the given name, as if it was uploaded, and the client doesn't have to upload it
+    (200); otherwise the client has to upload the file (404). For more info look into the
+    'upload_store' module.
+    """
+    body = request.get_json(force=True, silent=True)
+
+    if not isinstance(body, dict) or not body.get('file_name') or not body.get('checksum'):
+        return jsonify(message="The body must be a JSON object having a 'file_name' and a 'checksum'"), 400
+
+    file_name = secure_filename(body['file_name'])
+
+    if not file_name or not upload_store.place_file(str(body['checksum']).lower(), file_name):
+        return jsonify(message='The file is not in the upload store', stored=False), 404
+
+    return jsonify(message='The file was taken from the upload store', stored=True, file_name=file_name)
+
+
+@app.route('/status/upload_store', methods=['GET'])
+def upload_store_status():
+    """
+    This GET request function returns, as JSON, the number of files and derived forms (e.g. parsed
+    datasets) in the upload store, their size and the disk budget of the store
+    """
+    return jsonify(upload_store.get_report())
+
+
+@app.route('/upload/sessions/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_chunk(upload_id):
+    """
+    This request function serves an upload started with '/upload/sessions': GET returns the offset from
+    which the client has to continue, PUT writes a chunk of the file and DELETE cancels the upload. The
+    body of a PUT request is the chunk itself; its offset in the file is given with the 'Upload-Offset'
+    header and its SHA-256 checksum with the 'Chunk-Checksum' header. The chunk is streamed to disk.
+
+    :param upload_id: string object containing the id of the upload
+    """
+    try:
+        if request.method == 'GET':
+            return get_upload_session_response(chunked_upload.read_session(upload_id))
+
+        if request.method == 'DELETE':
+            chunked_upload.remove_session(upload_id)
+            return jsonify(message='The upload was cancelled')
+
+        session = chunked_upload.write_chunk(upload_id,
+                                             request.headers.get('Upload-Offset', type=int),
+                                             request.content_length,
+                                             request.headers.get('Chunk-Checksum'),
+                                             request.stream)
+    except chunked_upload.ChunkedUploadError as e:
+        return reject_upload_request(e)
+
+    return get_upload_session_response(session)
+
+
 @app.route('/files/<filename>')
 def uploaded_file(filename):
     """
@@ -217,4 +867,37 @@ def uploaded_file(filename):
 
 
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0')
+    logging.getLogger().setLevel(logging.INFO)
+
+    loaded_data_version = get_data_version()
+
+    # build the in-memory indexes and load the model before serving requests, if we already know
+    # where the database is; in the pre-forked mode they are shared by all the workers
+    if os.path.isfile(Backbone.configuration_file_name):
+        try:
+            prefork.measure('autocomplete_index_seconds', legal_name_autocomplete_index.build,
+                            Backbone.read_database_config())
+        except Exception as e:
+            logging.warning('the autocomplete index will be built at the first request: {}'.format(e))
+
+    if resident_matcher.is_model_available():
+        prefork.measure('model_load_seconds', resident_matcher.load_model)
+
+        # comma separated list of jurisdictions (e.g. 'no,dk') whose clusters are indexed for the
+        # real-time matching before serving requests
+        for jurisdiction in filter(None, os.getenv('BACKBONE_PRELOAD_JURISDICTIONS', '').split(',')):
+            try:
+                prefork.measure(('jurisdictions_index_seconds', jurisdiction), resident_matcher.index_jurisdiction,
+                                Backbone.read_database_config(), jurisdiction.strip())
+            except Exception as e:
+                logging.warning('could not index jurisdiction {}: {}'.format(jurisdiction, e))
+
+    prefork.finish_startup()
+
+    nr_of_workers = int(os.getenv('BACKBONE_WORKERS', '1'))
+
+    if nr_of_workers > 1:
+        prefork.serve_with_prefork_workers(app, '0.0.0.0', 5000, nr_of_workers)
+    else:
+        # every request is served in its own thread, so the searches are served while a job runs
+        app.run(debug=False, host='0.0.0.0', threaded=True)
@@ -0,0 +1,258 @@
+"""
+Asynchronous serving of the read-only search endpoints.
+
+The searches by name and by address of 'api' run their queries with psycopg2 in the thread of the
+request, so every search in flight holds a thread (and a database connection) while it waits for the
+database, and the queries of the provider tables are sent one after the other. This module serves the
+same endpoints, with the same responses, from an asyncio event loop (aiohttp) with an asynchronous
+PostgreSQL driver (asyncpg): a search only holds a connection of a shared pool while one of its
+queries runs, the queries of all the provider tables are sent at the same time, each on its own
+connection of the pool, and thousands of searches can wait for the database in one process.
+
+It runs as a separate server, next to 'api', in the same working directory (it reads the database
+configuration from the configuration file given by the user):
+
+    python3 async_search_api.py
+
+The port and the pool are given with environment variables: BACKBONE_ASYNC_PORT (5001 by default),
+BACKBONE_ASYNC_POOL_MIN_SIZE and BACKBONE_ASYNC_POOL_MAX_SIZE (the number of connections of the pool),
+BACKBONE_ASYNC_POOL_TIMEOUT_SECONDS (how long a query waits for a free connection before the search is
+rejected with '429 Too Many Requests') and BACKBONE_ASYNC_QUERY_TIMEOUT_SECONDS (how long a query can run
+before the search fails with '504 Gateway Timeout').
+"""
+import os
+import time
+import pickle
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+import asyncpg
+
+from aiohttp import web
+
+from backbone import Backbone
+
+# the fields that can be searched, with the path of their endpoint
+SEARCH_PATHS = (('legal_name', '/search/company/legal_name/{value}'),
+                ('thoroughfare', '/search/company/thoroughfare/{value}'))
+
+# the fields of the rows that are meant to be used internally and are not sent to the client
+INTERNAL_FIELDS = ('company_id', 'cluster_id', 'link_score', 'row_hash')
+
+# the names of the provider tables are read again at most this often (in seconds), or as soon as
+# the algorithm loads new companies into the database
+TABLE_NAMES_MAX_AGE_SECONDS = 60
+
+# after how many seconds a rejected client should try again
+RETRY_AFTER_SECONDS = 1
+
+# the state of the server, kept in the aiohttp application
+POOL_KEY = 'pool'
+TABLE_NAMES_KEY = 'table_names'
+SEARCH_STATS_KEY = 'search_stats'
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection of the pool was freed within the pool timeout
+    """
+    pass
+
+
+def get_environment_number(variable_name, default_value, number_type=int):
+    return number_type(os.getenv(variable_name, default_value))
+
+
+def get_data_version():
+    """
+    This function returns the modification time of the data version file (touched by 'api' every time
+    the algorithm loaded new companies into the database), or None if it was never created
+    """
+    try:
+        return os.stat(Backbone.data_version_file_name).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+async def get_provider_table_names(app):
+    """
+    This function returns the names of the tables that contain datasets from providers (the ones
+    starting with 'bi_'), as 'utilities.get_all_table_names_from_schema' does for the 'public' schema.
+    The names are cached, until they are older than TABLE_NAMES_MAX_AGE_SECONDS or the data version changes.
+    """
+    cached_table_names = app[TABLE_NAMES_KEY]
+    data_version = get_data_version()
+
+    if cached_table_names['names'] is not None and cached_table_names['data_version'] == data_version and \
+            time.monotonic() - cached_table_names['read_at'] < TABLE_NAMES_MAX_AGE_SECONDS:
+        return cached_table_names['names']
+
+    rows = await fetch(app, "SELECT table_name FROM information_schema.tables "
+                            "WHERE table_schema = 'public' AND table_name LIKE 'bi\\_%'")
+
+    cached_table_names.update(names=sorted(row['table_name'] for row in rows),
+                              data_version=data_version,
+                              read_at=time.monotonic())
+
+    return cached_table_names['names']
+
+
+async def fetch(app, query, *arguments):
+    """
+    This function runs the given query on a connection of the pool and returns its rows. It waits for a
+    free connection for at most the pool timeout; if none is freed, 'PoolExhausted' is raised. If the query
+    runs longer than the query timeout, 'asyncio.TimeoutError' is raised.
+    """
+    pool = app[POOL_KEY]
+
+    try:
+        connection = await pool.acquire(timeout=app['pool_timeout_seconds'])
+    except asyncio.TimeoutError:
+        raise PoolExhausted()
+
+    try:
+        return await connection.fetch(query, *arguments)
+    finally:
+        await pool.release(connection)
+
+
+async def search_field_in_db_by_value(app, field, value):
+    """
+    This function does what 'utilities.search_field_in_db_by_value' does, with the queries of all the
+    provider tables sent at the same time: it searches all the provider tables for the rows whose 'field'
+    contains the 'value', then it searches the other tables for the rows that are in the same clusters as
+    the ones found (one query per table, for all the clusters), and it returns a dictionary where its keys
+    are the table names and the values are lists of rows, without the fields meant to be used internally.
+
+    Input: 'app' - the aiohttp application, which keeps the pool of connections
+           'field' - string object containing the field name
+           'value' - string object that contains the value that we want to find in that field
+    """
+    table_names = await get_provider_table_names(app)
+
+    # the names of the tables are the ones returned by the database, so they can be put in the query;
+    # the value is sent as a parameter
+    rows_of_tables = await asyncio.gather(*[
+        fetch(app, 'SELECT * FROM "{}" WHERE "{}" ILIKE \'%\' || $1 || \'%\''.format(table_name, field), value)
+        for table_name in table_names])
+
+    result = OrderedDict((table_name, [dict(row) for row in rows])
+                         for table_name, rows in zip(table_names, rows_of_tables) if rows)
+
+    # the rows of the other tables that are in the clusters of the rows found in a table
+    linked_table_names = []
+    linked_queries = []
+    for table_name in table_names:
+        cluster_ids = sorted({row['cluster_id'] for other_table_name, rows in result.items()
+                              if other_table_name != table_name for row in rows})
+        if cluster_ids:
+            linked_table_names.append(table_name)
+            linked_queries.append(fetch(app, 'SELECT * FROM "{}" WHERE cluster_id = ANY($1::bigint[])'.format(
+                table_name), cluster_ids))
+
+    for table_name, linked_rows in zip(linked_table_names, await asyncio.gather(*linked_queries)):
+        rows = result.setdefault(table_name, [])
+        found_company_ids = {row['company_id'] for row in rows}
+
+        rows.extend(dict(row) for row in linked_rows if row['company_id'] not in found_company_ids)
+
+    for rows in result.values():
+        for row in rows:
+            for internal_field in INTERNAL_FIELDS:
+                row.pop(internal_field, None)
+
+    return result
+
+
+def create_search_handler(field):
+    """
+    This function returns the handler of the GET requests that search the companies whose 'field'
+    contains the value given in the path. The response is the serialized (pickled) dictionary
+    returned by 'search_field_in_db_by_value', like the one of the same endpoint of 'api'.
+    """
+    async def search_handler(request):
+        search_stats = request.app[SEARCH_STATS_KEY]
+        search_stats['in_flight'] += 1
+        search_stats['max_in_flight'] = max(search_stats['max_in_flight'], search_stats['in_flight'])
+
+        try:
+            result = await search_field_in_db_by_value(request.app, field, request.match_info['value'])
+        except PoolExhausted:
+            search_stats['rejected'] += 1
+            return web.Response(status=429, text='Too many searches; try again in {} s'.format(RETRY_AFTER_SECONDS),
+                                headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+        except asyncio.TimeoutError:
+            # the query itself is too slow, so sending the search again would not help
+            search_stats['timed_out'] += 1
+            return web.Response(status=504, text='The search took too long')
+        finally:
+            search_stats['in_flight'] -= 1
+
+        search_stats['served'] += 1
+
+        return web.Response(body=pickle.dumps(result), content_type='application/octet-stream')
+
+    return search_handler
+
+
+async def get_status(request):
+    """
+    This GET request function returns, as JSON, the number of searches served, rejected, timed out and in flight
+    and the state of the pool of connections
+    """
+    pool = request.app[POOL_KEY]
+
+    return web.json_response(OrderedDict([('searches', request.app[SEARCH_STATS_KEY]),
+                                          ('pool', OrderedDict([('min_size', pool.get_min_size()),
+                                                                ('max_size', pool.get_max_size()),
+                                                                ('size', pool.get_size()),
+                                                                ('idle', pool.get_idle_size())]))]))
+
+
+async def open_pool(app):
+    database_config = Backbone.read_database_config()
+
+    app[POOL_KEY] = await asyncpg.create_pool(
+        database=database_config['database_name'],
+        user=database_config['username'],
+        password=database_config['password'],
+        host=database_config['host'],
+        port=int(database_config['port']),
+        min_size=get_environment_number('BACKBONE_ASYNC_POOL_MIN_SIZE', 2),
+        max_size=get_environment_number('BACKBONE_ASYNC_POOL_MAX_SIZE', 20),
+        command_timeout=get_environment_number('BACKBONE_ASYNC_QUERY_TIMEOUT_SECONDS', 30, float))
+
+
+async def close_pool(app):
+    await app[POOL_KEY].close()
+
+
+def create_app():
+    """
+    This function creates the aiohttp application that serves the searches; its pool of connections
+    is opened when the server starts and closed when it stops
+    """
+    app = web.Application()
+
+    app['pool_timeout_seconds'] = get_environment_number('BACKBONE_ASYNC_POOL_TIMEOUT_SECONDS', 10, float)
+    app[TABLE_NAMES_KEY] = {'names': None, 'data_version': None, 'read_at': 0}
+    app[SEARCH_STATS_KEY] = OrderedDict([('served', 0), ('rejected', 0), ('timed_out', 0), ('in_flight', 0),
+                                            ('max_in_flight', 0)])
+
+    for field, path in SEARCH_PATHS:
+        app.router.add_get(path, create_search_handler(field))
+    app.router.add_get('/status/async_search', get_status)
+
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+
+    return app
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    web.run_app(create_app(), host='0.0.0.0', port=get_environment_number('BACKBONE_ASYNC_PORT', 5001),
+                backlog=4096)
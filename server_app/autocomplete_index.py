@@ -0,0 +1,126 @@
+import bisect
+import logging
+import threading
+
+from array import array
+
+import utilities
+
+
+class AutocompleteIndex:
+    """
+    In-memory index used for type-ahead (prefix) searches on a field of the provider tables.
+    It is made of three parallel arrays, sorted by the normalized values: the normalized
+    values, the original values (the ones shown to the user) and the cluster_ids. A prefix
+    search is a binary search in the sorted array of normalized values, so it does not
+    touch the database. The values are normalized with the same rules the matching
+    algorithm uses, i.e., "Ørsted AS" can be found by typing "orst".
+
+    The index is built from all the 'bi_' tables and it has to be rebuilt every time a
+    provider table was (re)created. While it is rebuilt, the old arrays keep serving the
+    requests; the new ones replace them at once, when they are ready.
+    """
+
+    def __init__(self, field):
+        """
+        Constructor
+
+        :param field: string object containing the name of the field that is indexed
+        """
+        self.field = field
+
+        # tuple made of the 3 parallel arrays; it is always replaced as a whole, so a reader
+        # never sees arrays that belong to different builds
+        self.__entries = ([], [], array('q'))
+
+        self.__build_lock = threading.Lock()
+        self.is_built = False
+
+    def __len__(self):
+        return len(self.__entries[0])
+
+    def build(self, info_db):
+        """
+        Reads the values of the field, together with their cluster_ids, from all the provider
+        tables and replaces the current arrays with new ones.
+
+        :param info_db: dictionary containing the database parameters needed for creating
+                        a connection; the dictionary is the one given in the configuration file
+        """
+        with self.__build_lock:
+            self.__build(info_db)
+
+    def build_if_needed(self, info_db):
+        """
+        Builds the index if it was not built before, e.g., because the database was not
+        reachable when the server started.
+
+        :param info_db: dictionary containing the database parameters needed for creating
+                        a connection; the dictionary is the one given in the configuration file
+        """
+        if self.is_built:
+            return
+
+        with self.__build_lock:
+            # another request could have built the index while this one was waiting for the lock
+            if not self.is_built:
+                self.__build(info_db)
+
+    def __build(self, info_db):
+        """
+        Builds the new arrays and swaps them with the current ones. A value that appears
+        more than once in the same cluster is kept only once. It must be called while
+        holding the build lock.
+
+        :param info_db: dictionary containing the database parameters needed for creating
+                        a connection; the dictionary is the one given in the configuration file
+        """
+        entries = {}
+        for value, cluster_id in utilities.get_values_of_field_and_cluster_ids_from_all_tables(info_db, self.field):
+            normalized_value = utilities.normalize_value(value)
+
+            if normalized_value:
+                entries.setdefault((normalized_value, cluster_id), value)
+
+        sorted_keys = sorted(entries)
+
+        normalized_values = [normalized_value for normalized_value, cluster_id in sorted_keys]
+        values = [entries[key] for key in sorted_keys]
+        cluster_ids = array('q', [cluster_id for normalized_value, cluster_id in sorted_keys])
+
+        self.__entries = (normalized_values, values, cluster_ids)
+        self.is_built = True
+
+        logging.info('autocomplete index for {} built with {} values'.format(self.field, len(sorted_keys)))
+
+    def invalidate(self):
+        """
+        Marks the index as outdated, so that it is rebuilt at the next request. Until then,
+        the current arrays keep serving the requests.
+        """
+        self.is_built = False
+
+    def complete(self, prefix, limit):
+        """
+        Returns a list with at most 'limit' dictionaries, having as keys the name of the
+        field and 'cluster_id', for the values that start with the given prefix (after both of them
+        were normalized), in alphabetical order.
+
+        :param prefix: string object containing what the user typed so far
+        :param limit: maximum number of values that are returned
+        """
+        normalized_values, values, cluster_ids = self.__entries
+
+        normalized_prefix = utilities.normalize_value(prefix)
+        if not normalized_prefix:
+            return []
+
+        result = []
+
+        idx = bisect.bisect_left(normalized_values, normalized_prefix)
+        while idx < len(normalized_values) and len(result) < limit and \
+                normalized_values[idx].startswith(normalized_prefix):
+            result.append({self.field: values[idx], 'cluster_id': cluster_ids[idx]})
+            idx += 1
+
+        return result
@@ -1,6 +1,13 @@
+import os
+import csv
+import logging
+import itertools
+import multiprocessing
+import metrics
 import utilities
+import compressed_files
+import memory_budget
 import simplejson as json
-import pandas as pd
 import pickle
 
 from werkzeug.utils import secure_filename
@@ -25,8 +32,34 @@ class Backbone:
     # if the user creates the training file, that file will be named like it's written on the next line
     training_file_name_created_by_client = 'training_file.json'
 
+    # copy of the settings file (the trained model) of the last run of the algorithm; it is kept
+    # after the run, because it is used for matching single records in real time
+    resident_model_settings_file_name = 'resident_model_settings_file'
+
+    # file that is touched every time the algorithm loaded new companies into the database;
+    # the server processes use its modification time to know when their in-memory indexes are outdated
+    data_version_file_name = 'data_version'
+
+    # prefix of the file that contains only the new and the changed rows of the 1st input dataset, when
+    # its provider sent the dataset again (read more about this in 'create_delta_of_first_input_dataset')
+    delta_file_1_prefix = 'delta_'
+
+    # prefix of the files (datasets and configuration files for Dedupe) of a partition of the run,
+    # when the 1st input dataset is partitioned by jurisdiction; it is followed by the index of the partition
+    partition_file_prefix = 'partition_'
+
+    # prefix of the files that keep, on disk, the data of the run that would not fit in the memory budget
+    spill_file_prefix = 'spill_'
+
     def __init__(self):
+        self.partitions = []
+        self.is_delta_used = False
+        self.full_input_file_1 = None
+        self.removed_row_hashes = None
+        self.spilled_maps = []
+        self.notebook_namespace = {}
         self.__set_data_from_config_file()
+        self.memory_budget = memory_budget.MemoryBudget.from_config(self.data_from_config_file.get('memory_budget'))
         self.__set_input_file_1_name()
         self.__set_input_file_2_name()
         self.__set_training_file_name()
@@ -37,6 +70,24 @@ class Backbone:
         self.__set_output_file_1_name()
         self.__set_output_file_2_name()
 
+    @classmethod
+    def read_configuration_file(cls):
+        """
+        Reads the configuration file given by the user. Unlike the constructor, it doesn't
+        create Dedupe's configuration file and doesn't query the database
+        """
+        with open(cls.configuration_file_name, 'r') as config_file:
+            return json.load(config_file)
+
+    @classmethod
+    def read_database_config(cls):
+        """
+        Reads only the database configuration from the configuration file given by the user.
+        Unlike the constructor, it doesn't create Dedupe's configuration file and doesn't query
+        the database, so it is cheap enough to be called for every search request
+        """
+        return cls.read_configuration_file()['database_config']
+
     def __set_jupyter_notebook_data(self):
         """
         Reads the JSON file where the Dedupe algorithm is located, and stores it in an instance variable
@@ -63,13 +114,13 @@ class Backbone:
         """
         Set the name of the 2nd input dataset that will be passed to Dedupe: 
         if the name is not correctly given in the configuration file, i.e., 
-        it is null or it's not a '.csv' file, the second dataset the will be given 
+        it is null or it's not a '.csv' file (compressed or not, e.g. '.csv.gz' or
+        '.csv.zst'), the second dataset the will be given 
         to Dedupe will be a temporary file, that will contain rows extracted by 
         the given 'jurisdiction', from the tables that are currently in the database
         """
         if self.data_from_config_file.get('input_file_2') and \
-                self.data_from_config_file.get('input_file_2').find(".csv") == len(
-            self.data_from_config_file.get('input_file_2')) - 4:
+                compressed_files.is_csv_file_name(self.data_from_config_file.get('input_file_2')):
 
             self.input_file_2 = secure_filename(self.data_from_config_file.get('input_file_2'))
         else:
@@ -100,8 +151,9 @@ class Backbone:
         """
         Set the name of the first output file, i.e., the one that is created from the first input dataset
         The names of the output files are just the name of the input files having 'output_' as prefix
+        (without the compression suffix, since the output files are not compressed)
         """
-        self.output_file_1 = "output_" + self.input_file_1
+        self.output_file_1 = "output_" + compressed_files.strip_compression_suffix(self.input_file_1)
 
     def __set_output_file_2_name(self):
         """
@@ -109,8 +161,8 @@ class Backbone:
         If the user didn't give a name for the 2nd input file, then the 2nd output file name will be
         the concatenation of 'output_' with the name of the temporary file that will be created
         """
-        self.output_file_2 = "output_" + self.data_from_config_file[
-            'input_file_2'] if not self.is_tmp_file_used() else "output_" + self.tmp_file_2_name
+        self.output_file_2 = "output_" + compressed_files.strip_compression_suffix(self.data_from_config_file[
+            'input_file_2']) if not self.is_tmp_file_used() else "output_" + self.tmp_file_2_name
 
     def __set_last_cluster_id_in_db(self):
         """
@@ -150,8 +202,12 @@ class Backbone:
         self.config_data_for_dedupe['training']['settings_file'] = self.settings_file_name
         self.config_data_for_dedupe['last_cluster_id'] = self.last_cluster_id_in_db
 
-        print(self.config_data_for_dedupe)
-        
+        # the rows resulted from Dedupe are streamed directly into the database, so Dedupe doesn't need
+        # to write the output files (if the user wants them, they are written while the rows are streamed)
+        self.config_data_for_dedupe['export_output_files'] = False
+
+        logging.debug('configuration for Dedupe: {}'.format(self.config_data_for_dedupe))
+
         # write Dedupe's configuration file that we've made to a JSON file 
         with open(self.configuration_file_name_for_dedupe, "w") as config_file_for_dedupe:
             json.dump(self.config_data_for_dedupe, config_file_for_dedupe)
@@ -162,50 +218,25 @@ class Backbone:
         from providers and extracts all the rows that have the given 'jurisdiction'.
         Then, it merges all the extracted rows into a single table, keeping only the
         fields that are common across the resulted rows. After this table is created
-        all of its content is written in a csv file
+        all of its content is written in a csv file. If the rows would not fit in the memory
+        budget, they are streamed from the database directly into the csv file.
         """
+        database_config = self.data_from_config_file['database_config']
 
-        info_db = self.data_from_config_file['database_config']
-
-        # get the names of all the tables that contain datasets from different providers   
-        table_names = utilities.get_all_table_names_from_schema(info_db, 'public')
-
-        # list of dataframes; each dataframe is composed of all the rows that are extracted 
-        # from a table with the SELECT query (they are extracted based on their jurisdiction)
-        list_of_dataframes_resulted_from_select_query = []
-        for table_name in table_names:
-            df = utilities.extract_rows_by_jurisdiction_from_table_and_return_as_df(info_db, table_name, repr(
-                self.data_from_config_file['jurisdiction']))
-
-            list_of_dataframes_resulted_from_select_query.append(df)
-
-        column_names_of_each_dataframe = []
-        for df in list_of_dataframes_resulted_from_select_query:
-            column_names_of_each_dataframe.append(set(df.columns.values))
-
-        # we'll keep only the common columns of the rows previously extracted from the tables
-        common_columns_across_dataframes = set.intersection(*column_names_of_each_dataframe)
+        if self.memory_budget.should_spill(
+                'extraction',
+                lambda: utilities.get_size_of_provider_tables(database_config) *
+                memory_budget.DATAFRAME_BYTES_PER_TABLE_BYTE):
+            jurisdiction = self.data_from_config_file['jurisdiction']
 
-        # new list of dataframes, where each dataframe was reduced to only having the common columns
-        list_of_dataframes_resulted_from_select_query_with_common_fields = []
-        for df in list_of_dataframes_resulted_from_select_query:
-            df = df[list(common_columns_across_dataframes)]
-            list_of_dataframes_resulted_from_select_query_with_common_fields.append(df)
+            utilities.extract_one_row_per_cluster_by_jurisdictions_and_write_to_csv_files(
+                database_config, {jurisdiction: self.tmp_file_2_name}, self.memory_budget.chunk_size)
 
-        # merge/concatenate all dataframes that we have so far into a big one 
-        big_df = pd.concat(list_of_dataframes_resulted_from_select_query_with_common_fields, axis=0).reset_index(
-            drop=True)
+            return
 
-        # shuffle (rearrange in random order) the examples from the dataframe
-        big_df = big_df.sample(frac=1).reset_index(drop=True)
-
-        # Keep only one example from a cluster. This is neccessary because our Dedupe
-        # algorithm makes one-to-one matches between the two input files, i.e., the clusters
-        # that Dedupe creates contain maximum 2 elements, where one element is from input file 1
-        # and the other is from input file 2. If we would have two or more examples from the same
-        # cluster in this file, at most one would get matched and the remaining ones will be put
-        # in their own clusters and later on inserted into the database AGAIN.
-        big_df.drop_duplicates(subset=['cluster_id'], inplace=True)
+        big_df = utilities.extract_one_row_per_cluster_by_jurisdiction_and_return_as_df(
+            self.data_from_config_file['database_config'],
+            self.data_from_config_file['jurisdiction'])
 
         # rename the 'cluster_id' column to 'cluster_id_from_db', so that
         # when Dedupe creates the output file and adds  the columns 'cluster_id'
@@ -215,6 +246,295 @@ class Backbone:
         # write this big table to a csv file that dedupe will use as the 2nd input file
         big_df.to_csv(self.tmp_file_2_name, index=False)
 
+    def is_partitioned_by_jurisdiction(self):
+        """
+        Function which returns True if the 1st input dataset has to be partitioned by jurisdiction
+        and the partitions have to be matched in parallel, i.e., the user has not provided a second
+        input dataset and the 'jurisdiction' parameter from the configuration file is a list of
+        jurisdictions or '*' (all the jurisdictions found in the 1st input dataset)
+        """
+        jurisdiction = self.data_from_config_file.get('jurisdiction')
+
+        return self.is_tmp_file_used() and (isinstance(jurisdiction, list) or jurisdiction == '*')
+
+    def __create_partitions_of_first_input_dataset(self):
+        """
+        This function splits the 1st input dataset by the values of its 'jurisdiction' column and
+        writes each part into its own file. It sets 'partitions' to a list of dictionaries (one per
+        jurisdiction) having the keys: 'jurisdiction', 'input_file_1', 'input_file_2', 'configuration_file',
+        'nr_of_rows' and 'cluster_ids_from_db' (set after the partition was matched).
+        """
+        jurisdictions = self.data_from_config_file['jurisdiction']
+
+        # dictionary where the keys are jurisdictions and the values are tuples made of
+        # the csv writer of the partition and the partition
+        partition_writers = {}
+        partition_files = []
+
+        with compressed_files.open_input_file(self.input_file_1) as input_file:
+            reader = csv.reader(input_file)
+            heading_row = next(reader)
+
+            if 'jurisdiction' not in heading_row:
+                raise ValueError("The 1st input dataset doesn't have a 'jurisdiction' column")
+
+            idx_jurisdiction = heading_row.index('jurisdiction')
+
+            try:
+                for row in reader:
+                    jurisdiction = row[idx_jurisdiction]
+
+                    if jurisdiction not in partition_writers:
+                        if jurisdictions != '*' and jurisdiction not in jurisdictions:
+                            raise ValueError("The 1st input dataset has rows from the jurisdiction '{}', "
+                                             "which is not in the configuration file".format(jurisdiction))
+
+                        prefix = self.partition_file_prefix + str(len(self.partitions)) + '_'
+                        partition_file_name = prefix + compressed_files.strip_compression_suffix(self.input_file_1)
+
+                        partition_file = open(partition_file_name, 'w')
+                        partition_files.append(partition_file)
+
+                        partition = {'jurisdiction': jurisdiction,
+                                     'input_file_1': partition_file_name,
+                                     'input_file_2': prefix + self.tmp_file_2_name,
+                                     'configuration_file': prefix + self.configuration_file_name_for_dedupe,
+                                     'nr_of_rows': 0,
+                                     'cluster_ids_from_db': None}
+                        self.partitions.append(partition)
+
+                        partition_writers[jurisdiction] = (csv.writer(partition_file), partition)
+                        partition_writers[jurisdiction][0].writerow(heading_row)
+
+                    writer, partition = partition_writers[jurisdiction]
+                    writer.writerow(row)
+                    partition['nr_of_rows'] += 1
+            finally:
+                for partition_file in partition_files:
+                    partition_file.close()
+
+    def match_partitions_in_parallel(self):
+        """
+        This function partitions the 1st input dataset by jurisdiction, extracts from the database,
+        in one pass, the rows of all these jurisdictions (each jurisdiction becomes the 2nd input dataset
+        of its partition) and then matches the partitions in parallel, on a pool of processes.
+        If the user didn't give a settings file, the model is first trained on the biggest partition,
+        so that all the partitions use the same model.
+        Each partition is matched with its own configuration file for Dedupe and the cluster_ids that
+        Dedupe gives inside a partition are only used for finding the rows of the 1st input dataset
+        that were matched with rows from the database; the final cluster_ids are given when the rows
+        are generated (read more about this in 'generate_output_rows_of_partitions').
+        """
+        with metrics.stage('extraction'):
+            self.__create_partitions_of_first_input_dataset()
+
+            database_config = self.data_from_config_file['database_config']
+
+            # a partition can only be matched if there are rows of its jurisdiction in the database
+            partitions_to_match = []
+
+            if self.memory_budget.should_spill(
+                    'extraction',
+                    lambda: utilities.get_size_of_provider_tables(database_config) *
+                    memory_budget.DATAFRAME_BYTES_PER_TABLE_BYTE):
+                # the rows are streamed from the database directly into the files of the partitions
+                file_names_by_jurisdiction = dict((partition['jurisdiction'], partition['input_file_2'])
+                                                  for partition in self.partitions)
+
+                nr_of_rows_by_jurisdiction = \
+                    utilities.extract_one_row_per_cluster_by_jurisdictions_and_write_to_csv_files(
+                        database_config, file_names_by_jurisdiction, self.memory_budget.chunk_size)
+
+                for partition in self.partitions:
+                    if nr_of_rows_by_jurisdiction[partition['jurisdiction']]:
+                        partitions_to_match.append(partition)
+            else:
+                dfs = utilities.extract_one_row_per_cluster_by_jurisdictions_and_return_as_dfs(
+                    database_config,
+                    [partition['jurisdiction'] for partition in self.partitions])
+
+                for partition in self.partitions:
+                    df = dfs[partition['jurisdiction']]
+
+                    if len(df.index) == 0:
+                        continue
+
+                    # read more about renaming these columns in 'extract_data_from_db_and_create_second_input_dataset'
+                    df = df.rename(columns={'cluster_id': 'cluster_id_from_db', 'link_score': 'link_score_from_db'})
+                    df.to_csv(partition['input_file_2'], index=False)
+
+                    partitions_to_match.append(partition)
+
+        if not partitions_to_match:
+            return
+
+        settings_file_name = self.settings_file_name
+        if not settings_file_name:
+            # train the model on the biggest partition; the notebook writes it in the 'settings_file' file
+            biggest_partition = max(partitions_to_match, key=lambda p: p['nr_of_rows'])
+            self.__create_partition_configuration_file(biggest_partition, settings_file_name=None)
+
+            # only the cells up to the end of the training are executed
+            idx_last_cell = get_idx_of_cell_after_stage(self.jupyter_notebook_data["cells"], 'training')
+            match_partition((self.jupyter_notebook_data, biggest_partition['configuration_file'], idx_last_cell))
+
+            settings_file_name = 'settings_file'
+
+        for partition in partitions_to_match:
+            self.__create_partition_configuration_file(partition, settings_file_name)
+
+        nr_of_processes = self.data_from_config_file.get('nr_of_parallel_partitions') or multiprocessing.cpu_count()
+
+        logging.info('matching {} partitions on {} processes'.format(len(partitions_to_match), nr_of_processes))
+
+        # the stages of the partitions run in the processes of the pool, so only their total time is measured
+        pool = multiprocessing.Pool(processes=min(nr_of_processes, len(partitions_to_match)))
+        try:
+            with metrics.stage('match_partitions'):
+                results = pool.map(match_partition,
+                                   [(self.jupyter_notebook_data, partition['configuration_file'], None)
+                                    for partition in partitions_to_match])
+        finally:
+            pool.close()
+            pool.join()
+
+        for partition, cluster_ids_from_db in zip(partitions_to_match, results):
+            partition['cluster_ids_from_db'] = cluster_ids_from_db
+
+    def __create_partition_configuration_file(self, partition, settings_file_name):
+        """
+        This function creates the configuration file that Dedupe uses for matching the given partition.
+        It is a copy of Dedupe's configuration file of the run, having the datasets of the partition
+        as input datasets and the given settings file. Each partition uses only one core, since
+        the partitions are matched in parallel.
+
+        :param partition: dictionary, one of the elements of 'partitions'
+        :param settings_file_name: string object containing the name of the settings file, or None
+        """
+        config_data_for_partition = json.loads(json.dumps(self.config_data_for_dedupe))
+
+        config_data_for_partition['input_file_1'] = partition['input_file_1']
+        config_data_for_partition['input_file_2'] = partition['input_file_2']
+        config_data_for_partition['training']['settings_file'] = settings_file_name
+        config_data_for_partition['last_cluster_id'] = 0
+        config_data_for_partition['nr_of_cores'] = 1
+
+        with open(partition['configuration_file'], "w") as config_file_for_partition:
+            json.dump(config_data_for_partition, config_file_for_partition)
+
+    def generate_output_rows_of_partitions(self):
+        """
+        This function is a generator of the rows resulted from Dedupe for all the partitions of the
+        1st input dataset: the heading row, followed by the rows of all the partitions, each having the
+        'cluster_id' and 'link_score' columns in front. A row that was matched with a row from the
+        database gets the cluster_id of that row, while the other rows get new cluster_ids, which follow
+        the last cluster_id from the database. It can only be called after the partitions were matched.
+        """
+        next_cluster_id = self.last_cluster_id_in_db + 1
+        is_heading_row_given = False
+
+        for partition in self.partitions:
+            cluster_ids_from_db = partition['cluster_ids_from_db'] or [(None, None)] * partition['nr_of_rows']
+
+            with open(partition['input_file_1']) as partition_file:
+                reader = csv.reader(partition_file)
+                heading_row = next(reader)
+
+                if not is_heading_row_given:
+                    is_heading_row_given = True
+                    yield ['cluster_id', 'link_score'] + heading_row
+
+                for row, (cluster_id, score) in zip(reader, cluster_ids_from_db):
+                    if cluster_id is None:
+                        cluster_id = next_cluster_id
+                        next_cluster_id += 1
+
+                    yield [cluster_id, score] + row
+
+    def get_nr_of_rows_without_cluster_in_partitions(self):
+        """
+        This function returns how many rows of the 1st input dataset were not matched with rows
+        from the database, in all the partitions, i.e., how many new cluster_ids are needed
+        """
+        nr_of_rows = 0
+        for partition in self.partitions:
+            if partition['cluster_ids_from_db'] is None:
+                nr_of_rows += partition['nr_of_rows']
+            else:
+                nr_of_rows += sum(1 for cluster_id, score in partition['cluster_ids_from_db'] if cluster_id is None)
+
+        return nr_of_rows
+
+    def remove_partition_files(self):
+        """
+        This function removes the files created for the partitions of the run
+        """
+        for partition in self.partitions:
+            for file_name in (partition['input_file_1'], partition['input_file_2'], partition['configuration_file']):
+                if os.path.isfile(file_name):
+                    os.remove(file_name)
+
+    def create_delta_of_first_input_dataset(self):
+        """
+        This function is used when the provider of the 1st input dataset sent its dataset again,
+        i.e., its table already exists in the database. It compares the hashes of the rows of the
+        dataset with the ones of the rows from the table and writes only the new and the changed rows
+        into a new file, which becomes the 1st input dataset given to Dedupe. The rows that did not
+        change keep their cluster_id and link_score from the table, and the hashes of the rows that
+        are no longer in the dataset are kept in 'removed_row_hashes', so that those rows can be deleted.
+        If the table doesn't exist (or it doesn't have the same columns as the dataset), nothing changes
+        and the whole dataset is given to Dedupe.
+        """
+        with compressed_files.open_input_file(self.input_file_1) as input_file:
+            reader = csv.reader(input_file)
+            heading_row = next(reader)
+
+            row_hashes_in_db = utilities.get_row_hashes_of_provider_table(
+                self.data_from_config_file['database_config'],
+                self.data_from_config_file['provider_1_name'],
+                heading_row)
+
+            if row_hashes_in_db is None:
+                return
+
+            self.full_input_file_1 = self.input_file_1
+            self.input_file_1 = self.delta_file_1_prefix + compressed_files.strip_compression_suffix(
+                self.full_input_file_1)
+            self.nr_of_unchanged_rows = 0
+            self.nr_of_delta_rows = 0
+
+            with open(self.input_file_1, 'w') as delta_file:
+                writer = csv.writer(delta_file)
+                writer.writerow(heading_row)
+
+                for row in reader:
+                    row_hash = utilities.get_row_hash(row)
+
+                    if row_hashes_in_db[row_hash] > 0:
+                        row_hashes_in_db[row_hash] -= 1
+                        self.nr_of_unchanged_rows += 1
+                    else:
+                        writer.writerow(row)
+                        self.nr_of_delta_rows += 1
+
+        # what remained in the Counter are the rows that were removed or changed
+        self.removed_row_hashes = +row_hashes_in_db
+        self.is_delta_used = True
+
+        # Dedupe has to read the new file
+        self.__set_output_file_1_name()
+        self.__create_dedupe_configuration_file()
+
+        logging.info('{} unchanged rows, {} new or changed rows, {} removed or changed rows'.format(
+            self.nr_of_unchanged_rows, self.nr_of_delta_rows, sum(self.removed_row_hashes.values())))
+
+    def has_rows_to_match(self):
+        """
+        This function returns False if the provider sent again a dataset that has no new or changed
+        rows, so Dedupe doesn't have to be run, and True otherwise
+        """
+        return not self.is_delta_used or self.nr_of_delta_rows > 0
+
     def execute_jupyter_notebook_cells(self, idx_first_cell, idx_last_cell=None):
         """
         This function executes cells of the Jupyter notebook where the Dedupe algorithm is.
@@ -230,14 +550,92 @@ class Backbone:
             last_cell_to_execute = len(self.jupyter_notebook_data["cells"])
         else:
             last_cell_to_execute = idx_last_cell
-        # execute each cell from the notebook
-        for idx_cell in range(idx_first_cell, last_cell_to_execute):
-            # get all (L)ines (O)f (C)ode from the current cell, merge them all 
-            # into a long LOC and execute it
-            # N.B.: every LOC is terminated with a new line character '\n' --> 
-            # concatenating them won't produce an error
-            result = self.jupyter_notebook_data["cells"][idx_cell]["source"]
-            exec(''.join(result), locals())
+
+        # the variables and functions defined by the cells are kept in this dictionary, so that
+        # the results of the algorithm can be used after the cells were executed
+        self.notebook_namespace = {}
+
+        execute_code_cells(self.jupyter_notebook_data["cells"][idx_first_cell:last_cell_to_execute],
+                           self.notebook_namespace)
+
+    def generate_output_rows(self, input_file_number):
+        """
+        This function returns a generator of the rows resulted from Dedupe for the 1st or
+        the 2nd input dataset: the heading row, followed by the rows of the input dataset,
+        each having the 'cluster_id' and 'link_score' columns in front. Every call returns
+        a new generator, which gives the same rows. It can only be called after all the
+        cells of the Jupyter notebook were executed.
+
+        :param input_file_number: int data type, 1 or 2
+        """
+        if input_file_number == 1:
+            return self.notebook_namespace['generate_output_rows'](self.input_file_1,
+                                                                   self.notebook_namespace['first_unique_id_1'])
+
+        return self.notebook_namespace['generate_output_rows'](self.input_file_2,
+                                                               self.notebook_namespace['first_unique_id_2'])
+
+    def get_nr_of_rows_without_cluster_in_first_dataset(self):
+        """
+        This function returns how many examples from the 1st input dataset were not matched with
+        examples from the 2nd dataset, i.e., how many examples were put in their own cluster
+        """
+        return self.notebook_namespace['first_unique_id_2'] - self.notebook_namespace['first_unique_id_1']
+
+    def get_last_cluster_id_given_by_dedupe(self):
+        """
+        This function returns the last (maximum) cluster_id that Dedupe gave to an example
+        from the two input datasets
+        """
+        return self.notebook_namespace['next_unique_id'] - 1
+
+    def create_spilled_map_of_cluster_ids_given_by_dedupe(self):
+        """
+        This function returns a SpilledIntKeyMap (a map kept in a file mapped in memory) whose keys can
+        be all the cluster_ids that Dedupe gave in the run and whose values are integers. It is used
+        instead of a dictionary when the memory budget would be exceeded, and its file is removed by
+        'remove_spill_files'. It can only be called after all the cells of the Jupyter notebook were executed.
+        """
+        first_cluster_id = self.last_cluster_id_in_db + 1
+
+        spilled_map = memory_budget.SpilledIntKeyMap(
+            first_cluster_id,
+            self.get_last_cluster_id_given_by_dedupe() - first_cluster_id + 1,
+            ['int64'],
+            self.spill_file_prefix + 'cluster_ids_given_by_dedupe_{}.bin'.format(len(self.spilled_maps)))
+        self.spilled_maps.append(spilled_map)
+
+        return spilled_map
+
+    def get_memory_budget_report(self):
+        """
+        This function returns the report of the memory budget of the run: which stages were switched
+        to their spill-to-disk mode, including the ones from the Jupyter notebook
+        """
+        report = self.memory_budget.report
+
+        notebook_memory_budget = self.notebook_namespace.get('memory_guard')
+        if notebook_memory_budget is not None:
+            report['stages'].update(notebook_memory_budget.report['stages'])
+
+        return report
+
+    def remove_spill_files(self):
+        """
+        This function removes the files that kept, on disk, the data that would not fit in the memory budget
+        """
+        for spilled_map in self.spilled_maps:
+            spilled_map.close()
+        self.spilled_maps = []
+
+        close_spilled_cluster_membership(self.notebook_namespace)
+
+    def is_output_export_requested(self):
+        """
+        This function returns True if the user wants to keep the output files, i.e., the
+        'export_output_files' parameter from the configuration file is true
+        """
+        return bool(self.data_from_config_file.get('export_output_files'))
 
     def search_field_in_db_by_value_and_return_serialized_result(self, field, value):
         """
@@ -249,3 +647,100 @@ class Backbone:
         """
         return pickle.dumps(
             utilities.search_field_in_db_by_value(self.data_from_config_file['database_config'], field, value))
+
+
+def execute_code_cells(cells, notebook_namespace):
+    """
+    This function executes the code cells of the Jupyter notebook from the given list, in the given
+    namespace; the markdown cells only document the algorithm. Every cell has, in its metadata, the
+    stage of the algorithm it belongs to ('backbone_stage'), and the consecutive cells of a stage are
+    timed together (read more about this in the 'metrics' module).
+
+    :param cells: list of the cells of the Jupyter notebook
+    :param notebook_namespace: dictionary where the variables and functions defined by the cells are kept
+    """
+    code_cells = [cell for cell in cells if cell["cell_type"] == "code"]
+
+    for stage_name, cells_of_stage in itertools.groupby(
+            code_cells, key=lambda cell: cell.get("metadata", {}).get("backbone_stage", "notebook")):
+        with metrics.stage(stage_name):
+            for cell in cells_of_stage:
+                # get all (L)ines (O)f (C)ode from the current cell, merge them all
+                # into a long LOC and execute it
+                # N.B.: every LOC is terminated with a new line character '\n' -->
+                # concatenating them won't produce an error
+                exec(''.join(cell["source"]), notebook_namespace)
+
+
+def get_idx_of_cell_after_stage(cells, stage_name):
+    """
+    This function returns the index of the cell that comes after the last cell of the given stage of the
+    algorithm ('backbone_stage' in the metadata of the cell), so that executing the cells before that index
+    executes the whole stage and the stages before it
+
+    :param cells: list of the cells of the Jupyter notebook
+    :param stage_name: string object containing the name of the stage, e.g. 'training'
+    """
+    idx_cells_of_stage = [idx for idx, cell in enumerate(cells)
+                          if cell.get("metadata", {}).get("backbone_stage") == stage_name]
+
+    if not idx_cells_of_stage:
+        raise ValueError("The Jupyter notebook has no cells of the stage '{}'".format(stage_name))
+
+    return idx_cells_of_stage[-1] + 1
+
+
+def match_partition(arguments):
+    """
+    This function executes the cells of the Jupyter notebook, where the Dedupe algorithm is, for one
+    partition of a run and returns, for every row of the 1st input dataset of the partition, a tuple
+    made of the cluster_id from the database of the row it was matched with (None if it was not matched)
+    and the link score. It is executed by the processes of the pool that matches the partitions in
+    parallel, so it gets all its arguments in one tuple.
+
+    :param arguments: tuple made of the data of the Jupyter notebook, the name of the configuration file
+                      for Dedupe of the partition, and the index of the cell BEFORE which the execution
+                      stops (None for executing all the cells)
+    """
+    jupyter_notebook_data, configuration_file_name, idx_last_cell = arguments
+
+    # the notebook reads the name of its configuration file from the environment
+    os.environ['BACKBONE_DEDUPE_CONFIGURATION_FILE'] = configuration_file_name
+
+    notebook_namespace = {}
+    try:
+        execute_code_cells(jupyter_notebook_data["cells"][:idx_last_cell], notebook_namespace)
+    finally:
+        del os.environ['BACKBONE_DEDUPE_CONFIGURATION_FILE']
+
+    if idx_last_cell is not None:
+        close_spilled_cluster_membership(notebook_namespace)
+        return None
+
+    cluster_ids_from_database = utilities.get_cluster_ids_from_database_of_matched_rows(
+        notebook_namespace['generate_output_rows'](notebook_namespace['input_file_2'],
+                                                   notebook_namespace['first_unique_id_2']))
+
+    output_rows_1 = notebook_namespace['generate_output_rows'](notebook_namespace['input_file_1'],
+                                                               notebook_namespace['first_unique_id_1'])
+    next(output_rows_1)
+
+    cluster_ids_from_db = [(cluster_ids_from_database.get(int(row[0])), row[1]) for row in output_rows_1]
+
+    close_spilled_cluster_membership(notebook_namespace)
+
+    return cluster_ids_from_db
+
+
+def close_spilled_cluster_membership(notebook_namespace):
+    """
+    This function removes the file of the clusters of the matched records, if the Jupyter notebook kept
+    them on disk (because they would not fit in the memory budget)
+
+    :param notebook_namespace: dictionary where the variables defined by the cells of the notebook are kept
+    """
+    cluster_membership = notebook_namespace.get('cluster_membership')
+
+    if isinstance(cluster_membership, memory_budget.SpilledIntKeyMap):
+        cluster_membership.close()
+        notebook_namespace['cluster_membership'] = {}
@@ -0,0 +1,229 @@
+"""
+Diagnostics of the blocking done by Dedupe and a guard against oversized blocks.
+
+Before the records are matched, Dedupe groups them in blocks with the predicates it learned
+(e.g. "the first 4 letters of the legal name") and only scores the pairs of records that share
+a block, i.e., a record from the 1st dataset and a record from the 2nd dataset that got the same
+block key. A predicate that puts many records in the same block (e.g. a common word) produces a
+huge number of candidate pairs, which makes the matching much slower.
+
+This module counts, before matching, the records that every block has from each dataset, and
+reports the number of candidate pairs of every predicate, the distribution of the block sizes
+and the largest blocks. The blocks that would produce more candidate pairs than a given limit
+can be skipped, or split into smaller blocks (the records of a block are spread in sub-blocks
+by a hash of their ids, so only the pairs of records from the same sub-block are scored), so the
+matching time stays bounded, at the cost of the pairs that are not scored.
+
+Counting the blocks means blocking both datasets one more time, so it is only done when a limit is
+given or the diagnostics are asked for. The index of the 2nd dataset built for counting is used by
+the matching too, and it is dropped with 'reset_indices' once the datasets are matched.
+"""
+import math
+import zlib
+import logging
+
+from collections import Counter, OrderedDict
+
+# the upper limits (inclusive) of the intervals of the block size distribution; the size of a block
+# is the number of candidate pairs it produces
+BLOCK_SIZE_INTERVALS = (1, 10, 100, 1000, 10000, 100000)
+
+# the number of the largest blocks that are reported
+NR_OF_LARGEST_BLOCKS = 10
+
+
+class GuardedBlocker:
+    """
+    Wraps the blocker of a Dedupe linker and changes the keys of the oversized blocks:
+    a block that has to be skipped gets no key at all, and a block that has to be split
+    gets a different key for every sub-block. Everything else is done by the wrapped blocker.
+    """
+
+    def __init__(self, blocker, nr_of_sub_blocks_by_block_key):
+        """
+        Constructor
+
+        :param blocker: the blocker of the Dedupe linker
+        :param nr_of_sub_blocks_by_block_key: dictionary having as keys the keys of the oversized
+                                              blocks and as values the number of sub-blocks the
+                                              block is split in (0 if the block is skipped)
+        """
+        self.blocker = blocker
+        self.nr_of_sub_blocks_by_block_key = nr_of_sub_blocks_by_block_key
+
+    def __call__(self, records, target=False):
+        for block_key, record_id in self.blocker(records, target=target):
+            nr_of_sub_blocks = self.nr_of_sub_blocks_by_block_key.get(block_key)
+
+            if nr_of_sub_blocks is None:
+                yield block_key, record_id
+            elif nr_of_sub_blocks > 0:
+                sub_block = zlib.crc32(str(record_id).encode('utf-8')) % nr_of_sub_blocks
+                yield block_key + '#' + str(sub_block), record_id
+
+    def __getattr__(self, name):
+        return getattr(self.blocker, name)
+
+
+def get_predicate_of_block_key(blocker, block_key):
+    """
+    This function returns the name of the predicate that created the given block key. Dedupe
+    ends every block key with ':' followed by the index of the predicate.
+    """
+    predicate_idx = block_key.rsplit(':', 1)[-1]
+
+    try:
+        return str(blocker.predicates[int(predicate_idx)])
+    except (ValueError, IndexError, AttributeError):
+        return predicate_idx
+
+
+def count_records_by_block_key(blocker, data, target):
+    """
+    This function returns a Counter having as keys the block keys given to the records of
+    the given dataset and as values the number of records that got that key
+
+    :param blocker: the blocker of the Dedupe linker
+    :param data: dictionary of records, like the ones given to Dedupe
+    :param target: True for the 2nd dataset (the one that is indexed), False for the 1st one
+    """
+    records_by_block_key = Counter()
+    for block_key, record_id in blocker(data.items(), target=target):
+        records_by_block_key[block_key] += 1
+
+    return records_by_block_key
+
+
+def get_block_size_interval(nr_of_pairs):
+    """
+    This function returns the name of the interval of the block size distribution the given
+    number of candidate pairs belongs to, e.g., '11-100'
+    """
+    lower_limit = 1
+    for upper_limit in BLOCK_SIZE_INTERVALS:
+        if nr_of_pairs <= upper_limit:
+            return str(lower_limit) if lower_limit == upper_limit else '{}-{}'.format(lower_limit, upper_limit)
+
+        lower_limit = upper_limit + 1
+
+    return '>{}'.format(BLOCK_SIZE_INTERVALS[-1])
+
+
+def diagnose_and_guard_blocking(linker, data_1, data_2, max_block_pairs=None, oversized_blocks='split',
+                                diagnostics=False):
+    """
+    This function counts the candidate pairs of every block of the two datasets, returns the blocking
+    report and, if a maximum number of candidate pairs per block is given, makes the linker skip or
+    split the blocks that have more candidate pairs than that. It has to be called right before the
+    datasets are matched. If no maximum is given and the diagnostics are not asked for, the blocks are
+    not counted and the result is None.
+
+    The number of candidate pairs of a predicate is the sum of the pairs of its blocks. A pair of records
+    that share blocks of several predicates is counted for each of them, although Dedupe scores it once.
+
+    :param linker: the Dedupe linker (RecordLink or StaticRecordLink object)
+    :param data_1: dictionary of records, the 1st dataset
+    :param data_2: dictionary of records, the 2nd dataset
+    :param max_block_pairs: the maximum number of candidate pairs of a block, or None for no limit
+    :param oversized_blocks: 'skip' or 'split', what happens with the blocks that have more candidate
+                             pairs than the limit
+    :param diagnostics: True if the blocks are counted and reported even if no maximum is given
+    :return: an ordered dictionary with the blocking report, or None
+    """
+    if not max_block_pairs and not diagnostics:
+        return None
+
+    blocker = linker.blocker
+
+    # the index predicates need the 2nd dataset to be indexed before the blocks are created;
+    # the linker is told that the index is ready, so that it is not built again when matching
+    if getattr(blocker, 'index_fields', None):
+        blocker.indexAll(data_2)
+
+        if hasattr(linker, 'loaded_indices'):
+            linker.loaded_indices = True
+
+    records_by_block_key_2 = count_records_by_block_key(blocker, data_2, target=True)
+    records_by_block_key_1 = count_records_by_block_key(blocker, data_1, target=False)
+
+    pairs_by_predicate = Counter()
+    block_size_distribution = Counter()
+    blocks = []
+    for block_key, nr_of_records_1 in records_by_block_key_1.items():
+        nr_of_records_2 = records_by_block_key_2.get(block_key)
+        if not nr_of_records_2:
+            continue
+
+        nr_of_pairs = nr_of_records_1 * nr_of_records_2
+
+        pairs_by_predicate[get_predicate_of_block_key(blocker, block_key)] += nr_of_pairs
+        block_size_distribution[get_block_size_interval(nr_of_pairs)] += 1
+        blocks.append((nr_of_pairs, block_key, nr_of_records_1, nr_of_records_2))
+
+    blocks.sort(reverse=True)
+
+    nr_of_sub_blocks_by_block_key = {}
+    if max_block_pairs:
+        for nr_of_pairs, block_key, nr_of_records_1, nr_of_records_2 in blocks:
+            if nr_of_pairs <= max_block_pairs:
+                break
+
+            if oversized_blocks == 'skip':
+                nr_of_sub_blocks_by_block_key[block_key] = 0
+            else:
+                # the records of each dataset are spread evenly in the sub-blocks, so the pairs are
+                # divided by the square of the number of sub-blocks
+                nr_of_sub_blocks_by_block_key[block_key] = int(math.ceil(math.sqrt(nr_of_pairs / max_block_pairs)))
+
+    if nr_of_sub_blocks_by_block_key:
+        linker.blocker = GuardedBlocker(blocker, nr_of_sub_blocks_by_block_key)
+
+    report = OrderedDict()
+    report['nr_of_blocks'] = len(blocks)
+    report['nr_of_candidate_pairs'] = sum(block[0] for block in blocks)
+    report['candidate_pairs_by_predicate'] = OrderedDict(pairs_by_predicate.most_common())
+    report['block_size_distribution'] = OrderedDict(
+        (interval, block_size_distribution[interval])
+        for interval in [get_block_size_interval(limit) for limit in BLOCK_SIZE_INTERVALS] +
+        ['>{}'.format(BLOCK_SIZE_INTERVALS[-1])]
+        if block_size_distribution[interval])
+    report['largest_blocks'] = [OrderedDict([('block_key', block_key),
+                                             ('predicate', get_predicate_of_block_key(blocker, block_key)),
+                                             ('records_1', nr_of_records_1),
+                                             ('records_2', nr_of_records_2),
+                                             ('candidate_pairs', nr_of_pairs)])
+                                for nr_of_pairs, block_key, nr_of_records_1, nr_of_records_2
+                                in blocks[:NR_OF_LARGEST_BLOCKS]]
+    report['oversized_blocks'] = OrderedDict([
+        ('max_block_pairs', max_block_pairs),
+        ('action', oversized_blocks if nr_of_sub_blocks_by_block_key else None),
+        ('nr_of_blocks', len(nr_of_sub_blocks_by_block_key))])
+
+    logging.info('blocking: {} blocks, {} candidate pairs'.format(report['nr_of_blocks'],
+                                                                  report['nr_of_candidate_pairs']))
+    for predicate, nr_of_pairs in report['candidate_pairs_by_predicate'].items():
+        logging.info('blocking: {} candidate pairs from {}'.format(nr_of_pairs, predicate))
+    if nr_of_sub_blocks_by_block_key:
+        logging.warning('blocking: {} blocks have more than {} candidate pairs and are {}'.format(
+            len(nr_of_sub_blocks_by_block_key), max_block_pairs,
+            'skipped' if oversized_blocks == 'skip' else 'split'))
+
+    return report
+
+
+def reset_indices(linker, loaded_indices=False):
+    """
+    This function drops the index of the 2nd dataset (the canopies and the caches of the index predicates),
+    which Dedupe keeps after matching, and gives back to the linker the state it had before the blocking
+    was diagnosed. It has to be called after the matched pairs were read, since they can be generated
+    (and the records blocked) while they are read.
+
+    :param linker: the Dedupe linker (RecordLink or StaticRecordLink object)
+    :param loaded_indices: the value the 'loaded_indices' attribute of the linker had before the blocking
+                           was diagnosed
+    """
+    if getattr(linker.blocker, 'index_fields', None):
+        linker.blocker.resetIndices()
+
+    if hasattr(linker, 'loaded_indices'):
+        linker.loaded_indices = loaded_indices
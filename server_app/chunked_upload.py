@@ -0,0 +1,291 @@
+"""
+Resumable uploads of large files, in chunks.
+
+A file is uploaded in an upload session: the client starts (or resumes) the session with the name, the
+size and, optionally, the SHA-256 checksum of the whole file, and then sends the file in chunks, every
+chunk with the offset where it starts and its own SHA-256 checksum. Every chunk is streamed from the
+request to the end of a partial file (it is never kept whole in memory) while its checksum is computed,
+and it is kept only if its checksum is the one given by the client; otherwise the partial file is cut
+back to where the chunk started. The offset up to which the partial file was checked is kept next to it,
+in the file of the session, so an interrupted upload (a dropped connection, a restart of the client or
+of the server) is resumed from that offset instead of from zero: the session of a file is identified by
+its name, size and checksum, so starting it again returns the offset where the client should continue.
+When the last chunk was received, the checksum of the whole file is checked (if it was given), the
+partial file is moved into the upload store and placed under the name of the file, like a file uploaded
+with '/upload' (read more about this in the 'upload_store' module), and the session ends.
+
+A chunk is written while holding a lock on the partial file, so the chunks of a session are written one
+at a time, even by the different worker processes of the pre-forked mode.
+
+The sessions that were abandoned (no chunk was received for BACKBONE_UPLOAD_SESSION_MAX_AGE_HOURS hours,
+24 by default) are removed, with their partial files, every time a session is started.
+"""
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+
+import upload_store
+
+from werkzeug.utils import secure_filename
+
+# the prefix of the partial file and of the file of a session; it is followed by the id of the session
+upload_session_file_prefix = 'upload_session_'
+
+# the size of the chunks the client is asked to send, and the maximum size of a chunk
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# how many bytes of a chunk are read from the request (and written to the partial file) at once
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# after how many seconds without a chunk a session is abandoned, and its files are removed
+MAX_SESSION_AGE_SECONDS = float(os.getenv('BACKBONE_UPLOAD_SESSION_MAX_AGE_HOURS', '24')) * 3600
+
+
+class ChunkedUploadError(Exception):
+    """
+    Raised when a request of an upload session can't be served
+
+    :param status_code: int data type, the HTTP status code of the response
+    :param offset: int data type, the offset the client should continue from, or None
+    """
+
+    def __init__(self, message, status_code, offset=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.offset = offset
+
+
+def get_session_id(file_name, size, checksum):
+    """
+    This function returns the id of the upload session of the given file; the same file (name, size
+    and checksum) always gets the same id, so the client can resume its upload after a restart
+    """
+    return hashlib.sha256('{}\n{}\n{}'.format(file_name, size, checksum or '').encode('utf-8')).hexdigest()[:32]
+
+
+def get_partial_file_name(session_id):
+    return upload_session_file_prefix + session_id + '.part'
+
+
+def get_session_file_name(session_id):
+    return upload_session_file_prefix + session_id + '.json'
+
+
+def write_session(session):
+    """
+    This function writes the given session to its file, atomically (a crash never leaves half a file)
+    """
+    session_file_name = get_session_file_name(session['upload_id'])
+
+    with open(session_file_name + '.tmp', 'w') as session_file:
+        json.dump(session, session_file)
+        session_file.flush()
+        os.fsync(session_file.fileno())
+
+    os.replace(session_file_name + '.tmp', session_file_name)
+
+
+def read_session(session_id):
+    """
+    This function returns the upload session with the given id; if there is no such session,
+    'ChunkedUploadError' is raised
+    """
+    if not session_id.isalnum():
+        raise ChunkedUploadError('Unknown upload session', 404)
+
+    try:
+        with open(get_session_file_name(session_id), 'r') as session_file:
+            return json.load(session_file)
+    except FileNotFoundError:
+        raise ChunkedUploadError('Unknown upload session', 404)
+
+
+def remove_stale_sessions():
+    """
+    This function removes the files of the sessions (in the working directory) that didn't change for more
+    than MAX_SESSION_AGE_SECONDS, i.e. no chunk was received for them; a session whose chunk is being written
+    is never removed, since its partial file is locked
+    """
+    # the time of the last change of every session, from the newest of its files
+    last_change_times = {}
+    for entry in os.scandir('.'):
+        if entry.is_file() and entry.name.startswith(upload_session_file_prefix):
+            session_id = entry.name[len(upload_session_file_prefix):].split('.')[0]
+            last_change_times[session_id] = max(last_change_times.get(session_id, 0), entry.stat().st_mtime)
+
+    for session_id, last_change_time in last_change_times.items():
+        if time.time() - last_change_time <= MAX_SESSION_AGE_SECONDS:
+            continue
+
+        try:
+            partial_file = open(get_partial_file_name(session_id), 'r+b')
+        except FileNotFoundError:
+            partial_file = None
+
+        try:
+            if partial_file is not None:
+                fcntl.flock(partial_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            for session_file_name in (get_partial_file_name(session_id), get_session_file_name(session_id),
+                                      get_session_file_name(session_id) + '.tmp'):
+                try:
+                    os.remove(session_file_name)
+                except FileNotFoundError:
+                    pass
+
+            logging.info('abandoned upload session {} removed'.format(session_id))
+        except BlockingIOError:
+            # a chunk of the session is being written
+            pass
+        finally:
+            if partial_file is not None:
+                partial_file.close()
+
+
+def start_session(file_name, size, checksum=None):
+    """
+    This function starts the upload session of the given file, or returns the one that was already started
+    for it, so the client knows from which offset it has to send the file
+
+    Input: 'file_name' - string object containing the name of the file, as the client named it
+           'size' - int data type, the size of the whole file, in bytes
+           'checksum' - string object containing the SHA-256 checksum (hex) of the whole file, or None
+    """
+    file_name = secure_filename(file_name or '')
+    if not file_name:
+        raise ChunkedUploadError('The name of the file is missing', 400)
+    if not isinstance(size, int) or size < 0:
+        raise ChunkedUploadError('The size of the file must be a non-negative integer', 400)
+
+    checksum = checksum.lower() if checksum else None
+    session_id = get_session_id(file_name, size, checksum)
+
+    remove_stale_sessions()
+
+    try:
+        session = read_session(session_id)
+    except ChunkedUploadError:
+        session = {'upload_id': session_id, 'file_name': file_name, 'size': size, 'checksum': checksum,
+                   'offset': 0, 'completed': False}
+
+        # the partial file is created before the session, so a session never exists without it
+        open(get_partial_file_name(session_id), 'ab').close()
+        write_session(session)
+
+        logging.info('upload of {} ({} bytes) started, session {}'.format(file_name, size, session_id))
+
+        # an empty file has no chunks
+        if size == 0:
+            complete_session(session)
+
+    return session
+
+
+def write_chunk(session_id, offset, chunk_size, chunk_checksum, stream):
+    """
+    This function streams a chunk of the file of the given session from the request to the end of the
+    partial file, and returns the session with its new offset. The chunk is kept only if it starts at the
+    offset the session reached and its checksum is the given one; otherwise 'ChunkedUploadError' is raised
+    with the offset the client should continue from. After the last chunk, the upload is completed.
+
+    Input: 'session_id' - string object containing the id of the upload session
+           'offset' - int data type, the offset (in the file) where the chunk starts
+           'chunk_size' - int data type, the size of the chunk (the length of the body of the request)
+           'chunk_checksum' - string object containing the SHA-256 checksum (hex) of the chunk
+           'stream' - the stream of the body of the request
+    """
+    session = read_session(session_id)
+
+    if chunk_size is None or chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+        raise ChunkedUploadError('The size of a chunk must be between 1 and {} bytes'.format(MAX_CHUNK_SIZE),
+                                 400, session['offset'])
+    if not chunk_checksum:
+        raise ChunkedUploadError('The checksum of the chunk is missing', 400, session['offset'])
+
+    try:
+        partial_file = open(get_partial_file_name(session_id), 'r+b')
+    except FileNotFoundError:
+        raise ChunkedUploadError('Unknown upload session', 404)
+
+    with partial_file:
+        fcntl.flock(partial_file, fcntl.LOCK_EX)
+
+        # read again, since another request may have written a chunk (or completed the upload)
+        # while this one waited for the lock
+        session = read_session(session_id)
+
+        if offset != session['offset']:
+            raise ChunkedUploadError('The chunk must start at offset {}'.format(session['offset']), 409,
+                                     session['offset'])
+        if offset + chunk_size > session['size']:
+            raise ChunkedUploadError('The chunk ends after the end of the file', 400, session['offset'])
+
+        # the bytes after the offset are from a chunk that was not checked (e.g. the server stopped
+        # while writing it), so they are overwritten
+        partial_file.truncate(offset)
+        partial_file.seek(offset)
+
+        chunk_hash = hashlib.sha256()
+        nr_of_bytes_left = chunk_size
+        while nr_of_bytes_left > 0:
+            block = stream.read(min(STREAM_BLOCK_SIZE, nr_of_bytes_left))
+            if not block:
+                break
+            chunk_hash.update(block)
+            partial_file.write(block)
+            nr_of_bytes_left -= len(block)
+
+        if nr_of_bytes_left > 0 or chunk_hash.hexdigest() != chunk_checksum.lower():
+            partial_file.truncate(offset)
+            raise ChunkedUploadError('The chunk was incomplete or its checksum is wrong', 400, offset)
+
+        partial_file.flush()
+        os.fsync(partial_file.fileno())
+
+        session['offset'] = offset + chunk_size
+        if session['offset'] == session['size']:
+            complete_session(session)
+        else:
+            write_session(session)
+
+    return session
+
+
+def complete_session(session):
+    """
+    This function checks the checksum of the whole file of the given session (if the client gave it), moves
+    the partial file into the upload store, places it under the name of the file and removes the session;
+    if the checksum is wrong, the upload starts again
+    """
+    partial_file_name = get_partial_file_name(session['upload_id'])
+    checksum = upload_store.get_file_hash(partial_file_name)
+
+    if session['checksum'] and checksum != session['checksum']:
+        session['offset'] = 0
+        write_session(session)
+        open(partial_file_name, 'wb').close()
+
+        raise ChunkedUploadError('The checksum of the file is wrong; the upload starts again', 400, 0)
+
+    upload_store.place_file(upload_store.add_file(partial_file_name, checksum), session['file_name'])
+    os.remove(get_session_file_name(session['upload_id']))
+    session['completed'] = True
+
+    logging.info('upload of {} ({} bytes) completed'.format(session['file_name'], session['size']))
+
+
+def remove_session(session_id):
+    """
+    This function removes the given upload session and its partial file, e.g. when the client cancels it
+    """
+    read_session(session_id)
+
+    for file_name in (get_partial_file_name(session_id), get_session_file_name(session_id)):
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
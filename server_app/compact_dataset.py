@@ -0,0 +1,143 @@
+"""
+Compact in-memory representation of the datasets given to Dedupe.
+
+A dataset read as a dictionary of dictionaries keeps, for every record, a dictionary with its own
+copy of every field name and value, which takes several hundred bytes per record, i.e., gigabytes
+for a few million companies. A CompactDataset keeps the field names once and stores every column
+as an array of integer codes (dictionary encoding): a value that appears in many records (e.g. a
+city or a jurisdiction) is stored once and every record only keeps its 4-byte code.
+
+The records have integer ids, given in order, starting from a given id, so the ids of two datasets
+can be kept apart (the ids of the 2nd dataset start after the ones of the 1st dataset) and the id
+of a record is found from its row number, without building string keys. A CompactDataset is a
+read-only mapping from record ids to records (dictionaries), so it can be given to Dedupe as it is.
+
+Every lookup of a record builds a new dictionary, so a consumer that keeps the records it looks up
+(e.g. Dedupe, which keeps the records of the 2nd dataset once for every block they are in, while it
+matches) should be given a MemoizedDataset instead, where every record is built once and shared.
+"""
+import operator
+
+from array import array
+from collections.abc import Mapping
+
+
+class CompactDataset(Mapping):
+    """
+    Mapping from integer record ids to records, where the columns are stored dictionary encoded.
+    The records are added in order with 'append'; every call to '__getitem__' builds a new
+    dictionary for the record, so changing it doesn't change the dataset.
+    """
+
+    def __init__(self, field_names, first_record_id=0):
+        """
+        Constructor
+
+        :param field_names: list of string objects containing the names of the fields of the records
+        :param first_record_id: int data type, the id of the first record
+        """
+        self.field_names = list(field_names)
+        self.first_record_id = first_record_id
+
+        # the code 0 is always the missing value (None)
+        self.__values_of_columns = [[None] for field_name in self.field_names]
+        self.__codes_of_columns = [array('I') for field_name in self.field_names]
+        self.__encoders = [{None: 0} for field_name in self.field_names]
+        self.__nr_of_records = 0
+
+    def append(self, values):
+        """
+        Adds a record at the end of the dataset and returns its id
+
+        :param values: list containing the values of the record, in the order of the field names
+        """
+        if self.__encoders is None:
+            raise ValueError("No records can be added to the dataset after it was frozen")
+
+        for values_of_column, codes_of_column, encoder, value in zip(self.__values_of_columns,
+                                                                      self.__codes_of_columns,
+                                                                      self.__encoders, values):
+            code = encoder.get(value)
+            if code is None:
+                code = encoder[value] = len(values_of_column)
+                values_of_column.append(value)
+
+            codes_of_column.append(code)
+
+        self.__nr_of_records += 1
+
+        return self.first_record_id + self.__nr_of_records - 1
+
+    def freeze(self):
+        """
+        Drops the dictionaries used for encoding the values, which are only needed while records are
+        added, so the dataset takes less memory. No records can be added after the dataset is frozen.
+        """
+        self.__encoders = None
+
+    def __getitem__(self, record_id):
+        idx = self.__get_index(record_id)
+        if idx is None:
+            raise KeyError(record_id)
+
+        return dict((field_name, values_of_column[codes_of_column[idx]])
+                    for field_name, values_of_column, codes_of_column
+                    in zip(self.field_names, self.__values_of_columns, self.__codes_of_columns))
+
+    def __contains__(self, record_id):
+        return self.__get_index(record_id) is not None
+
+    def __iter__(self):
+        return iter(range(self.first_record_id, self.first_record_id + self.__nr_of_records))
+
+    def __len__(self):
+        return self.__nr_of_records
+
+    def __get_index(self, record_id):
+        """
+        Returns the index of the record having the given id in the arrays of codes, or None if
+        the dataset has no such record
+        """
+        # the ids given back by Dedupe can be numpy integers
+        try:
+            record_id = operator.index(record_id)
+        except TypeError:
+            return None
+
+        idx = record_id - self.first_record_id
+
+        return idx if 0 <= idx < self.__nr_of_records else None
+
+
+class MemoizedDataset(Mapping):
+    """
+    Read-only view of a dataset, where every record is built (by the dataset) at its first lookup and then
+    kept, so all the lookups of a record return the same dictionary. It is meant to live only while it is
+    needed (e.g. while the datasets are matched); the dataset itself keeps no dictionaries.
+    """
+
+    def __init__(self, dataset):
+        """
+        Constructor
+
+        :param dataset: the mapping from record ids to records that is viewed, e.g. a CompactDataset
+        """
+        self.dataset = dataset
+
+        self.__records = {}
+
+    def __getitem__(self, record_id):
+        record = self.__records.get(record_id)
+        if record is None:
+            record = self.__records[record_id] = self.dataset[record_id]
+
+        return record
+
+    def __contains__(self, record_id):
+        return record_id in self.dataset
+
+    def __iter__(self):
+        return iter(self.dataset)
+
+    def __len__(self):
+        return len(self.dataset)
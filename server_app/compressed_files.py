@@ -0,0 +1,89 @@
+"""
+Reading of compressed input datasets.
+
+The providers can send their datasets compressed with gzip (.csv.gz) or with zstd (.csv.zst), which
+are several times smaller than the .csv files, so they are faster to upload and to read from disk. The
+compressed files are kept as they were uploaded and every reader of an input dataset opens it with
+'open_input_file', which decompresses it as a stream, while it is read, so a decompressed copy of the
+dataset is never written to disk (nor kept whole in memory). The compression is found from the first
+bytes of the file (its magic number), not from its name, so a plain .csv file is read as before.
+
+gzip is supported by the standard library; zstd needs the optional 'zstandard' module.
+"""
+import io
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the first bytes of the files compressed with gzip and with zstd
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+ZSTD_MAGIC_NUMBER = b'\x28\xb5\x2f\xfd'
+
+# the suffixes of the names of the compressed files
+COMPRESSED_FILE_SUFFIXES = ('.gz', '.zst')
+
+
+def get_compression(file_name):
+    """
+    This function returns the compression of the given file ('gzip' or 'zstd'), found from its first
+    bytes, or None if the file is not compressed
+    """
+    with open(file_name, 'rb') as f:
+        first_bytes = f.read(len(ZSTD_MAGIC_NUMBER))
+
+    if first_bytes.startswith(GZIP_MAGIC_NUMBER):
+        return 'gzip'
+    if first_bytes.startswith(ZSTD_MAGIC_NUMBER):
+        return 'zstd'
+
+    return None
+
+
+def open_input_file(file_name):
+    """
+    This function opens the given file for reading text, like 'open(file_name)' does; if the file is
+    compressed, it is decompressed while it is read. It is used by all the readers of the input datasets.
+
+    Input: 'file_name' - string object containing the name of a .csv file, which can be compressed with
+                         gzip or with zstd
+    """
+    compression = get_compression(file_name)
+
+    if compression == 'gzip':
+        return gzip.open(file_name, 'rt')
+
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The file '{}' is compressed with zstd; install the 'zstandard' module "
+                               "to read it".format(file_name))
+
+        # the file can have several frames (e.g. if it was compressed in parallel); the decompressing
+        # reader closes the file when it is closed
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'),
+                                                                           read_across_frames=True,
+                                                                           closefd=True))
+
+    return open(file_name)
+
+
+def strip_compression_suffix(file_name):
+    """
+    This function returns the given file name without its compression suffix, e.g. 'file1.csv' for
+    'file1.csv.gz'; it is used for the names of the (not compressed) files created from an input dataset
+    """
+    for suffix in COMPRESSED_FILE_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+
+    return file_name
+
+
+def is_csv_file_name(file_name):
+    """
+    This function returns True if the given file name is the name of a .csv file, compressed or not
+    (e.g. 'file1.csv', 'file1.csv.gz' or 'file1.csv.zst')
+    """
+    return strip_compression_suffix(file_name).endswith('.csv')
@@ -0,0 +1,191 @@
+"""
+Memory budget of a run of the algorithm.
+
+The stages that keep the most data in memory (the extraction of the companies from the database,
+the matching and the remapping of the cluster_ids of the output) have a chunked, spill-to-disk mode:
+the extracted companies are streamed from the database into the csv file in chunks, instead of
+being loaded in a dataframe, and the cluster_ids of the matched records are kept in files mapped
+in memory (SpilledIntKeyMap), instead of dictionaries, so the operating system can page them out.
+
+Before such a stage starts, the memory the process uses is added to an estimate of what the stage
+needs, and if the result would exceed a given part (the spill ratio) of the memory budget, the stage
+runs in its spill-to-disk mode. This way the modes are switched before the limit is reached, not
+after the process was killed. Every decision is kept in a report, which is added to the job report.
+"""
+import os
+import logging
+import operator
+
+from collections import OrderedDict
+
+import numpy as np
+
+from training_budget import get_memory_usage_mb
+
+# the part of the memory budget that the memory used by the process plus the estimated memory
+# of a stage may take before the stage is switched to its spill-to-disk mode
+DEFAULT_SPILL_RATIO = 0.8
+
+# the number of rows that are fetched from the database at once, in the spill-to-disk mode of the extraction
+DEFAULT_CHUNK_SIZE = 50000
+
+# rough estimates of the memory (in bytes) the stages need: per record of the datasets when matching, per
+# row of the 2nd dataset when the cluster_ids are remapped, and per byte of the provider tables when the
+# companies are extracted into a dataframe
+BYTES_PER_MATCHED_RECORD = 250
+BYTES_PER_REMAPPED_ROW = 150
+DATAFRAME_BYTES_PER_TABLE_BYTE = 3
+
+
+class MemoryBudget:
+    """
+    Decides which stages run in their spill-to-disk mode, so that the memory used by the process
+    stays under the budget
+    """
+
+    def __init__(self, max_memory_mb=None, spill_ratio=DEFAULT_SPILL_RATIO, chunk_size=DEFAULT_CHUNK_SIZE,
+                 nr_of_top_allocations=0):
+        """
+        Constructor
+
+        :param max_memory_mb: the maximum memory (in MB) the process should use, or None for no limit
+        :param spill_ratio: float between 0 and 1, the part of the budget after which the stages spill to disk
+        :param chunk_size: the number of rows fetched from the database at once, when the extraction spills to disk
+        :param nr_of_top_allocations: the number of places that allocated the most memory which are reported
+                                      for every stage of the run (0 for none; read more about this in 'metrics')
+        """
+        self.max_memory_mb = max_memory_mb
+        self.spill_ratio = spill_ratio
+        self.chunk_size = chunk_size
+        self.nr_of_top_allocations = nr_of_top_allocations
+
+        self.report = OrderedDict([('max_memory_mb', max_memory_mb),
+                                   ('spill_ratio', spill_ratio),
+                                   ('stages', OrderedDict())])
+
+    @classmethod
+    def from_config(cls, memory_budget_config):
+        """
+        Creates a MemoryBudget from the 'memory_budget' section of the configuration file (or None)
+        """
+        memory_budget_config = memory_budget_config or {}
+
+        return cls(max_memory_mb=memory_budget_config.get('max_memory_mb'),
+                   spill_ratio=memory_budget_config.get('spill_ratio') or DEFAULT_SPILL_RATIO,
+                   chunk_size=memory_budget_config.get('chunk_size') or DEFAULT_CHUNK_SIZE,
+                   nr_of_top_allocations=memory_budget_config.get('nr_of_top_allocations') or 0)
+
+    def should_spill(self, stage_name, estimated_bytes=0):
+        """
+        Returns True if the given stage has to run in its spill-to-disk mode, i.e., the memory used by
+        the process plus the estimated memory of the stage would exceed the spill ratio of the budget.
+        Without a budget, no stage spills to disk.
+
+        :param stage_name: string object containing the name of the stage, e.g. 'match'
+        :param estimated_bytes: the estimated memory (in bytes) the stage needs, or a function that
+                                returns it (called only if there is a budget)
+        """
+        if not self.max_memory_mb:
+            return False
+
+        if callable(estimated_bytes):
+            estimated_bytes = estimated_bytes()
+
+        memory_usage_mb = get_memory_usage_mb()
+        estimated_mb = estimated_bytes / 1024.0 / 1024.0
+        spill = memory_usage_mb + estimated_mb > self.spill_ratio * self.max_memory_mb
+
+        self.report['stages'][stage_name] = OrderedDict([('memory_usage_mb', round(memory_usage_mb, 1)),
+                                                         ('estimated_mb', round(estimated_mb, 1)),
+                                                         ('spill_to_disk', spill)])
+
+        if spill:
+            logging.warning('{}: {:.0f} MB used and {:.0f} MB estimated, out of a budget of {} MB; '
+                            'spilling to disk'.format(stage_name, memory_usage_mb, estimated_mb, self.max_memory_mb))
+
+        return spill
+
+
+class SpilledIntKeyMap:
+    """
+    Mapping from the integers of a given range to tuples of numbers (or to numbers), kept in a file
+    that is mapped in memory. It is used instead of a dictionary when the keys are (almost) all the
+    integers of a range, e.g., the record ids of the datasets or the cluster_ids given by Dedupe.
+    """
+
+    def __init__(self, first_key, nr_of_keys, value_types, file_name):
+        """
+        Constructor
+
+        :param first_key: int data type, the first key of the range
+        :param nr_of_keys: int data type, the number of keys of the range
+        :param value_types: list of numpy types (e.g. ['int64', 'float64']), one per element of the
+                            values; if it has only one type, the values are numbers instead of tuples
+        :param file_name: string object containing the name of the file; it is removed by 'close'
+        """
+        self.first_key = first_key
+        self.nr_of_keys = nr_of_keys
+        self.file_name = file_name
+        self.is_tuple = len(value_types) > 1
+
+        dtype = [('is_set', 'bool')] + [('value_{}'.format(idx), value_type)
+                                        for idx, value_type in enumerate(value_types)]
+        self.__array = np.memmap(file_name, dtype=dtype, mode='w+', shape=(max(nr_of_keys, 1),))
+        self.__value_names = [name for name, value_type in dtype[1:]]
+        self.__nr_of_keys_set = 0
+
+    def __setitem__(self, key, value):
+        idx = self.__get_index(key)
+        if idx is None:
+            raise KeyError(key)
+
+        entry = self.__array[idx]
+        if not entry['is_set']:
+            self.__nr_of_keys_set += 1
+
+        entry['is_set'] = True
+        for name, element in zip(self.__value_names, value if self.is_tuple else (value,)):
+            entry[name] = element
+
+    def get(self, key, default=None):
+        idx = self.__get_index(key)
+        if idx is None or not self.__array[idx]['is_set']:
+            return default
+
+        entry = self.__array[idx]
+        value = tuple(entry[name].item() for name in self.__value_names)
+
+        return value if self.is_tuple else value[0]
+
+    def __getitem__(self, key):
+        idx = self.__get_index(key)
+        if idx is None or not self.__array[idx]['is_set']:
+            raise KeyError(key)
+
+        return self.get(key)
+
+    def __contains__(self, key):
+        idx = self.__get_index(key)
+
+        return idx is not None and bool(self.__array[idx]['is_set'])
+
+    def __len__(self):
+        return self.__nr_of_keys_set
+
+    def close(self):
+        """
+        Removes the file; the map can't be used afterwards
+        """
+        del self.__array
+
+        if os.path.isfile(self.file_name):
+            os.remove(self.file_name)
+
+    def __get_index(self, key):
+        # the keys can be numpy integers
+        try:
+            idx = operator.index(key) - self.first_key
+        except TypeError:
+            return None
+
+        return idx if 0 <= idx < self.nr_of_keys else None
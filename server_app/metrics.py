@@ -0,0 +1,357 @@
+"""
+Timing instrumentation of the algorithm and of the database calls.
+
+Every stage of a run of the algorithm (extraction, preprocessing, training, threshold, match, output,
+cluster remap, backbone_index insert, COPY load, evaluation, ...) is timed with 'stage', and every
+function of the 'utilities' module that talks to the database is timed with 'timed_db_call', which
+also counts the statements it sent, the connections it opened and the rows its statements returned or
+changed (the connections and their cursors report them with 'count_db_connection', 'count_db_statement'
+and 'count_db_rows').
+
+While a job runs, the peak memory (resident set size) of every stage is measured by a thread that samples
+the memory of the process and, if the job asks for it, the places where every stage allocated the most
+memory (that it still holds when the stage ends) are found with tracemalloc, which slows the job down.
+
+The times are added to the totals of the process, which the '/metrics' endpoint exports in the
+Prometheus text format, and to the report of the job that is running in the current thread (a
+JobReport), which is returned to the client when the job ends. In the pre-forked mode every worker
+keeps its own totals, so '/metrics' shows the totals of the worker that served the request.
+"""
+import time
+import logging
+import datetime
+import functools
+import threading
+import tracemalloc
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from training_budget import get_memory_usage_mb
+
+# the prefix of the names of the exported metrics
+METRIC_NAME_PREFIX = 'backbone_'
+
+# how often (in seconds) the memory of the process is sampled while a stage of a job runs
+MEMORY_SAMPLING_INTERVAL_SECONDS = 0.1
+
+# the totals of the process: stage -> [number of runs, seconds], function -> [number of calls, seconds, rows,
+# statements, connections] and (job name, status) -> number of jobs
+stage_totals = {}
+db_call_totals = {}
+job_totals = {}
+
+# the number of statements sent and of connections opened by the process; unlike the totals of the
+# functions, which include the statements of the functions they call, every statement is counted once
+db_totals = {'statements': 0, 'connections': 0}
+
+# the positions of the counts in the database calls of the stack of the current thread
+ROWS, STATEMENTS, CONNECTIONS = 1, 2, 3
+
+# the maximum number of slow statements kept in the report of a job
+MAX_SLOW_STATEMENTS_PER_JOB = 20
+
+totals_lock = threading.Lock()
+
+# the job report and the stack of the database calls of the current thread
+thread_state = threading.local()
+
+
+class JobReport:
+    """
+    Collects the times of the stages and of the database calls of a job (e.g. a run of the algorithm),
+    while it runs in the current thread. It is used as a context manager around the job.
+    """
+
+    def __init__(self, job_name):
+        """
+        Constructor
+
+        :param job_name: string object containing the name of the job, e.g. 'run_algorithm'
+        """
+        self.job_name = job_name
+
+        self.report = OrderedDict([('job', job_name),
+                                   ('started_at', None),
+                                   ('seconds', None),
+                                   ('status', None),
+                                   ('stages', OrderedDict()),
+                                   ('db_calls', OrderedDict()),
+                                   ('statements', OrderedDict()),
+                                   ('slow_statements', [])])
+
+        self.nr_of_top_allocations = 0
+
+        self.__start_time = None
+        self.__previous_job_report = None
+        self.__is_tracemalloc_started = False
+
+    def __enter__(self):
+        self.__previous_job_report = getattr(thread_state, 'job_report', None)
+        thread_state.job_report = self
+
+        self.report['started_at'] = datetime.datetime.utcnow().isoformat() + 'Z'
+        self.__start_time = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        thread_state.job_report = self.__previous_job_report
+
+        if self.__is_tracemalloc_started:
+            tracemalloc.stop()
+
+        self.report['seconds'] = round(time.perf_counter() - self.__start_time, 3)
+        self.report['status'] = 'failure' if exception_type else 'success'
+
+        with totals_lock:
+            job_key = (self.job_name, self.report['status'])
+            job_totals[job_key] = job_totals.get(job_key, 0) + 1
+
+        logging.info('job report: {}'.format(dict(self.report)))
+
+        return False
+
+    def trace_allocations(self, nr_of_top_allocations):
+        """
+        Makes the next stages of the job report the given number of places (file and line) that
+        allocated the most memory during the stage, which the stage still holds when it ends
+        """
+        self.nr_of_top_allocations = nr_of_top_allocations
+
+        if nr_of_top_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__is_tracemalloc_started = True
+
+    def add_stage(self, stage_name, seconds, peak_memory_mb=None, top_allocations=None):
+        stage_report = self.report['stages'].setdefault(stage_name, OrderedDict([('runs', 0), ('seconds', 0.0)]))
+        stage_report['runs'] += 1
+        stage_report['seconds'] = round(stage_report['seconds'] + seconds, 3)
+
+        if peak_memory_mb is not None:
+            stage_report['peak_memory_mb'] = round(max(stage_report.get('peak_memory_mb', 0), peak_memory_mb), 1)
+
+        if top_allocations is not None:
+            stage_report['top_allocations'] = top_allocations
+
+    def add_db_call(self, function_name, seconds, nr_of_rows, nr_of_statements=0, nr_of_connections=0):
+        db_call_report = self.report['db_calls'].setdefault(
+            function_name, OrderedDict([('calls', 0), ('seconds', 0.0), ('rows', 0), ('statements', 0),
+                                        ('connections', 0)]))
+        db_call_report['calls'] += 1
+        db_call_report['seconds'] = round(db_call_report['seconds'] + seconds, 3)
+        db_call_report['rows'] += nr_of_rows
+        db_call_report['statements'] += nr_of_statements
+        db_call_report['connections'] += nr_of_connections
+
+    def add_statement(self, shape, seconds, nr_of_rows, slow_statement_trace=None):
+        """
+        Adds a statement, traced by 'sql_tracing', to the totals of its shape and, if it is slow, its
+        trace to the slow statements of the job (at most MAX_SLOW_STATEMENTS_PER_JOB of them)
+        """
+        statement_report = self.report['statements'].setdefault(
+            shape, OrderedDict([('statements', 0), ('seconds', 0.0), ('rows', 0)]))
+        statement_report['statements'] += 1
+        statement_report['seconds'] = round(statement_report['seconds'] + seconds, 6)
+        statement_report['rows'] += nr_of_rows
+
+        if slow_statement_trace is not None and len(self.report['slow_statements']) < MAX_SLOW_STATEMENTS_PER_JOB:
+            self.report['slow_statements'].append(slow_statement_trace)
+
+
+def get_current_job_report():
+    """
+    This function returns the JobReport of the job that runs in the current thread, or None
+    """
+    return getattr(thread_state, 'job_report', None)
+
+
+@contextmanager
+def stage(stage_name):
+    """
+    Context manager that times the code it surrounds and adds the time to the given stage, in the
+    totals of the process and in the report of the current job (if there is one)
+
+    :param stage_name: string object containing the name of the stage, e.g. 'match'
+    """
+    job_report = get_current_job_report()
+
+    # the memory of the stage is only measured for the stages of a job
+    if job_report is not None:
+        peak_memory_mb = [get_memory_usage_mb()]
+        stop_sampling = threading.Event()
+
+        def sample_memory():
+            while not stop_sampling.wait(MEMORY_SAMPLING_INTERVAL_SECONDS):
+                peak_memory_mb[0] = max(peak_memory_mb[0], get_memory_usage_mb())
+
+        sampling_thread = threading.Thread(target=sample_memory, daemon=True)
+        sampling_thread.start()
+
+        start_snapshot = tracemalloc.take_snapshot() if job_report.nr_of_top_allocations else None
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+
+        with totals_lock:
+            stage_total = stage_totals.setdefault(stage_name, [0, 0.0])
+            stage_total[0] += 1
+            stage_total[1] += seconds
+
+        if job_report is None:
+            logging.info('stage {} took {:.3f} s'.format(stage_name, seconds))
+        else:
+            stop_sampling.set()
+            sampling_thread.join()
+            peak_memory_mb[0] = max(peak_memory_mb[0], get_memory_usage_mb())
+
+            top_allocations = None
+            if start_snapshot is not None and tracemalloc.is_tracing():
+                top_allocations = get_top_allocations(start_snapshot, tracemalloc.take_snapshot(),
+                                                      job_report.nr_of_top_allocations)
+
+            job_report.add_stage(stage_name, seconds, peak_memory_mb[0], top_allocations)
+
+            logging.info('stage {} took {:.3f} s (peak memory {:.1f} MB)'.format(stage_name, seconds,
+                                                                                peak_memory_mb[0]))
+
+
+def get_top_allocations(start_snapshot, end_snapshot, nr_of_top_allocations):
+    """
+    This function returns a list with the given number of places (file and line) whose allocated
+    memory grew the most between the two tracemalloc snapshots, each one given as a dictionary
+    """
+    statistics = end_snapshot.compare_to(start_snapshot, 'lineno')
+
+    return [OrderedDict([('location', '{}:{}'.format(statistic.traceback[0].filename, statistic.traceback[0].lineno)),
+                         ('size_kb', round(statistic.size_diff / 1024.0, 1)),
+                         ('count', statistic.count_diff)])
+            for statistic in statistics[:nr_of_top_allocations]]
+
+
+def timed_db_call(function):
+    """
+    Decorator of the functions that talk to the database: the time of every call and the numbers of
+    rows its statements returned or changed, of statements and of connections are added to the totals
+    of the process and to the report of the current job (if there is one), under the name of the function
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        db_calls = getattr(thread_state, 'db_calls', None)
+        if db_calls is None:
+            db_calls = thread_state.db_calls = []
+
+        db_call = [function.__name__, 0, 0, 0]
+        db_calls.append(db_call)
+
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start_time
+            db_calls.pop()
+
+            with totals_lock:
+                db_call_total = db_call_totals.setdefault(function.__name__, [0, 0.0, 0, 0, 0])
+                db_call_total[0] += 1
+                db_call_total[1] += seconds
+                db_call_total[2] += db_call[ROWS]
+                db_call_total[3] += db_call[STATEMENTS]
+                db_call_total[4] += db_call[CONNECTIONS]
+
+            job_report = get_current_job_report()
+            if job_report is not None:
+                job_report.add_db_call(function.__name__, seconds, db_call[ROWS], db_call[STATEMENTS],
+                                       db_call[CONNECTIONS])
+
+    return wrapper
+
+
+def get_current_db_call_name():
+    """
+    This function returns the name of the innermost database function that runs in the current thread, or None
+    """
+    db_calls = getattr(thread_state, 'db_calls', None)
+
+    return db_calls[-1][0] if db_calls else None
+
+
+def count_db_rows(nr_of_rows):
+    """
+    This function adds the given number of rows to the database call that runs in the current thread
+    (and to the database calls that called it). A negative number (the row count of a statement that
+    doesn't return or change rows) is ignored.
+    """
+    if nr_of_rows > 0:
+        for db_call in getattr(thread_state, 'db_calls', None) or []:
+            db_call[ROWS] += nr_of_rows
+
+
+def count_db_statement():
+    """
+    This function counts a statement sent to the database by the current thread
+    """
+    with totals_lock:
+        db_totals['statements'] += 1
+
+    for db_call in getattr(thread_state, 'db_calls', None) or []:
+        db_call[STATEMENTS] += 1
+
+
+def count_db_connection():
+    """
+    This function counts a connection to the database opened by the current thread
+    """
+    with totals_lock:
+        db_totals['connections'] += 1
+
+    for db_call in getattr(thread_state, 'db_calls', None) or []:
+        db_call[CONNECTIONS] += 1
+
+
+def format_labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+def render_prometheus_metrics():
+    """
+    This function returns the totals of the process in the Prometheus text exposition format
+    """
+    with totals_lock:
+        metrics = [
+            ('stage_runs_total', 'counter', 'Number of times a stage of the algorithm ran',
+             [(format_labels(stage=name), total[0]) for name, total in stage_totals.items()]),
+            ('stage_seconds_total', 'counter', 'Time spent in a stage of the algorithm',
+             [(format_labels(stage=name), total[1]) for name, total in stage_totals.items()]),
+            ('db_calls_total', 'counter', 'Number of calls of a database function',
+             [(format_labels(function=name), total[0]) for name, total in db_call_totals.items()]),
+            ('db_call_seconds_total', 'counter', 'Time spent in a database function',
+             [(format_labels(function=name), total[1]) for name, total in db_call_totals.items()]),
+            ('db_call_rows_total', 'counter', 'Rows returned or changed by the statements of a database function',
+             [(format_labels(function=name), total[2]) for name, total in db_call_totals.items()]),
+            ('db_call_statements_total', 'counter', 'Statements sent by a database function',
+             [(format_labels(function=name), total[3]) for name, total in db_call_totals.items()]),
+            ('db_call_connections_total', 'counter', 'Connections opened by a database function',
+             [(format_labels(function=name), total[4]) for name, total in db_call_totals.items()]),
+            ('db_statements_total', 'counter', 'Statements sent to the database',
+             [('', db_totals['statements'])]),
+            ('db_connections_total', 'counter', 'Connections opened to the database',
+             [('', db_totals['connections'])]),
+            ('jobs_total', 'counter', 'Number of jobs that ended, by status',
+             [(format_labels(job=job_name, status=status), total)
+              for (job_name, status), total in job_totals.items()]),
+        ]
+
+    lines = []
+    for name, metric_type, description, samples in metrics:
+        lines.append('# HELP {}{} {}'.format(METRIC_NAME_PREFIX, name, description))
+        lines.append('# TYPE {}{} {}'.format(METRIC_NAME_PREFIX, name, metric_type))
+
+        for labels, value in sorted(samples):
+            lines.append('{}{}{} {}'.format(METRIC_NAME_PREFIX, name, labels, repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,152 @@
+import csv
+import logging
+
+from io import BytesIO
+
+import dedupe
+
+import utilities
+import compressed_files
+
+from resident_matcher import get_preprocessed_record
+
+
+class MultiSourceLinker:
+    """
+    Links several datasets (sources), from different providers, against each other and against
+    the clusters that are already in the database, in one job. It uses Dedupe's Gazetteer: the
+    canonical dataset is made of one row per cluster of the jurisdiction, extracted once from all
+    the provider tables, and its blocking index is built once and shared by all the sources.
+
+    The sources are linked one after the other. A record that is not similar enough to any cluster
+    gets a new cluster and is added to the index, so the records of the next sources can be matched
+    with it. Inside a source the matching is one-to-one, i.e., a cluster gets at most one record from
+    a source, like in the matching of two datasets. This way all the sources get consistent cluster_ids
+    and every source is read and preprocessed only once.
+    """
+
+    # the number of candidate clusters that are scored for every record; the best free one is chosen
+    nr_of_candidate_clusters = 3
+
+    def __init__(self, settings_file_name, threshold):
+        """
+        Constructor
+
+        :param settings_file_name: string object containing the name of the settings file
+                                   (the trained model) used for matching
+        :param threshold: float between 0 and 1; a record is matched with a cluster only
+                          if their score is above the threshold
+        """
+        with open(settings_file_name, 'rb') as sf:
+            self.gazetteer = dedupe.StaticGazetteer(BytesIO(sf.read()))
+
+        self.fields = [field.field for field in self.gazetteer.data_model.primary_fields]
+        self.threshold = threshold
+
+        # the number of clusters indexed so far; the records can't be matched before a cluster is indexed,
+        # since Dedupe can't block records with its index predicates without an index
+        self.nr_of_indexed_clusters = 0
+
+    def index_clusters_from_database(self, info_db, jurisdiction):
+        """
+        Indexes one row per cluster, of the given jurisdiction, from all the provider tables
+
+        :param info_db: dictionary containing the database parameters needed for creating
+                        a connection; the dictionary is the one given in the configuration file
+        :param jurisdiction: string object containing the jurisdiction of the clusters
+        """
+        canonical_df = utilities.extract_one_row_per_cluster_by_jurisdiction_and_return_as_df(info_db, jurisdiction)
+
+        canonical_data = {}
+        if len(canonical_df.index):
+            missing_fields = set(self.fields).difference(canonical_df.columns.values)
+            if missing_fields:
+                raise ValueError("The companies from the database do not have the fields: " +
+                                 ', '.join(sorted(missing_fields)))
+
+            for row in canonical_df[self.fields + ['cluster_id']].itertuples(index=False):
+                canonical_data[int(row[-1])] = get_preprocessed_record(self.fields, row[:-1])
+
+        if canonical_data:
+            self.gazetteer.index(canonical_data)
+            self.nr_of_indexed_clusters += len(canonical_data)
+
+        logging.info('{} clusters indexed for jurisdiction {}'.format(len(canonical_data), jurisdiction))
+
+    def link_source(self, input_file_name, next_cluster_id):
+        """
+        Links the records of a source with the indexed clusters and indexes the records that
+        got new clusters. It returns a tuple made of a list that has, for every row of the source
+        (in the same order), a tuple made of its cluster_id and its link score (None for a new
+        cluster), and the cluster_id that the next new cluster should get.
+
+        :param input_file_name: string object containing the name of the csv file of the source
+        :param next_cluster_id: int data type, the cluster_id given to the first new cluster
+        """
+        messy_data = {}
+
+        with compressed_files.open_input_file(input_file_name) as input_file:
+            reader = csv.reader(input_file)
+            heading_row = next(reader)
+
+            missing_fields = set(self.fields).difference(heading_row)
+            if missing_fields:
+                raise ValueError("The dataset {} does not have the fields: ".format(input_file_name) +
+                                 ', '.join(sorted(missing_fields)))
+
+            idx_fields = [heading_row.index(field) for field in self.fields]
+
+            for idx_row, row in enumerate(reader):
+                messy_data[idx_row] = get_preprocessed_record(self.fields, [row[idx] for idx in idx_fields])
+
+        # when nothing is indexed yet (e.g. the jurisdiction has no companies in the database), every
+        # record of the source gets a new cluster
+        candidates = []
+        if messy_data and self.nr_of_indexed_clusters:
+            matches = self.gazetteer.match(messy_data, threshold=self.threshold,
+                                           n_matches=self.nr_of_candidate_clusters, generator=False)
+
+            for match in matches:
+                for (messy_id, cluster_id), score in match:
+                    candidates.append((float(score), int(messy_id), int(cluster_id)))
+
+        # one-to-one matching inside the source: the best pairs are chosen first
+        assignments = [None] * len(messy_data)
+        matched_cluster_ids = set()
+        for score, messy_id, cluster_id in sorted(candidates, reverse=True):
+            if assignments[messy_id] is None and cluster_id not in matched_cluster_ids:
+                assignments[messy_id] = (cluster_id, score)
+                matched_cluster_ids.add(cluster_id)
+
+        # the records without a match get new clusters, which the next sources can be matched with
+        new_clusters = {}
+        for messy_id, assignment in enumerate(assignments):
+            if assignment is None:
+                assignments[messy_id] = (next_cluster_id, None)
+                new_clusters[next_cluster_id] = messy_data[messy_id]
+                next_cluster_id += 1
+
+        if new_clusters:
+            self.gazetteer.index(new_clusters)
+            self.nr_of_indexed_clusters += len(new_clusters)
+
+        logging.info('{}: {} records matched, {} new clusters'.format(
+            input_file_name, len(assignments) - len(new_clusters), len(new_clusters)))
+
+        return assignments, next_cluster_id
+
+
+def generate_output_rows_of_source(input_file_name, assignments):
+    """
+    This function is a generator of the rows of a linked source: the heading row, followed by the
+    rows of the source, each having the 'cluster_id' and 'link_score' columns in front
+
+    :param input_file_name: string object containing the name of the csv file of the source
+    :param assignments: the list returned by 'MultiSourceLinker.link_source' for the source
+    """
+    with compressed_files.open_input_file(input_file_name) as input_file:
+        reader = csv.reader(input_file)
+        yield ['cluster_id', 'link_score'] + next(reader)
+
+        for row, (cluster_id, score) in zip(reader, assignments):
+            yield [cluster_id, score] + row
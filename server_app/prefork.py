@@ -0,0 +1,199 @@
+"""
+Pre-warming and pre-forking of the server.
+
+The heavy modules that the Jupyter notebook imports in its first cell are imported when
+this module is imported, and the time of every import is measured. The 'api' module imports
+this module before any other module of the application, so the measured times are the real
+import costs, and the notebook cells only find the modules in the cache afterwards.
+
+In the pre-forked mode the server process loads everything (modules and the trained model)
+once and then forks the workers, which share that memory copy-on-write, so no worker pays
+the import and load costs when it serves its first request.
+"""
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import importlib
+
+from collections import OrderedDict, deque
+
+from werkzeug.serving import make_server
+
+# the modules imported by the Jupyter notebook and by the 'utilities' module, that take most of the start up time
+heavy_module_names = ('numpy', 'pandas', 'psycopg2', 'psycopg2.extras', 'unidecode', 'simplejson', 'dedupe')
+
+# the time this module started to be imported, i.e., (almost) the time the server started
+process_start_time = time.time()
+
+# a worker that died is replaced after a delay, which is doubled for every worker that died within the
+# crash window (up to the maximum delay); if too many workers die within the window (e.g. every worker
+# dies at start up, because the database can't be reached), the server stops instead of forking forever
+WORKER_RESTART_DELAY_SECONDS = 0.5
+MAX_WORKER_RESTART_DELAY_SECONDS = 30
+WORKER_CRASH_WINDOW_SECONDS = 60
+MAX_WORKER_CRASHES_IN_WINDOW = 5
+
+# the data reported by the '/status/startup' endpoint
+startup_report = OrderedDict([('module_import_seconds', OrderedDict()),
+                              ('autocomplete_index_seconds', None),
+                              ('model_load_seconds', None),
+                              ('jurisdictions_index_seconds', OrderedDict()),
+                              ('startup_seconds', None),
+                              ('workers', 1)])
+
+
+def preload_modules(module_names):
+    """
+    Imports the given modules, measures how long every import takes and stores the
+    times in the start up report. A module that was already imported takes (almost) no time.
+
+    :param module_names: list of string objects containing the names of the modules
+    """
+    for module_name in module_names:
+        was_imported = module_name in sys.modules
+
+        start_time = time.perf_counter()
+        importlib.import_module(module_name)
+        import_seconds = time.perf_counter() - start_time
+
+        startup_report['module_import_seconds'][module_name] = round(import_seconds, 4)
+
+        if not was_imported:
+            logging.info('imported {} in {:.3f} s'.format(module_name, import_seconds))
+
+
+def measure(report_key, function, *args):
+    """
+    Calls the given function with the given arguments and stores the time it took in the
+    start up report, under the given key. It returns what the function returned.
+
+    :param report_key: string object containing the key of the start up report, or a tuple
+                       made of the key and a sub key (e.g. ('jurisdictions_index_seconds', 'no'))
+    :param function: the function that is called
+    """
+    start_time = time.perf_counter()
+    result = function(*args)
+    seconds = round(time.perf_counter() - start_time, 4)
+
+    if isinstance(report_key, tuple):
+        startup_report[report_key[0]][report_key[1]] = seconds
+    else:
+        startup_report[report_key] = seconds
+
+    return result
+
+
+def finish_startup():
+    """
+    Stores in the start up report how long it took to start the server and logs the report
+    """
+    startup_report['startup_seconds'] = round(time.time() - process_start_time, 4)
+
+    logging.info('start up report: {}'.format(dict(startup_report)))
+
+
+def serve_with_prefork_workers(app, host, port, nr_of_workers):
+    """
+    Opens the listening socket, forks 'nr_of_workers' worker processes that serve the
+    requests from that socket and then supervises them: a worker that dies is replaced by
+    a new one, after a delay that grows with the number of workers that died recently, and
+    all the workers are stopped when the server process receives SIGTERM or SIGINT. If more
+    than MAX_WORKER_CRASHES_IN_WINDOW workers die within WORKER_CRASH_WINDOW_SECONDS, the
+    server stops with the exit status 1. Everything that was loaded before calling this
+    function is shared by the workers copy-on-write.
+
+    :param app: the Flask application
+    :param host: string object containing the address the server listens on
+    :param port: int data type, the port the server listens on
+    :param nr_of_workers: int data type, the number of worker processes
+    """
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((host, port))
+    listening_socket.listen(128)
+
+    startup_report['workers'] = nr_of_workers
+
+    # move the objects created so far out of the garbage collector's reach, so that the
+    # collections done in the workers don't write to (and copy) the shared memory pages
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+    workers = set()
+
+    def start_worker():
+        pid = os.fork()
+
+        if pid == 0:
+            # the worker process: restore the default signal handlers and serve requests
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            exit_status = 1
+            try:
+                server = make_server(host, port, app, threaded=True, fd=listening_socket.fileno())
+                server.serve_forever()
+                exit_status = 0
+            except BaseException:
+                logging.exception('worker {} failed'.format(os.getpid()))
+            finally:
+                os._exit(exit_status)
+
+        workers.add(pid)
+
+    def kill_workers():
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def stop_workers(signal_number, frame):
+        kill_workers()
+
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    for _ in range(nr_of_workers):
+        start_worker()
+
+    logging.info('serving on {}:{} with {} pre-forked workers'.format(host, port, nr_of_workers))
+
+    # the times the workers died, within the crash window
+    crash_times = deque()
+
+    while True:
+        pid, status = os.wait()
+
+        if pid not in workers:
+            continue
+
+        workers.remove(pid)
+
+        crash_times.append(time.monotonic())
+        while crash_times[0] < time.monotonic() - WORKER_CRASH_WINDOW_SECONDS:
+            crash_times.popleft()
+
+        if len(crash_times) > MAX_WORKER_CRASHES_IN_WINDOW:
+            logging.error('worker {} exited with status {}; {} workers died within {} s, so the server '
+                          'stops'.format(pid, status, len(crash_times), WORKER_CRASH_WINDOW_SECONDS))
+            kill_workers()
+            sys.exit(1)
+
+        restart_delay_seconds = min(WORKER_RESTART_DELAY_SECONDS * 2 ** (len(crash_times) - 1),
+                                    MAX_WORKER_RESTART_DELAY_SECONDS)
+        logging.warning('worker {} exited with status {}; starting a new one in {} s'.format(
+            pid, status, restart_delay_seconds))
+
+        time.sleep(restart_delay_seconds)
+        start_worker()
+
+
+preload_modules(heavy_module_names)
@@ -0,0 +1,203 @@
+import os
+import logging
+import threading
+
+from io import BytesIO
+
+import dedupe
+
+import utilities
+
+
+class ResidentMatcher:
+    """
+    Matches a few company records, in real time, against the clusters that are already in the
+    database. It uses Dedupe's Gazetteer, which finds for every given (messy) record the most
+    similar records from a canonical dataset.
+
+    The trained model (the settings file written by the Jupyter notebook) is read once and
+    kept in memory. The canonical dataset of a jurisdiction is made of one row per cluster,
+    extracted from all the provider tables, and its blocking index is built at the first
+    request for that jurisdiction and then reused by the next requests. Both the model and
+    the indexes are dropped with 'reset', which must be called every time the algorithm
+    loaded new companies or produced a new model.
+
+    The index of a jurisdiction is built holding only the lock of that jurisdiction, so the
+    requests for the other jurisdictions are not blocked while it is built, and the records
+    are matched without holding any lock, so the requests are matched at the same time.
+    """
+
+    def __init__(self, settings_file_name):
+        """
+        Constructor
+
+        :param settings_file_name: string object containing the name of the settings file
+                                   (the trained model) used for matching
+        """
+        self.settings_file_name = settings_file_name
+
+        self.__settings_data = None
+
+        # dictionary where the keys are jurisdictions and the values are tuples made of
+        # an indexed Gazetteer (None if the jurisdiction has no clusters) and the list with
+        # the names of the fields of the model
+        self.__gazetteers = {}
+
+        # the locks held while the index of a jurisdiction is built, one for every jurisdiction
+        self.__jurisdiction_locks = {}
+
+        # increased by 'reset', so that an index built from the data of before the reset is not kept
+        self.__generation = 0
+
+        # the lock held while the dictionaries above or the model are read or changed
+        self.__lock = threading.Lock()
+
+    def is_model_available(self):
+        """
+        Returns True if a trained model can be used for matching
+        """
+        return self.__settings_data is not None or os.path.isfile(self.settings_file_name)
+
+    def reset(self):
+        """
+        Drops the model and the indexes, so that they are loaded again at the next request
+        """
+        with self.__lock:
+            self.__settings_data = None
+            self.__gazetteers = {}
+            self.__jurisdiction_locks = {}
+            self.__generation += 1
+
+    def load_model(self):
+        """
+        Reads the settings file into memory, if it was not read before
+        """
+        with self.__lock:
+            self.__load_model()
+
+    def __load_model(self):
+        if self.__settings_data is None:
+            with open(self.settings_file_name, 'rb') as sf:
+                self.__settings_data = sf.read()
+
+            logging.info('resident model read from {}'.format(self.settings_file_name))
+
+    def index_jurisdiction(self, info_db, jurisdiction):
+        """
+        Builds the index of the canonical dataset of the given jurisdiction, if it was not built
+        before, so that the first request for that jurisdiction doesn't have to wait for it
+
+        :param info_db: dictionary containing the database parameters needed for creating
+                        a connection; the dictionary is the one given in the configuration file
+        :param jurisdiction: string object containing the jurisdiction of the clusters
+        """
+        self.__get_indexed_gazetteer(info_db, jurisdiction)
+
+    def __get_indexed_gazetteer(self, info_db, jurisdiction):
+        """
+        Returns a tuple made of the Gazetteer that has the canonical dataset of the given
+        jurisdiction indexed (None if the jurisdiction has no clusters in the database, since
+        Dedupe can't match records without an index), and the names of the fields of the model.
+        The index is built holding the lock of the jurisdiction, so it is built once even if
+        several requests for the same jurisdiction come at the same time.
+        """
+        with self.__lock:
+            if jurisdiction in self.__gazetteers:
+                return self.__gazetteers[jurisdiction]
+
+            jurisdiction_lock = self.__jurisdiction_locks.setdefault(jurisdiction, threading.Lock())
+
+        with jurisdiction_lock:
+            with self.__lock:
+                # another request may have built the index while this one waited for the lock
+                if jurisdiction in self.__gazetteers:
+                    return self.__gazetteers[jurisdiction]
+
+                self.__load_model()
+                settings_data = self.__settings_data
+                generation = self.__generation
+
+            gazetteer = dedupe.StaticGazetteer(BytesIO(settings_data))
+            fields = [field.field for field in gazetteer.data_model.primary_fields]
+
+            canonical_df = utilities.extract_one_row_per_cluster_by_jurisdiction_and_return_as_df(info_db,
+                                                                                                jurisdiction)
+
+            canonical_data = {}
+            if len(canonical_df.index):
+                missing_fields = set(fields).difference(canonical_df.columns.values)
+                if missing_fields:
+                    raise ValueError("The companies from the database do not have the fields: " +
+                                     ', '.join(sorted(missing_fields)))
+
+                for row in canonical_df[fields + ['cluster_id']].itertuples(index=False):
+                    canonical_data[int(row[-1])] = get_preprocessed_record(fields, row[:-1])
+
+            if canonical_data:
+                gazetteer.index(canonical_data)
+            else:
+                gazetteer = None
+
+            logging.info('{} clusters indexed for jurisdiction {}'.format(len(canonical_data), jurisdiction))
+
+            with self.__lock:
+                if generation == self.__generation:
+                    self.__gazetteers[jurisdiction] = (gazetteer, fields)
+
+        return gazetteer, fields
+
+    def match(self, info_db, jurisdiction, records, n_matches, threshold):
+        """
+        Returns a list that has, for every given record, a list with at most 'n_matches'
+        dictionaries having the keys 'cluster_id' and 'score', from the best match to the
+        worst one. A record that is not similar enough to any cluster has an empty list.
+
+        :param info_db: dictionary containing the database parameters needed for creating
+                        a connection; the dictionary is the one given in the configuration file
+        :param jurisdiction: string object containing the jurisdiction of the clusters
+        :param records: list of dictionaries, each one representing a company
+        :param n_matches: maximum number of clusters returned for a record
+        :param threshold: float between 0 and 1; a cluster is returned only if its score
+                          is above the threshold
+        """
+        gazetteer, fields = self.__get_indexed_gazetteer(info_db, jurisdiction)
+
+        # no record can be matched in a jurisdiction that has no clusters
+        if gazetteer is None or not records:
+            return [[] for _ in records]
+
+        messy_data = {}
+        for idx, record in enumerate(records):
+            messy_data[idx] = get_preprocessed_record(fields, [record.get(field) for field in fields])
+
+        matches = gazetteer.match(messy_data, threshold=threshold, n_matches=n_matches, generator=False)
+
+        result = [[] for _ in records]
+        for match in matches:
+            for (messy_id, cluster_id), score in match:
+                result[int(messy_id)].append({'cluster_id': int(cluster_id), 'score': float(score)})
+
+        for record_matches in result:
+            record_matches.sort(key=lambda m: m['score'], reverse=True)
+
+        return result
+
+
+def get_preprocessed_record(fields, values):
+    """
+    Returns a dictionary (a record, in the format Dedupe expects) having as keys the given
+    fields and as values the given values, preprocessed like the notebook does it.
+    Missing values become None.
+
+    :param fields: list of string objects containing the names of the fields
+    :param values: list containing the values of the fields, in the same order
+    """
+    record = {}
+    for field, value in zip(fields, values):
+        if value is None or value != value:
+            # missing value (None or NaN)
+            record[field] = None
+        else:
+            record[field] = utilities.normalize_value(str(value))
+
+    return record
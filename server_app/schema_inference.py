@@ -0,0 +1,250 @@
+"""
+Inference of the SQL datatypes of the columns of a provider's dataset.
+
+The datatypes are first guessed from a bounded sample of the rows (or taken from the types
+that were used the last time the same provider was loaded) and then every value of the dataset
+is checked, in one streaming pass, against the guessed datatype of its column. A value that does
+not fit widens the datatype of its column (e.g. smallint -> integer -> bigint -> double precision
+-> text), so the final datatypes always fit all the values, while being as compact as possible.
+A column that has numeric values starting with 0 (e.g. the post code 0273) is always text, so
+that the leading zeros are kept. Empty values are NULLs, so they fit every datatype.
+
+The final datatypes are stored per provider in a json file, so that a provider's tables keep the
+same datatypes from one load to the next one and the sample does not have to be read again.
+"""
+import os
+import re
+import csv
+import json
+import math
+import fcntl
+import datetime
+import itertools
+
+import compressed_files
+
+# the number of rows read for guessing the datatypes of the columns
+SAMPLE_SIZE = 10000
+
+# the file where the datatypes of the columns are stored, for each provider, and the file locked while
+# it is changed, since the partitions of a dataset are loaded at the same time
+PROVIDER_SCHEMAS_FILE_NAME = 'provider_schemas.json'
+PROVIDER_SCHEMAS_LOCK_FILE_NAME = PROVIDER_SCHEMAS_FILE_NAME + '.lock'
+
+# the datatypes, from the most compact one to the widest one; a datatype can only
+# be widened to one that comes after it in its chain
+NUMERIC_DATATYPES = ('SMALLINT', 'INTEGER', 'BIGINT', 'DOUBLE PRECISION', 'TEXT')
+DATE_DATATYPES = ('DATE', 'TEXT')
+BOOLEAN_DATATYPES = ('BOOLEAN', 'TEXT')
+
+INTEGER_RANGES = {'SMALLINT': 2 ** 15, 'INTEGER': 2 ** 31, 'BIGINT': 2 ** 63}
+
+INTEGER_REGEX = re.compile(r'^[+-]?[0-9]+$')
+NUMERIC_WITH_LEADING_ZERO_REGEX = re.compile(r'^[+-]?0[0-9]+$')
+FLOAT_REGEX = re.compile(r'^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$')
+DATE_REGEX = re.compile(r'^[0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])$')
+BOOLEAN_VALUES = {'true', 'false'}
+
+
+def value_fits_datatype(value, datatype):
+    """
+    This function returns True if the given (not empty) value can be stored in a column
+    having the given datatype
+
+    Input: 'value' - string object, a value from the csv file
+           'datatype' - string object, one of the datatypes defined in this module
+    """
+    if datatype == 'TEXT':
+        return True
+
+    if datatype in INTEGER_RANGES:
+        if not INTEGER_REGEX.match(value) or NUMERIC_WITH_LEADING_ZERO_REGEX.match(value):
+            return False
+
+        return -INTEGER_RANGES[datatype] <= int(value) < INTEGER_RANGES[datatype]
+
+    if datatype == 'DOUBLE PRECISION':
+        # a value like 1e400 matches the regex, but it is out of the range of the datatype
+        return FLOAT_REGEX.match(value) is not None and NUMERIC_WITH_LEADING_ZERO_REGEX.match(value) is None and \
+            math.isfinite(float(value))
+
+    if datatype == 'DATE':
+        if DATE_REGEX.match(value) is None:
+            return False
+
+        # a value like 2019-02-30 matches the regex, but it is not a date
+        try:
+            datetime.date(*map(int, value.split('-')))
+        except ValueError:
+            return False
+
+        return True
+
+    if datatype == 'BOOLEAN':
+        return value.lower() in BOOLEAN_VALUES
+
+    return False
+
+
+def get_datatype_chain(datatype):
+    """
+    This function returns the tuple of datatypes the given datatype belongs to
+    """
+    for datatype_chain in (NUMERIC_DATATYPES, DATE_DATATYPES, BOOLEAN_DATATYPES):
+        if datatype in datatype_chain:
+            return datatype_chain
+
+    return ('TEXT',)
+
+
+def get_narrowest_datatype(value):
+    """
+    This function returns the most compact datatype the given (not empty) value fits in
+    """
+    for datatype in ('BOOLEAN', 'DATE') + NUMERIC_DATATYPES:
+        if value_fits_datatype(value, datatype):
+            return datatype
+
+
+def widen_datatype(datatype, value):
+    """
+    This function returns the most compact datatype, starting from the given one, that the given
+    (not empty) value fits in. If the value doesn't fit any datatype of the chain the given datatype
+    belongs to, the result is 'TEXT'.
+
+    Input: 'datatype' - string object, the current datatype of the column
+           'value' - string object, a value from the csv file
+    """
+    if datatype is None:
+        return get_narrowest_datatype(value)
+
+    datatype_chain = get_datatype_chain(datatype)
+
+    for wider_datatype in datatype_chain[datatype_chain.index(datatype):]:
+        if value_fits_datatype(value, wider_datatype):
+            return wider_datatype
+
+    return 'TEXT'
+
+
+def widen_datatypes_to_fit_rows(datatypes, rows):
+    """
+    This function widens the given datatypes until they fit all the values of the given rows.
+    The datatype of a column that has only empty values remains None.
+
+    Input: 'datatypes' - list that has, for every column, its current datatype or None
+           'rows' - iterable of lists, where each list is a row (without the heading row)
+    """
+    datatypes = list(datatypes)
+
+    # the indexes of the columns whose datatypes can still be widened
+    idx_columns = [idx for idx, datatype in enumerate(datatypes) if datatype != 'TEXT']
+
+    for row in rows:
+        if not idx_columns:
+            break
+
+        widened_to_text = False
+        for idx in idx_columns:
+            value = row[idx] if idx < len(row) else ''
+
+            if value != '' and (datatypes[idx] is None or not value_fits_datatype(value, datatypes[idx])):
+                datatypes[idx] = widen_datatype(datatypes[idx], value)
+                widened_to_text = widened_to_text or datatypes[idx] == 'TEXT'
+
+        if widened_to_text:
+            idx_columns = [idx for idx in idx_columns if datatypes[idx] != 'TEXT']
+
+    return datatypes
+
+
+def is_wider_datatype(datatype, other_datatype):
+    """
+    This function returns True if a column having the datatype 'other_datatype' has to be changed
+    to the datatype 'datatype' in order to fit more values, e.g., it is True for 'BIGINT' and 'INTEGER',
+    but it is False for 'INTEGER' and 'BIGINT' and for 'BIGINT' and 'CHARACTER VARYING'
+
+    Input: 'datatype' - string object, one of the datatypes defined in this module
+           'other_datatype' - string object, the datatype of a column, in upper case
+    """
+    if other_datatype in ('TEXT', 'CHARACTER VARYING') or datatype == other_datatype:
+        return False
+
+    if datatype == 'TEXT':
+        return True
+
+    datatype_chain = get_datatype_chain(datatype)
+
+    return other_datatype in datatype_chain and datatype_chain.index(datatype) > datatype_chain.index(other_datatype)
+
+
+def read_provider_schemas():
+    """
+    This function returns the dictionary stored in the provider schemas file, where the keys are
+    the names of the providers and the values are dictionaries having as keys the column names and
+    as values their datatypes. If the file does not exist, the result is an empty dictionary.
+    """
+    try:
+        with open(PROVIDER_SCHEMAS_FILE_NAME) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_provider_schema(provider_name, column_names_and_datatypes):
+    """
+    This function stores the datatypes of the columns of a provider in the provider schemas file
+
+    Input: 'provider_name' - string containing the name of the provider
+           'column_names_and_datatypes' - dictionary having as keys the column names and
+                                          as values their datatypes (None for a column that
+                                          had only empty values)
+    """
+    # the file is read and written while holding the lock, so the schemas written at the same time (e.g. by
+    # the partitions of a dataset) are all kept, and it is replaced atomically, so it is never read half written
+    with open(PROVIDER_SCHEMAS_LOCK_FILE_NAME, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        provider_schemas = read_provider_schemas()
+        provider_schemas[provider_name] = column_names_and_datatypes
+
+        with open(PROVIDER_SCHEMAS_FILE_NAME + '.tmp', 'w') as f:
+            json.dump(provider_schemas, f, indent=2, sort_keys=True)
+
+        os.replace(PROVIDER_SCHEMAS_FILE_NAME + '.tmp', PROVIDER_SCHEMAS_FILE_NAME)
+
+
+def infer_datatypes_of_csv_file(csv_file_name, provider_name=None):
+    """
+    This function returns a dictionary having as keys the names of the columns of the csv file and
+    as values their SQL datatypes. If a provider name is given, the datatypes stored for that provider
+    are the starting point (instead of the ones guessed from the sample) and the final datatypes are
+    stored for that provider.
+
+    Input: 'csv_file_name' - the name of the csv file
+           'provider_name' - string containing the name of the provider that gave the dataset, or None
+    """
+    cached_datatypes = read_provider_schemas().get(provider_name, {}) if provider_name else {}
+
+    with compressed_files.open_input_file(csv_file_name) as f:
+        reader = csv.reader(f)
+        column_names = next(reader)
+
+        datatypes = [cached_datatypes.get(column_name) for column_name in column_names]
+
+        # guess the datatypes of the columns that were not seen before from a sample
+        if None in datatypes:
+            sample_rows = list(itertools.islice(reader, SAMPLE_SIZE))
+            datatypes = widen_datatypes_to_fit_rows(datatypes, sample_rows)
+        else:
+            sample_rows = []
+
+        # check all the values against the guessed datatypes, in one pass
+        datatypes = widen_datatypes_to_fit_rows(datatypes, itertools.chain(sample_rows, reader))
+
+    # a column that has only empty values is stored for the provider without a datatype,
+    # so that its datatype is inferred again the next time, but its table column is text
+    if provider_name:
+        write_provider_schema(provider_name, dict(zip(column_names, datatypes)))
+
+    return dict((column_name, datatype or 'TEXT') for column_name, datatype in zip(column_names, datatypes))
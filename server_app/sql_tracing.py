@@ -0,0 +1,223 @@
+"""
+Tracing of the SQL statements sent to the database.
+
+Every statement sent by the cursors of the connections made with 'utilities.create_database_connection'
+is traced: its shape (the statement with its literals and parameters replaced by '?', so the statements
+built by concatenating values are grouped together), its parameters, its duration and the number of
+rows it returned or changed. The process keeps the totals of every shape, the last traced statements
+and the last slow statements, i.e., the ones that took longer than the threshold. For a slow statement
+that only reads data, the plan of the statement is captured with 'EXPLAIN (ANALYZE, BUFFERS)', which
+runs the statement again, so the plan of a shape is captured at most once in a given interval.
+
+The traces are exported by the '/admin/sql_traces' endpoint, and the statements of a job are added to
+the report of the job (read more about it in 'metrics'). The threshold (in milliseconds) is given with
+the BACKBONE_SLOW_STATEMENT_MS environment variable.
+"""
+import os
+import re
+import time
+import logging
+import datetime
+import threading
+
+from collections import OrderedDict, deque
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+# the statements that took longer than this (in seconds) are slow
+SLOW_STATEMENT_SECONDS = float(os.getenv('BACKBONE_SLOW_STATEMENT_MS', '500')) / 1000.0
+
+# the plan of a shape is captured at most once in this number of seconds
+EXPLAIN_INTERVAL_SECONDS = 60
+
+# how many of the last statements and of the last slow statements are kept
+NR_OF_RECENT_STATEMENTS = 200
+NR_OF_SLOW_STATEMENTS = 50
+
+# the statements and their parameters are cut to these lengths in the traces
+MAX_STATEMENT_LENGTH = 2000
+MAX_PARAMETERS_LENGTH = 500
+
+# only the statements that start with these words (and don't change data) are explained
+READ_ONLY_STATEMENT_PATTERN = re.compile(r'^\s*(SELECT|WITH|VALUES|TABLE)\b', re.IGNORECASE)
+WRITING_STATEMENT_PATTERN = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|DROP|ALTER|INTO|'
+                                       r'FOR\s+UPDATE|FOR\s+SHARE|NEXTVAL|SETVAL|PG_SLEEP)\b', re.IGNORECASE)
+
+# the parts of a statement that are replaced to get its shape: string literals, parameters ('%s'),
+# numbers, lists of values and whitespace
+STRING_LITERAL_PATTERN = re.compile(r"[EeUu]?'(?:[^']|'')*'")
+PARAMETER_PATTERN = re.compile(r'%\(\w+\)s|%s')
+NUMBER_PATTERN = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])')
+VALUE_LIST_PATTERN = re.compile(r'\b(IN|VALUES)\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# shape -> [number of statements, seconds, rows, maximum seconds, number of slow statements]
+shape_totals = {}
+recent_statements = deque(maxlen=NR_OF_RECENT_STATEMENTS)
+slow_statements = deque(maxlen=NR_OF_SLOW_STATEMENTS)
+
+# shape -> the time when its plan was last captured
+explain_times = {}
+
+traces_lock = threading.Lock()
+
+
+def get_statement_text(cursor, statement):
+    """
+    This function returns the given statement (a string, bytes or a composed statement of psycopg2) as a string
+    """
+    if isinstance(statement, bytes):
+        return statement.decode('utf-8', 'replace')
+    if not isinstance(statement, str):
+        return statement.as_string(cursor)
+
+    return statement
+
+
+def get_statement_shape(statement_text):
+    """
+    This function returns the shape of the given statement: its string literals, parameters and numbers
+    are replaced by '?', the lists of values (after IN or VALUES) by '(?, ...)' and the whitespace by one space, e.g.
+    "SELECT * FROM bi_a WHERE cluster_id IN (1, 2, 3) AND legal_name ILIKE 'abc'" becomes
+    "SELECT * FROM bi_a WHERE cluster_id IN (?, ...) AND legal_name ILIKE ?"
+    """
+    shape = STRING_LITERAL_PATTERN.sub('?', statement_text)
+    shape = PARAMETER_PATTERN.sub('?', shape)
+    shape = NUMBER_PATTERN.sub('?', shape)
+    shape = VALUE_LIST_PATTERN.sub(r'\1 (?, ...)', shape)
+
+    return WHITESPACE_PATTERN.sub(' ', shape).strip().rstrip(';')
+
+
+def is_read_only_statement(statement_text):
+    return bool(READ_ONLY_STATEMENT_PATTERN.match(statement_text)) and \
+        not WRITING_STATEMENT_PATTERN.search(STRING_LITERAL_PATTERN.sub('?', statement_text))
+
+
+def cut(text, max_length):
+    return text if len(text) <= max_length else text[:max_length] + '...'
+
+
+def explain_statement(cursor, statement_text, parameters):
+    """
+    This function runs the given statement again with 'EXPLAIN (ANALYZE, BUFFERS)', on the connection
+    of the given cursor, and returns the plan as a list of lines
+    """
+    # a plain cursor is used, so the EXPLAIN is neither traced nor counted in the metrics
+    with cursor.connection.cursor(cursor_factory=psycopg2.extensions.cursor) as explain_cursor:
+        explain_cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement_text, parameters)
+
+        return [row[0] for row in explain_cursor.fetchall()]
+
+
+def should_explain(cursor, statement_text, shape):
+    """
+    This function returns True if the plan of the given slow statement has to be captured: the statement
+    only reads data, it was not sent by a server-side cursor or inside a transaction (which the EXPLAIN
+    could break) and the plan of its shape was not captured in the last EXPLAIN_INTERVAL_SECONDS
+    """
+    if cursor.name or not cursor.connection.autocommit or not is_read_only_statement(statement_text):
+        return False
+
+    with traces_lock:
+        now = time.time()
+        if now - explain_times.get(shape, 0) < EXPLAIN_INTERVAL_SECONDS:
+            return False
+
+        explain_times[shape] = now
+
+    return True
+
+
+def trace_statement(cursor, statement, parameters, seconds, nr_of_rows, is_failed=False):
+    """
+    This function traces a statement that was sent by the given cursor: it is added to the totals of its
+    shape, to the last statements and to the report of the current job (if there is one) and, if it is
+    slow, to the last slow statements, together with its plan if it only reads data (and it didn't fail,
+    e.g. because of a statement timeout, which its EXPLAIN would hit again)
+
+    Input: 'cursor' - the cursor that sent the statement
+           'statement' - the statement, as it was given to the cursor
+           'parameters' - the parameters of the statement, or None
+           'seconds' - float data type, how long the statement took
+           'nr_of_rows' - int data type, the number of rows the statement returned or changed (-1 if unknown)
+           'is_failed' - True if the statement raised an error
+    """
+    statement_text = get_statement_text(cursor, statement)
+    shape = get_statement_shape(statement_text)
+    is_slow = seconds >= SLOW_STATEMENT_SECONDS
+    nr_of_rows = max(nr_of_rows, 0)
+
+    trace = OrderedDict([('started_at', (datetime.datetime.utcnow() -
+                                         datetime.timedelta(seconds=seconds)).isoformat() + 'Z'),
+                         ('function', metrics.get_current_db_call_name()),
+                         ('shape', shape),
+                         ('statement', cut(statement_text, MAX_STATEMENT_LENGTH)),
+                         ('parameters', cut(repr(parameters), MAX_PARAMETERS_LENGTH) if parameters is not None
+                          else None),
+                         ('seconds', round(seconds, 6)),
+                         ('rows', nr_of_rows)])
+
+    if is_failed:
+        trace['failed'] = True
+    elif is_slow and should_explain(cursor, statement_text, shape):
+        try:
+            trace['plan'] = explain_statement(cursor, statement_text, parameters)
+        except psycopg2.Error as e:
+            trace['plan_error'] = str(e).strip()
+
+    with traces_lock:
+        shape_total = shape_totals.setdefault(shape, [0, 0.0, 0, 0.0, 0])
+        shape_total[0] += 1
+        shape_total[1] += seconds
+        shape_total[2] += nr_of_rows
+        shape_total[3] = max(shape_total[3], seconds)
+        shape_total[4] += is_slow
+
+        recent_statements.append(trace)
+        if is_slow:
+            slow_statements.append(trace)
+
+    if is_slow:
+        logging.warning('slow statement ({:.3f} s): {}'.format(seconds, cut(statement_text, 200)))
+
+    job_report = metrics.get_current_job_report()
+    if job_report is not None:
+        job_report.add_statement(shape, seconds, nr_of_rows, trace if is_slow else None)
+
+
+def get_shape_reports(totals, limit=None):
+    """
+    This function returns a list of dictionaries, one per shape of the given totals (shape -> [number of
+    statements, seconds, rows, maximum seconds, number of slow statements]), sorted by their total time
+    """
+    shape_reports = [OrderedDict([('shape', shape),
+                                  ('statements', total[0]),
+                                  ('seconds', round(total[1], 6)),
+                                  ('mean_seconds', round(total[1] / total[0], 6)),
+                                  ('max_seconds', round(total[3], 6)),
+                                  ('rows', total[2]),
+                                  ('slow_statements', total[4])])
+                     for shape, total in totals.items()]
+    shape_reports.sort(key=lambda shape_report: shape_report['seconds'], reverse=True)
+
+    return shape_reports[:limit] if limit else shape_reports
+
+
+def get_traces_report(limit=None):
+    """
+    This function returns the traces of the process: the totals of the shapes (the slowest first), the last
+    slow statements and the last statements (the most recent first), at most 'limit' of each (if it is given)
+    """
+    with traces_lock:
+        shape_reports = get_shape_reports(shape_totals, limit)
+        last_slow_statements = list(reversed(slow_statements))[:limit]
+        last_statements = list(reversed(recent_statements))[:limit]
+
+    return OrderedDict([('slow_statement_seconds', SLOW_STATEMENT_SECONDS),
+                        ('shapes', shape_reports),
+                        ('slow_statements', last_slow_statements),
+                        ('recent_statements', last_statements)])
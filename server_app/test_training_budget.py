@@ -0,0 +1,65 @@
+import unittest
+
+from collections import Counter
+
+from training_budget import get_stratified_sample
+
+
+class GetStratifiedSampleTest(unittest.TestCase):
+
+    @staticmethod
+    def create_data(localities):
+        return dict((idx, {'legal_name': 'company {}'.format(idx), 'city': locality})
+                    for idx, locality in enumerate(localities))
+
+    def test_sample_of_small_dataset_is_the_whole_dataset(self):
+        data = self.create_data(['oslo'] * 10)
+
+        self.assertIs(get_stratified_sample(data, 100, 'city'), data)
+        self.assertIs(get_stratified_sample(data, None, 'city'), data)
+
+    def test_sample_without_strata_has_the_given_size(self):
+        data = self.create_data(['oslo'] * 1000)
+
+        self.assertEqual(len(get_stratified_sample(data, 100, seed=1)), 100)
+
+    def test_sample_keeps_the_proportions_of_the_strata(self):
+        data = self.create_data(['oslo'] * 600 + ['bergen'] * 300 + ['tromso'] * 100)
+
+        sample = get_stratified_sample(data, 100, 'city', seed=1)
+
+        self.assertEqual(Counter(record['city'] for record in sample.values()),
+                         Counter({'oslo': 60, 'bergen': 30, 'tromso': 10}))
+
+    def test_parts_of_the_strata_add_up_to_the_size(self):
+        data = self.create_data(['oslo'] * 334 + ['bergen'] * 333 + ['tromso'] * 333)
+
+        for size in (1, 2, 10, 100, 999):
+            self.assertEqual(len(get_stratified_sample(data, size, 'city', seed=1)), size)
+
+    def test_sample_is_bounded_when_there_are_more_strata_than_records_in_the_sample(self):
+        data = self.create_data(['city {}'.format(idx) for idx in range(5000)])
+
+        sample = get_stratified_sample(data, 100, 'city', seed=1)
+
+        self.assertEqual(len(sample), 100)
+        self.assertEqual(len(set(record['city'] for record in sample.values())), 100)
+
+    def test_sample_is_a_subset_of_the_records(self):
+        data = self.create_data(['oslo', None, 'bergen'] * 100)
+
+        sample = get_stratified_sample(data, 50, 'city', seed=1)
+
+        self.assertEqual(len(sample), 50)
+        for key, record in sample.items():
+            self.assertIs(record, data[key])
+
+    def test_same_seed_gives_the_same_sample(self):
+        data = self.create_data(['city {}'.format(idx % 37) for idx in range(1000)])
+
+        self.assertEqual(sorted(get_stratified_sample(data, 100, 'city', seed=7)),
+                         sorted(get_stratified_sample(data, 100, 'city', seed=7)))
+
+
+if __name__ == '__main__':
+    unittest.main()
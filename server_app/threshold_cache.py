@@ -0,0 +1,171 @@
+"""
+Cache of the thresholds computed by Dedupe.
+
+Computing the threshold means scoring a sample of the datasets, which takes a long time and
+gives (almost) the same result as long as the model doesn't change. So the computed thresholds
+are kept in a json file, next to the trained model, and the key of a threshold is made of the
+hash of the model (the settings file) and the recall weight it was computed with. A run that
+uses the same model and the same recall weight takes the threshold from the cache.
+
+The samples are drawn with reservoir sampling, i.e., in one pass over the records, without
+building the list of all the keys, and every record has the same chance of being chosen.
+"""
+import os
+import json
+import fcntl
+import random
+import hashlib
+import logging
+
+# the name of the file, in the directory of the settings file, that keeps the thresholds
+THRESHOLD_CACHE_FILE_NAME = 'threshold_cache.json'
+
+# the ways the threshold can be (re)computed:
+# 'cache' - the cached threshold is used, if there is one, otherwise it is computed
+# 'recompute' - the threshold is always computed and then cached
+# 'incremental' - a threshold is computed from a new sample and it is averaged with the cached one,
+#                 weighted by the sizes of their samples, so every run refines the cached threshold
+RECOMPUTE_MODES = ('cache', 'recompute', 'incremental')
+
+
+def get_model_hash(settings_file_name):
+    """
+    This function returns the md5 hexdigest of the settings file (the trained model)
+    """
+    md5 = hashlib.md5()
+    with open(settings_file_name, 'rb') as sf:
+        for chunk in iter(lambda: sf.read(1024 * 1024), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def get_cache_key(settings_file_name, recall_weight):
+    return '{}:{}'.format(get_model_hash(settings_file_name), float(recall_weight))
+
+
+def get_cache_file_name(settings_file_name):
+    return os.path.join(os.path.dirname(settings_file_name), THRESHOLD_CACHE_FILE_NAME)
+
+
+class CacheLock:
+    """
+    Exclusive lock of the cache file that is next to the given settings file, held while the cache is read,
+    changed and written, so the thresholds cached at the same time (e.g. by the partitions of a dataset) are
+    all kept
+
+    :param settings_file_name: string object containing the name of the settings file of the linker
+    """
+
+    def __init__(self, settings_file_name):
+        self.lock_file_name = get_cache_file_name(settings_file_name) + '.lock'
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_file_name, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock_file.close()
+
+
+def read_cache(settings_file_name):
+    """
+    This function returns the dictionary stored in the cache file that is next to the given settings
+    file, where the keys are made by 'get_cache_key' and the values are dictionaries having the keys
+    'threshold' and 'sample_size'. If the file does not exist, the result is an empty dictionary.
+    """
+    try:
+        with open(get_cache_file_name(settings_file_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_cache(settings_file_name, cache):
+    """
+    This function writes the given dictionary to the cache file that is next to the given settings file,
+    atomically (a reader never finds half a file); it must be called holding the 'CacheLock'
+    """
+    cache_file_name = get_cache_file_name(settings_file_name)
+
+    with open(cache_file_name + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+    os.replace(cache_file_name + '.tmp', cache_file_name)
+
+
+def reservoir_sample(data, size, seed=None):
+    """
+    This function returns a random subset of the given records, having at most 'size' records,
+    chosen in one pass over the records (reservoir sampling)
+
+    :param data: dictionary of records, like the ones given to Dedupe
+    :param size: the number of records of the subset
+    :param seed: the seed of the random number generator, or None
+    :return: a dictionary of records
+    """
+    rng = random.Random(seed)
+
+    reservoir = []
+    for idx, item in enumerate(data.items()):
+        if idx < size:
+            reservoir.append(item)
+        else:
+            idx_replaced = rng.randint(0, idx)
+            if idx_replaced < size:
+                reservoir[idx_replaced] = item
+
+    return dict(reservoir)
+
+
+def get_threshold(linker, settings_file_name, data_1, data_2, recall_weight, sample_size,
+                  recompute_mode='cache', seed=None):
+    """
+    This function returns the threshold of the linker, for the given recall weight, taking it
+    from the cache or computing it (and caching it), depending on the recompute mode.
+
+    :param linker: the Dedupe linker
+    :param settings_file_name: string object containing the name of the settings file of the linker
+    :param data_1: dictionary of records, the 1st dataset
+    :param data_2: dictionary of records, the 2nd dataset
+    :param recall_weight: how much more recall matters than precision
+    :param sample_size: the number of records sampled from each dataset for computing the threshold
+    :param recompute_mode: one of the RECOMPUTE_MODES
+    :param seed: the seed of the random number generator, or None
+    :return: float, the threshold
+    """
+    if recompute_mode not in RECOMPUTE_MODES:
+        raise ValueError("The threshold recompute mode must be one of: " + ', '.join(RECOMPUTE_MODES))
+
+    cache_key = get_cache_key(settings_file_name, recall_weight)
+    cached = read_cache(settings_file_name).get(cache_key)
+
+    if cached and recompute_mode == 'cache':
+        logging.info('threshold {} taken from the cache'.format(cached['threshold']))
+        return cached['threshold']
+
+    sample_size = int(sample_size)
+    threshold = linker.threshold(reservoir_sample(data_1, sample_size, seed),
+                                 reservoir_sample(data_2, sample_size, seed),
+                                 recall_weight)
+    threshold = float(threshold)
+
+    # the threshold is computed without holding the lock, so the cache is read again, since another
+    # run may have changed it in the meantime
+    with CacheLock(settings_file_name):
+        cache = read_cache(settings_file_name)
+        cached = cache.get(cache_key)
+
+        if cached and recompute_mode == 'incremental':
+            total_sample_size = cached['sample_size'] + sample_size
+            threshold = (cached['threshold'] * cached['sample_size'] + threshold * sample_size) / total_sample_size
+            sample_size = total_sample_size
+
+        cache[cache_key] = {'threshold': threshold, 'sample_size': sample_size}
+        write_cache(settings_file_name, cache)
+
+    logging.info('threshold {} computed and cached'.format(threshold))
+
+    return threshold
@@ -0,0 +1,350 @@
+"""
+Time and memory budget for the training part of the algorithm.
+
+The steps of the training (sampling the pairs of records and learning the model) run within a time
+and a memory limit, so a step stops early instead of running for an unpredictable amount of time.
+By default a step runs in a child process (forked from the server, so it has all the data of the run),
+which is killed, together with the processes it started, as soon as one of the limits is exceeded;
+when the step completes, what it changed in the object it belongs to (e.g. the pairs sampled or the
+model learned by the linker) is sent back to the server. If the step can't run in a child process
+(the server itself runs in a daemonic process, or what the step changed can't be sent back), it runs
+in the thread of the server and a watchdog thread raises 'TrainingBudgetExceeded' in that thread when
+a limit is exceeded. That is only a best-effort limit: the exception is raised when the thread runs
+Python code again, so a long call of C code (e.g. of numpy) is not stopped before it returns, and it
+can be raised anywhere in the code of the library, e.g. while it holds a lock. The time and the peak
+memory of every step are kept in a report, which is logged.
+
+The pairs used for training can also be sampled from a bounded, stratified random subset of the
+datasets, instead of from all their records.
+"""
+import os
+import time
+import ctypes
+import pickle
+import random
+import signal
+import logging
+import resource
+import threading
+import multiprocessing
+
+from collections import OrderedDict
+
+# how often (in seconds) the watchdog checks the limits
+WATCHDOG_INTERVAL_SECONDS = 0.2
+
+# where the steps run: 'process' - in a child process that is killed when a limit is exceeded
+#                      'thread' - in the current thread, where an exception is raised when a limit is exceeded
+ISOLATION_MODES = ('process', 'thread')
+
+
+class TrainingBudgetExceeded(Exception):
+    pass
+
+
+class StepStateNotTransferable(Exception):
+    """
+    Raised when what a step changed, in a child process, can't be sent back to the server
+    """
+    pass
+
+
+def get_memory_usage_mb(pid='self'):
+    """
+    This function returns the memory (resident set size) used by the given process (by default, the
+    current one), in MB. If it can't be read from '/proc', the peak memory of the current process is
+    returned instead.
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+    except (IOError, OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_step_in_child_process(connection, function, args, kwargs):
+    """
+    This function is executed by the child process of a step: it calls the given function and sends back,
+    on the given connection, its result and the attributes of the object the function belongs to (if it is
+    a method), which the step may have changed, or the exception it raised
+    """
+    # the child process leads its own process group, so it can be killed together with the processes it starts
+    os.setpgid(0, 0)
+
+    try:
+        result = function(*args, **kwargs)
+
+        bound_object = getattr(function, '__self__', None)
+        try:
+            message = pickle.dumps(('completed', result, bound_object.__dict__ if bound_object is not None else None),
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            message = pickle.dumps(('failed', StepStateNotTransferable(str(e)), None))
+    except BaseException as e:
+        try:
+            message = pickle.dumps(('failed', e, None))
+        except Exception:
+            message = pickle.dumps(('failed', RuntimeError(repr(e)), None))
+
+    connection.send_bytes(message)
+    connection.close()
+
+
+class TrainingBudget:
+    """
+    Runs the steps of the training within the given limits. The limits apply to every step.
+    """
+
+    def __init__(self, max_seconds=None, max_memory_mb=None, isolation='process'):
+        """
+        Constructor
+
+        :param max_seconds: the maximum number of seconds a step can take, or None for no limit
+        :param max_memory_mb: the maximum memory (in MB) the process can use during a step,
+                              or None for no limit
+        :param isolation: one of the ISOLATION_MODES, where the steps run when a limit is given
+        """
+        if isolation not in ISOLATION_MODES:
+            raise ValueError("The isolation of the training steps must be one of: " + ', '.join(ISOLATION_MODES))
+
+        self.max_seconds = max_seconds
+        self.max_memory_mb = max_memory_mb
+        self.isolation = isolation
+
+        self.report = OrderedDict([('max_seconds', max_seconds),
+                                   ('max_memory_mb', max_memory_mb),
+                                   ('isolation', isolation),
+                                   ('steps', OrderedDict())])
+
+        self.__lock = threading.Lock()
+        self.__is_step_running = False
+        self.__exceeded_limit = None
+
+    def __get_exceeded_limit(self, step_start_time, memory_mb):
+        """
+        Returns the description of the limit that is exceeded, or None if the step is within the limits
+        """
+        if self.max_seconds and time.time() - step_start_time > self.max_seconds:
+            return 'the time limit of {} s'.format(self.max_seconds)
+        if self.max_memory_mb and memory_mb > self.max_memory_mb:
+            return 'the memory limit of {} MB'.format(self.max_memory_mb)
+
+        return None
+
+    def __can_run_in_child_process(self):
+        # a daemonic process (e.g. a worker of a multiprocessing pool) is not allowed to start processes
+        return self.isolation == 'process' and bool(self.max_seconds or self.max_memory_mb) and \
+            hasattr(os, 'fork') and not multiprocessing.current_process().daemon
+
+    def run(self, step_name, function, *args, **kwargs):
+        """
+        Calls the given function with the given arguments and returns what the function returned.
+        If a limit is exceeded while the function runs, the function is stopped and
+        'TrainingBudgetExceeded' is raised.
+
+        :param step_name: string object containing the name of the step, used in the report
+        :param function: the function that is called
+        """
+        step_report = OrderedDict([('seconds', None), ('peak_memory_mb', None), ('isolation', None),
+                                   ('completed', False)])
+        self.report['steps'][step_name] = step_report
+
+        peak_memory_mb = [get_memory_usage_mb()]
+        self.__exceeded_limit = None
+
+        step_start_time = time.time()
+
+        try:
+            try:
+                if self.__can_run_in_child_process():
+                    try:
+                        step_report['isolation'] = 'process'
+                        result = self.__run_in_child_process(function, args, kwargs, step_start_time,
+                                                             peak_memory_mb)
+                    except StepStateNotTransferable as e:
+                        logging.warning('training step {} is run again in the current thread, since what it '
+                                        'changed could not be sent back from its process: {}'.format(step_name, e))
+                        step_report['isolation'] = 'thread'
+                        result = self.__run_in_current_thread(function, args, kwargs, step_start_time,
+                                                              peak_memory_mb)
+                else:
+                    step_report['isolation'] = 'thread'
+                    result = self.__run_in_current_thread(function, args, kwargs, step_start_time, peak_memory_mb)
+            finally:
+                step_report['seconds'] = round(time.time() - step_start_time, 3)
+                step_report['peak_memory_mb'] = round(peak_memory_mb[0], 1)
+        except TrainingBudgetExceeded:
+            logging.warning('training step {} stopped after {} s: {} was exceeded'.format(
+                step_name, step_report['seconds'], self.__exceeded_limit))
+            raise TrainingBudgetExceeded('{}: {} was exceeded'.format(step_name, self.__exceeded_limit))
+
+        step_report['completed'] = True
+
+        logging.info('training step {} took {} s (peak memory {} MB)'.format(
+            step_name, step_report['seconds'], step_report['peak_memory_mb']))
+
+        return result
+
+    def __run_in_child_process(self, function, args, kwargs, step_start_time, peak_memory_mb):
+        """
+        Runs the step in a child process, which is killed (with the processes it started) when a limit is
+        exceeded, and copies what the step changed in the object the function belongs to into that object
+        """
+        receiving_connection, sending_connection = multiprocessing.Pipe(duplex=False)
+
+        child_process = multiprocessing.get_context('fork').Process(
+            target=run_step_in_child_process, args=(sending_connection, function, args, kwargs))
+        child_process.start()
+        sending_connection.close()
+
+        try:
+            while not receiving_connection.poll(WATCHDOG_INTERVAL_SECONDS):
+                if not child_process.is_alive():
+                    # the result may have been sent right before the process ended
+                    if receiving_connection.poll():
+                        break
+                    raise RuntimeError('the process of the training step ended with the exit code {}'.format(
+                        child_process.exitcode))
+
+                # the child process has all the memory of the server mapped, like the thread of the step would
+                memory_mb = get_memory_usage_mb(child_process.pid)
+                peak_memory_mb[0] = max(peak_memory_mb[0], memory_mb)
+
+                self.__exceeded_limit = self.__get_exceeded_limit(step_start_time, memory_mb)
+                if self.__exceeded_limit is not None:
+                    raise TrainingBudgetExceeded(self.__exceeded_limit)
+
+            try:
+                status, result, state = pickle.loads(receiving_connection.recv_bytes())
+            except EOFError:
+                raise RuntimeError('the process of the training step ended without a result')
+        finally:
+            receiving_connection.close()
+
+            if child_process.is_alive():
+                try:
+                    os.killpg(child_process.pid, signal.SIGKILL)
+                except OSError:
+                    # the process didn't lead its process group yet
+                    os.kill(child_process.pid, signal.SIGKILL)
+
+            child_process.join()
+
+        if status == 'failed':
+            raise result
+
+        if state is not None:
+            function.__self__.__dict__.update(state)
+
+        return result
+
+    def __run_in_current_thread(self, function, args, kwargs, step_start_time, peak_memory_mb):
+        """
+        Runs the step in the current thread, while a watchdog thread raises 'TrainingBudgetExceeded' in it
+        when a limit is exceeded (read more about the limits of this in the description of the module)
+        """
+        stop_watchdog = threading.Event()
+        thread_id = threading.get_ident()
+
+        def watchdog():
+            while not stop_watchdog.wait(WATCHDOG_INTERVAL_SECONDS):
+                memory_mb = get_memory_usage_mb()
+                peak_memory_mb[0] = max(peak_memory_mb[0], memory_mb)
+
+                exceeded_limit = self.__get_exceeded_limit(step_start_time, memory_mb)
+                if exceeded_limit is None:
+                    continue
+
+                with self.__lock:
+                    if self.__is_step_running:
+                        self.__exceeded_limit = exceeded_limit
+                        nr_of_modified_threads = ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                            ctypes.c_ulong(thread_id), ctypes.py_object(TrainingBudgetExceeded))
+
+                        if nr_of_modified_threads == 0:
+                            logging.warning('the training step could not be stopped: its thread was not found')
+                        elif nr_of_modified_threads > 1:
+                            # the exception must be raised in one thread only, so it is taken back
+                            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), None)
+                            logging.warning('the training step could not be stopped: its thread id is not unique')
+                return
+
+        with self.__lock:
+            self.__is_step_running = True
+
+        watchdog_thread = threading.Thread(target=watchdog, daemon=True)
+        watchdog_thread.start()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self.__lock:
+                self.__is_step_running = False
+
+            stop_watchdog.set()
+            watchdog_thread.join()
+
+
+def get_stratified_sample(data, size, stratify_by=None, seed=None):
+    """
+    This function returns a random subset of the given records, having at most 'size' records.
+    If a field is given, the records are grouped by the value of that field (the strata) and
+    every group gets a part of the subset proportional to its size, so that the subset has
+    the same proportions as the whole dataset (e.g. the same share of every jurisdiction).
+    The parts are rounded by the largest remainder method, so they add up to 'size'; when there
+    are more strata than 'size', the strata whose part is rounded down to 0 are left out.
+
+    :param data: dictionary of records, like the ones given to Dedupe
+    :param size: the maximum number of records of the subset, or None for all the records
+    :param stratify_by: string object containing the name of the field used for stratifying, or None
+    :param seed: the seed of the random number generator, or None
+    :return: a dictionary of records
+    """
+    if not size or len(data) <= size:
+        return data
+
+    rng = random.Random(seed)
+
+    if not stratify_by:
+        return dict((key, data[key]) for key in rng.sample(list(data), size))
+
+    strata = {}
+    for key, record in data.items():
+        strata.setdefault(record.get(stratify_by), []).append(key)
+
+    # the exact (fractional) part of every stratum, rounded down; the records left are given, one by one,
+    # to the strata with the largest remainders (the strata are shuffled first, so the ties are broken at random)
+    strata_keys = list(strata.values())
+    rng.shuffle(strata_keys)
+
+    exact_stratum_sizes = [size * len(stratum_keys) / float(len(data)) for stratum_keys in strata_keys]
+    stratum_sizes = [int(exact_stratum_size) for exact_stratum_size in exact_stratum_sizes]
+
+    idx_strata_by_remainder = sorted(range(len(strata_keys)),
+                                     key=lambda idx: exact_stratum_sizes[idx] - stratum_sizes[idx], reverse=True)
+    for idx in idx_strata_by_remainder[:size - sum(stratum_sizes)]:
+        stratum_sizes[idx] += 1
+
+    sample = {}
+    for stratum_keys, stratum_size in zip(strata_keys, stratum_sizes):
+        for key in rng.sample(stratum_keys, stratum_size):
+            sample[key] = data[key]
+
+    return sample
+
+
+def train_within_budget(linker, budget):
+    """
+    This function learns the model of the linker within the given budget. If the limits are
+    exceeded, the training is done again without index predicates (the blocking rules that need
+    an index of the records), which is the most expensive part of learning the blocking rules.
+    If the limits are exceeded again, 'TrainingBudgetExceeded' is raised.
+
+    :param linker: the Dedupe linker, having the training pairs
+    :param budget: TrainingBudget object
+    """
+    try:
+        budget.run('train', linker.train)
+    except TrainingBudgetExceeded:
+        budget.report['fallback'] = 'train without index predicates'
+        budget.run('train_without_index_predicates', linker.train, index_predicates=False)
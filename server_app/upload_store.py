@@ -0,0 +1,343 @@
+"""
+Content-addressed store of the uploaded files.
+
+The providers often upload the same dataset (or the same training file) again for a new run. Every
+uploaded file is kept in the store under the SHA-256 hash of its content, so a file is stored once,
+whatever its name, and before uploading a file the client can ask the server whether it already has
+a file with that hash; if it does, the file is placed under the name the client gave it without being
+uploaded again. The uploaded files are copies of the stored files (not links), so a run that changes
+or removes its input files never changes the store.
+
+The store also keeps derived forms of its files, e.g. the dataset parsed and preprocessed by the
+Jupyter notebook ('read_data'), under the hash of the file and a key that describes the form (the
+fields that were read and the version of the preprocessing). The name of every file placed by the
+store is recorded together with its size and modification time, so a reader can find the hash of a
+file without reading it, as long as the file was not changed since.
+
+The store is kept within a disk budget (BACKBONE_UPLOAD_STORE_MAX_MB megabytes, 20 GB by default):
+every time a file or a derived form is used its modification time is updated, and when the store is
+over its budget the least recently used files and forms are removed.
+"""
+import os
+import json
+import fcntl
+import pickle
+import shutil
+import hashlib
+import logging
+import marshal
+import tempfile
+
+from collections import OrderedDict
+
+# the directory of the store, in the working directory of the server
+UPLOAD_STORE_DIRECTORY = 'upload_store'
+OBJECTS_DIRECTORY = os.path.join(UPLOAD_STORE_DIRECTORY, 'objects')
+FORMS_DIRECTORY = os.path.join(UPLOAD_STORE_DIRECTORY, 'forms')
+
+# the file that keeps, for every file placed by the store, its hash, its size and its modification time
+PLACED_FILES_FILE_NAME = os.path.join(UPLOAD_STORE_DIRECTORY, 'placed_files.json')
+
+# the file locked while the store is changed, so the worker processes of the pre-forked mode change it one at a time
+LOCK_FILE_NAME = os.path.join(UPLOAD_STORE_DIRECTORY, 'store.lock')
+
+# the disk budget of the store, in bytes
+MAX_STORE_BYTES = int(float(os.getenv('BACKBONE_UPLOAD_STORE_MAX_MB', '20480')) * 1024 * 1024)
+
+# how many bytes are read (and hashed) at once
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class StoreLock:
+    """
+    Exclusive lock of the store, shared by all the processes of the server
+    """
+
+    def __enter__(self):
+        os.makedirs(OBJECTS_DIRECTORY, exist_ok=True)
+        os.makedirs(FORMS_DIRECTORY, exist_ok=True)
+
+        self.lock_file = open(LOCK_FILE_NAME, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock_file.close()
+
+
+def is_content_hash(content_hash):
+    return isinstance(content_hash, str) and len(content_hash) == 64 and \
+        all(character in '0123456789abcdef' for character in content_hash)
+
+
+def get_object_file_name(content_hash):
+    return os.path.join(OBJECTS_DIRECTORY, content_hash)
+
+
+def get_form_file_name(content_hash, form_key):
+    return os.path.join(FORMS_DIRECTORY, '{}_{}.pickle'.format(
+        content_hash, hashlib.md5(form_key.encode('utf-8')).hexdigest()))
+
+
+def get_file_hash(file_name):
+    """
+    This function returns the SHA-256 hexdigest of the content of the given file
+    """
+    file_hash = hashlib.sha256()
+
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def touch(file_name):
+    """
+    This function marks the given file of the store as used now; it returns False if the file does not exist
+    """
+    try:
+        os.utime(file_name)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def has_file(content_hash):
+    """
+    This function returns True if the store has a file with the given hash
+    """
+    return is_content_hash(content_hash) and os.path.isfile(get_object_file_name(content_hash))
+
+
+def add_file(file_name, content_hash=None):
+    """
+    This function moves the given file into the store and returns its hash. If the store already has a
+    file with the same content, the given file is removed.
+
+    Input: 'file_name' - string object containing the name of the file, which is moved (not copied)
+           'content_hash' - the SHA-256 hexdigest of the file, if it is already known, or None
+    """
+    content_hash = content_hash or get_file_hash(file_name)
+
+    with StoreLock():
+        object_file_name = get_object_file_name(content_hash)
+
+        if os.path.isfile(object_file_name):
+            os.remove(file_name)
+            touch(object_file_name)
+        else:
+            shutil.move(file_name, object_file_name)
+            logging.info('file {} added to the upload store'.format(content_hash))
+
+        remove_least_recently_used_entries(keep_file_names=[object_file_name])
+
+    return content_hash
+
+
+def add_file_from_stream(stream):
+    """
+    This function writes the content of the given stream (e.g. a file sent in a request) into the store,
+    computing its hash while it is written, and returns the hash
+    """
+    os.makedirs(UPLOAD_STORE_DIRECTORY, exist_ok=True)
+
+    file_hash = hashlib.sha256()
+
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_STORE_DIRECTORY, prefix='incoming_', delete=False) as f:
+        for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b''):
+            file_hash.update(block)
+            f.write(block)
+
+    return add_file(f.name, file_hash.hexdigest())
+
+
+def place_file(content_hash, file_name):
+    """
+    This function copies the file with the given hash from the store to the given name (in the working
+    directory), as if it was uploaded with that name, and records the hash of the placed file. It returns
+    False if the store doesn't have the file.
+    """
+    object_file_name = get_object_file_name(content_hash)
+
+    if not is_content_hash(content_hash) or not touch(object_file_name):
+        return False
+
+    # copied to a temporary file first, so a file with the given name is never half written
+    tmp_file_name = file_name + '.placing'
+    try:
+        shutil.copyfile(object_file_name, tmp_file_name)
+    except FileNotFoundError:
+        # the file was removed from the store (by another process) after it was found
+        return False
+    os.replace(tmp_file_name, file_name)
+
+    file_stat = os.stat(file_name)
+
+    with StoreLock():
+        # the files that were removed since they were placed (e.g. the input files of a finished run) are forgotten
+        placed_files = dict((placed_file_name, placed_file) for placed_file_name, placed_file
+                            in read_placed_files().items() if os.path.isfile(placed_file_name))
+        placed_files[file_name] = {'hash': content_hash, 'size': file_stat.st_size,
+                                   'mtime_ns': file_stat.st_mtime_ns}
+        write_placed_files(placed_files)
+
+    return True
+
+
+def read_placed_files():
+    try:
+        with open(PLACED_FILES_FILE_NAME) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_placed_files(placed_files):
+    with open(PLACED_FILES_FILE_NAME + '.tmp', 'w') as f:
+        json.dump(placed_files, f)
+
+    os.replace(PLACED_FILES_FILE_NAME + '.tmp', PLACED_FILES_FILE_NAME)
+
+
+def get_hash_of_placed_file(file_name):
+    """
+    This function returns the hash of the given file, if it was placed by the store and it was not
+    changed since (its size and modification time are the same), or None otherwise
+    """
+    placed_file = read_placed_files().get(file_name)
+
+    if placed_file is None:
+        return None
+
+    try:
+        file_stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+
+    if file_stat.st_size != placed_file['size'] or file_stat.st_mtime_ns != placed_file['mtime_ns']:
+        return None
+
+    return placed_file['hash']
+
+
+def get_preprocessing_version(*functions):
+    """
+    This function returns a version of the given preprocessing functions (the hash of their compiled
+    code), which is part of the key of a derived form, so the forms made by older versions of the
+    functions are not used
+    """
+    return hashlib.md5(b''.join(marshal.dumps(function.__code__) for function in functions)).hexdigest()
+
+
+def read_form(file_name, form_key):
+    """
+    This function returns the derived form, with the given key, of the given file, if the file was placed
+    by the store and the form was written before, or None otherwise
+
+    Input: 'file_name' - string object containing the name of the file, e.g. an input dataset
+           'form_key' - string object describing the form, e.g. the fields read and the preprocessing version
+    """
+    content_hash = get_hash_of_placed_file(file_name)
+    if content_hash is None:
+        return None
+
+    form_file_name = get_form_file_name(content_hash, form_key)
+    if not touch(form_file_name):
+        return None
+
+    try:
+        with open(form_file_name, 'rb') as f:
+            form = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        logging.warning('the cached form of {} could not be read: {}'.format(file_name, e))
+        return None
+
+    logging.info('the cached form of {} was read from the upload store'.format(file_name))
+
+    return form
+
+
+def write_form(file_name, form_key, form):
+    """
+    This function writes the given derived form of the given file into the store, if the file was placed
+    by the store (read more about the parameters in 'read_form')
+    """
+    content_hash = get_hash_of_placed_file(file_name)
+    if content_hash is None:
+        return
+
+    form_file_name = get_form_file_name(content_hash, form_key)
+
+    with StoreLock():
+        with open(form_file_name + '.tmp', 'wb') as f:
+            pickle.dump(form, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(form_file_name + '.tmp', form_file_name)
+
+        remove_least_recently_used_entries(keep_file_names=[form_file_name])
+
+
+def get_entries():
+    """
+    This function returns a list of tuples made of the name, the size and the time of the last use of
+    every file and derived form in the store
+    """
+    entries = []
+
+    for directory in (OBJECTS_DIRECTORY, FORMS_DIRECTORY):
+        if not os.path.isdir(directory):
+            continue
+
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entry_stat = entry.stat()
+                entries.append((entry.path, entry_stat.st_size, entry_stat.st_mtime))
+
+    return entries
+
+
+def remove_least_recently_used_entries(keep_file_names=()):
+    """
+    This function removes the least recently used files and derived forms until the store is within its
+    disk budget. The removed files also lose their derived forms. It must be called holding the store lock.
+
+    :param keep_file_names: the entries that are not removed (e.g. the one that was just added)
+    """
+    entries = get_entries()
+    store_bytes = sum(size for entry_file_name, size, last_use_time in entries)
+
+    removed_hashes = set()
+    for entry_file_name, size, last_use_time in sorted(entries, key=lambda entry: entry[2]):
+        if store_bytes <= MAX_STORE_BYTES:
+            break
+        if entry_file_name in keep_file_names:
+            continue
+
+        os.remove(entry_file_name)
+        store_bytes -= size
+
+        if os.path.dirname(entry_file_name) == OBJECTS_DIRECTORY:
+            removed_hashes.add(os.path.basename(entry_file_name))
+
+    # the derived forms of the removed files can't be used anymore, since the files are not placed again
+    for entry_file_name, size, last_use_time in entries:
+        if os.path.dirname(entry_file_name) == FORMS_DIRECTORY and \
+                os.path.basename(entry_file_name).split('_')[0] in removed_hashes and os.path.isfile(entry_file_name):
+            os.remove(entry_file_name)
+
+    if removed_hashes:
+        logging.info('{} files removed from the upload store'.format(len(removed_hashes)))
+
+
+def get_report():
+    """
+    This function returns the number of files and derived forms in the store, their size and the disk budget
+    """
+    entries = get_entries()
+
+    return OrderedDict([('files', sum(1 for entry in entries if os.path.dirname(entry[0]) == OBJECTS_DIRECTORY)),
+                        ('forms', sum(1 for entry in entries if os.path.dirname(entry[0]) == FORMS_DIRECTORY)),
+                        ('bytes', sum(entry[1] for entry in entries)),
+                        ('max_bytes', MAX_STORE_BYTES)])
@@ -1,9 +1,30 @@
+import re
+import csv
+import time
+import random
+import hashlib
+import itertools
+import collections
 import psycopg2
 import psycopg2.extras
 import pandas as pd
-import numpy as np
 
+from io import StringIO
+from unidecode import unidecode
 
+import metrics
+import sql_tracing
+import schema_inference
+
+# the fields that can be searched with the ranked (full-text and trigram) search;
+# their normalized values are kept in the 'search_index' table
+SEARCHABLE_FIELDS = ('legal_name', 'thoroughfare')
+
+# how many rows are sent to the database with one COPY statement when the search index is built
+SEARCH_INDEX_COPY_CHUNK_SIZE = 50000
+
+
+@metrics.timed_db_call
 def search_field_in_db_by_value(info_db, field, value):
     """
     This function searches in all the tables, that contain datasets from providers,
@@ -62,11 +83,11 @@ def search_field_in_db_by_value(info_db, field, value):
 
         table_names.append(table_name_key)
 
-    fields_to_be_deleted = ['company_id', 'cluster_id', 'link_score']
+    fields_to_be_deleted = ['company_id', 'cluster_id', 'link_score', 'row_hash']
     for table_name_key, extracted_rows_list in tmp_result.items():
         for row in extracted_rows_list:
             for field_to_be_deleted in fields_to_be_deleted:
-                del row[field_to_be_deleted]
+                row.pop(field_to_be_deleted, None)
 
     # close the database connection 
     db_cursor.close()
@@ -75,6 +96,418 @@ def search_field_in_db_by_value(info_db, field, value):
     return result
 
 
+def normalize_value(value):
+    """
+    This function normalizes a value exactly like the 'preProcess' function from the
+    Jupyter notebook does: it transliterates the value to ASCII with Unidecode, replaces
+    new lines with spaces, collapses repeated spaces, strips quotes and makes it lower case.
+    This way "Ørsted AS" and "orsted as" end up having the same normalized value.
+    It returns 'None' if nothing is left after the normalization.
+
+    Input: 'value' - string object that will be normalized
+    """
+    value = unidecode(value)
+    value = re.sub('\n', ' ', value)
+    value = re.sub('  +', ' ', value)
+    value = value.strip().strip('"').strip("'").lower().strip()
+
+    if not value:
+        value = None
+
+    return value
+
+
+def get_prefix_tsquery_from_normalized_value(normalized_value):
+    """
+    This function returns a string that can be given to the 'to_tsquery' postgres function.
+    Every word of the normalized value becomes a prefix term (e.g. 'ors:*') and all the terms
+    must match, so that short search terms also hit the full-text index.
+    It returns 'None' if the value has no word that can be searched.
+
+    Input: 'normalized_value' - string object that was returned by 'normalize_value'
+    """
+    words = [re.sub('[^0-9a-z]', '', word) for word in normalized_value.split()]
+    words = [word for word in words if word]
+
+    if not words:
+        return None
+
+    return ' & '.join(word + ':*' for word in words)
+
+
+def create_search_index_table_if_not_exists(db_cursor):
+    """
+    This function creates the 'search_index' table (and its indexes) if it does not exist and
+    returns True if the table was created. The table keeps, for every company from the provider
+    tables, the normalized values of the searchable fields. Its name doesn't start with 'bi_', so
+    it is never treated as a table that contains a dataset from a provider.
+    The normalized values are indexed both for full-text search (tsvector) and for trigram
+    similarity (pg_trgm).
+
+    Input: 'db_cursor' - cursor of an open database connection that has autocommit set to True
+    """
+    db_cursor.execute("SELECT to_regclass('public.search_index') AS table_name")
+    if db_cursor.fetchone()['table_name']:
+        return False
+
+    db_cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    db_cursor.execute("""CREATE TABLE search_index (
+            table_name VARCHAR(63) NOT NULL,
+            company_id INT NOT NULL,
+            cluster_id INT NOT NULL,
+            field VARCHAR(63) NOT NULL,
+            normalized_value TEXT NOT NULL)""")
+    db_cursor.execute("CREATE INDEX search_index_fts_idx ON search_index "
+                      "USING GIN (to_tsvector('simple', normalized_value))")
+    db_cursor.execute("CREATE INDEX search_index_trgm_idx ON search_index USING GIN (normalized_value gin_trgm_ops)")
+    db_cursor.execute("CREATE INDEX search_index_value_idx ON search_index (field, normalized_value)")
+    db_cursor.execute("CREATE INDEX search_index_table_name_idx ON search_index (table_name)")
+
+    return True
+
+
+def get_column_names_of_table(db_cursor, table_name):
+    """
+    This function returns a list containing the names of the columns of the given table
+
+    Input: 'db_cursor' - cursor of an open database connection
+           'table_name' - string containing the name of the table
+    """
+    db_cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' "
+                      "AND table_name = %s ORDER BY ordinal_position", (table_name,))
+
+    return [row['column_name'] for row in db_cursor.fetchall()]
+
+
+def index_table_for_search(db_cursor, table_name):
+    """
+    This function (re)builds the entries of the 'search_index' table that belong to the given
+    provider table. The values of the searchable fields are normalized in python, with the
+    same rules the matching algorithm uses, and are then copied in chunks into 'search_index'.
+
+    Input: 'db_cursor' - cursor of an open database connection that has autocommit set to True
+           'table_name' - string containing the name of the provider table (it starts with 'bi_')
+    """
+    table_name = table_name.split()[0]
+
+    fields = [f for f in SEARCHABLE_FIELDS if f in get_column_names_of_table(db_cursor, table_name)]
+
+    db_cursor.execute("DELETE FROM search_index WHERE table_name = %s", (table_name,))
+
+    if not fields:
+        return
+
+    db_cursor.execute("SELECT company_id, cluster_id, " + ','.join(fields) + " FROM " + table_name)
+    rows = db_cursor.fetchall()
+
+    copy_stmt = "COPY search_index (table_name, company_id, cluster_id, field, normalized_value) FROM STDIN CSV"
+
+    for chunk_start in range(0, len(rows), SEARCH_INDEX_COPY_CHUNK_SIZE):
+        s_buf = StringIO()
+        writer = csv.writer(s_buf)
+
+        for row in rows[chunk_start:chunk_start + SEARCH_INDEX_COPY_CHUNK_SIZE]:
+            for field in fields:
+                if row[field] is None:
+                    continue
+
+                normalized_value = normalize_value(str(row[field]))
+                if normalized_value:
+                    writer.writerow([table_name, row['company_id'], row['cluster_id'], field, normalized_value])
+
+        s_buf.seek(0)
+        db_cursor.copy_expert(copy_stmt, s_buf)
+
+
+def build_search_index_if_not_exists(info_db, db_cursor):
+    """
+    This function creates the 'search_index' table, if it does not exist, and fills it with
+    the companies from all the provider tables. It returns True if the table was created.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'db_cursor' - cursor of an open database connection that has autocommit set to True
+    """
+    if not create_search_index_table_if_not_exists(db_cursor):
+        return False
+
+    for table_name in get_all_table_names_from_schema(info_db, 'public'):
+        index_table_for_search(db_cursor, table_name)
+
+    return True
+
+
+@metrics.timed_db_call
+def index_provider_table_for_search(info_db, provider_name):
+    """
+    This function updates the 'search_index' table with the companies from the table of the
+    given provider. It has to be called every time a provider table is (re)created, because
+    the 'company_id' values of its rows change.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'provider_name' - string containing the name of the company that
+                             gave us the dataset
+    """
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    # if the table did not exist it was just built for all the provider tables, including this one
+    if not build_search_index_if_not_exists(info_db, db_cursor):
+        index_table_for_search(db_cursor, 'bi_' + provider_name)
+
+    db_cursor.close()
+    db_connection.close()
+
+
+@metrics.timed_db_call
+def search_field_in_db_by_value_ranked(info_db, field, value, limit):
+    """
+    This function searches the companies whose 'field' is similar to the given 'value' and
+    returns at most 'limit' of them, from the best match to the worst one. The value is
+    normalized like the matching algorithm does, and then it is searched in the 'search_index'
+    table with two ranked methods: full-text search (every word of the value is a prefix of a
+    word in the field) and trigram similarity (which also finds misspelled values). Only the
+    best 'limit' rows are fetched from the provider tables.
+    The result is a list of dictionaries with the keys: 'table_name' (the provider table where
+    the company was found), 'score' (the sum between the full-text rank and the similarity) and
+    'row' (the row extracted from that table, without the fields that are used internally).
+    If the 'search_index' table does not exist yet, it is created for all the provider tables.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'field' - string object containing the field name; it has to be one of the
+                     SEARCHABLE_FIELDS
+           'value' - string object that contains the value that we want to find
+                     in that field
+           'limit' - maximum number of companies that are returned
+    """
+    if field not in SEARCHABLE_FIELDS:
+        raise ValueError("Field '" + str(field) + "' can not be searched")
+
+    normalized_value = normalize_value(value)
+    if not normalized_value:
+        return []
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    build_search_index_if_not_exists(info_db, db_cursor)
+
+    tsquery = get_prefix_tsquery_from_normalized_value(normalized_value)
+
+    if tsquery:
+        db_cursor.execute("""
+            SELECT table_name, company_id,
+                   ts_rank(to_tsvector('simple', normalized_value), to_tsquery('simple', %(tsquery)s))
+                   + similarity(normalized_value, %(value)s) AS score
+            FROM search_index
+            WHERE field = %(field)s
+              AND (to_tsvector('simple', normalized_value) @@ to_tsquery('simple', %(tsquery)s)
+                   OR normalized_value %% %(value)s)
+            ORDER BY score DESC
+            LIMIT %(limit)s""", {'tsquery': tsquery, 'value': normalized_value, 'field': field, 'limit': limit})
+    else:
+        db_cursor.execute("""
+            SELECT table_name, company_id, similarity(normalized_value, %(value)s) AS score
+            FROM search_index
+            WHERE field = %(field)s AND normalized_value %% %(value)s
+            ORDER BY score DESC
+            LIMIT %(limit)s""", {'value': normalized_value, 'field': field, 'limit': limit})
+
+    hits = db_cursor.fetchall()
+
+    # fetch the rows of the hits with one query per provider table
+    company_ids_by_table_name = {}
+    for hit in hits:
+        company_ids_by_table_name.setdefault(hit['table_name'], []).append(hit['company_id'])
+
+    rows_by_table_name_and_company_id = {}
+    for table_name, company_ids in company_ids_by_table_name.items():
+        db_cursor.execute("SELECT * FROM " + table_name.split()[0] + " WHERE company_id = ANY(%s)", (company_ids,))
+
+        for row in db_cursor:
+            rows_by_table_name_and_company_id[(table_name, row['company_id'])] = row
+
+    db_cursor.close()
+    db_connection.close()
+
+    fields_to_be_deleted = ['company_id', 'cluster_id', 'link_score', 'row_hash']
+
+    result = []
+    for hit in hits:
+        row = rows_by_table_name_and_company_id.get((hit['table_name'], hit['company_id']))
+
+        # the provider table was recreated after the search index was queried
+        if row is None:
+            continue
+
+        for field_to_be_deleted in fields_to_be_deleted:
+            row.pop(field_to_be_deleted, None)
+
+        result.append({'table_name': hit['table_name'], 'score': float(hit['score']), 'row': row})
+
+    return result
+
+
+def get_rows_of_clusters_from_tables(db_cursor, table_names, cluster_ids):
+    """
+    This function extracts, with one query per table, all the rows that belong to the given
+    clusters and returns them grouped as a dictionary where the keys are the cluster_ids and
+    the values are dictionaries having as keys the table names and as values lists with the
+    rows extracted from that table. The fields that are used internally are deleted from the rows.
+
+    Input: 'db_cursor' - cursor of an open database connection
+           'table_names' - list of string objects containing the names of the provider tables
+           'cluster_ids' - list of int objects containing the cluster_ids that are searched
+    """
+    result = {}
+
+    if not cluster_ids:
+        return result
+
+    fields_to_be_deleted = ['company_id', 'cluster_id', 'link_score', 'row_hash']
+
+    for table_name in table_names:
+        db_cursor.execute("SELECT * FROM " + table_name.split()[0] + " WHERE cluster_id = ANY(%s)", (cluster_ids,))
+
+        for row in db_cursor:
+            cluster_id = row['cluster_id']
+
+            for field_to_be_deleted in fields_to_be_deleted:
+                row.pop(field_to_be_deleted, None)
+
+            result.setdefault(cluster_id, {}).setdefault(table_name, []).append(row)
+
+    return result
+
+
+@metrics.timed_db_call
+def search_clusters_in_db_by_cluster_ids(info_db, cluster_ids):
+    """
+    This function searches in all the tables, that contain datasets from providers, for the
+    companies that belong to the given clusters, using one query per table for all the
+    clusters. It returns a dictionary where the keys are the given cluster_ids and the values
+    are dictionaries having as keys the table names and as values lists with the rows extracted
+    from that table (a cluster that was not found has an empty dictionary).
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'cluster_ids' - list of int objects containing the cluster_ids that are searched
+    """
+    cluster_ids = sorted(set(int(cluster_id) for cluster_id in cluster_ids))
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    rows_by_cluster_id = get_rows_of_clusters_from_tables(
+        db_cursor, get_all_table_names_from_schema(info_db, 'public'), cluster_ids)
+
+    db_cursor.close()
+    db_connection.close()
+
+    return {cluster_id: rows_by_cluster_id.get(cluster_id, {}) for cluster_id in cluster_ids}
+
+
+@metrics.timed_db_call
+def search_field_in_db_by_values(info_db, field, values):
+    """
+    This function resolves many values of a field (e.g. thousands of company names) at once.
+    The values are normalized like the matching algorithm does and they are joined, in a single
+    query, with the normalized values from the 'search_index' table, i.e., a value is found if
+    it is equal to the value of a company, ignoring casing, accents, quotes and extra spaces.
+    Then, all the companies from the clusters of the found companies are extracted with one
+    query per provider table.
+    The result is a dictionary where the keys are the given values and the values are
+    dictionaries having as keys the cluster_ids that were found for that value and as values
+    dictionaries having as keys the table names and as values lists with the rows extracted
+    from that table (a value that was not found has an empty dictionary).
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'field' - string object containing the field name; it has to be one of the
+                     SEARCHABLE_FIELDS
+           'values' - list of string objects that contains the values that we want to find
+                      in that field
+    """
+    if field not in SEARCHABLE_FIELDS:
+        raise ValueError("Field '" + str(field) + "' can not be searched")
+
+    values = list(set(str(value) for value in values))
+    normalized_values = [normalize_value(value) or '' for value in values]
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    build_search_index_if_not_exists(info_db, db_cursor)
+
+    db_cursor.execute("""
+        SELECT DISTINCT requested.value, search_index.cluster_id
+        FROM unnest(%s::text[], %s::text[]) AS requested (value, normalized_value)
+        JOIN search_index ON search_index.field = %s
+                         AND search_index.normalized_value = requested.normalized_value""",
+                      (values, normalized_values, field))
+
+    cluster_ids_by_value = {}
+    for row in db_cursor.fetchall():
+        cluster_ids_by_value.setdefault(row['value'], []).append(row['cluster_id'])
+
+    all_cluster_ids = sorted(set(cluster_id for cluster_ids in cluster_ids_by_value.values()
+                                 for cluster_id in cluster_ids))
+
+    rows_by_cluster_id = get_rows_of_clusters_from_tables(
+        db_cursor, get_all_table_names_from_schema(info_db, 'public'), all_cluster_ids)
+
+    db_cursor.close()
+    db_connection.close()
+
+    result = {}
+    for value in values:
+        result[value] = {cluster_id: rows_by_cluster_id.get(cluster_id, {})
+                         for cluster_id in sorted(cluster_ids_by_value.get(value, []))}
+
+    return result
+
+
+@metrics.timed_db_call
+def get_values_of_field_and_cluster_ids_from_all_tables(info_db, field):
+    """
+    This function returns a list of tuples (value, cluster_id) with all the distinct, not null,
+    values of the given field, from all the tables that contain datasets from providers.
+    Tables that do not have the field are skipped.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'field' - string object containing the field name
+    """
+    field = field.split()[0]
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    result = []
+    for table_name in get_all_table_names_from_schema(info_db, 'public'):
+        if field not in get_column_names_of_table(db_cursor, table_name):
+            continue
+
+        db_cursor.execute("SELECT DISTINCT " + field + ", cluster_id FROM " + table_name +
+                          " WHERE " + field + " IS NOT NULL")
+
+        result.extend((str(row[field]), row['cluster_id']) for row in db_cursor)
+
+    db_cursor.close()
+    db_connection.close()
+
+    return result
+
+
+@metrics.timed_db_call
 def get_maximum_cluster_id_from_backbone_index_table(info_db):
     """
     This function returns the last/maximum known idx (cluster_id) that is in the
@@ -105,36 +538,25 @@ def get_maximum_cluster_id_from_backbone_index_table(info_db):
     return last_cluster_id
 
 
-def extract_rows_by_jurisdiction_from_table_and_return_as_df(info_db, table_name, field_value):
+@metrics.timed_db_call
+def extract_rows_by_jurisdictions_from_table_and_return_as_df(info_db, table_name, jurisdictions):
     """
-    This function extracts all the rows from 'table_name', where the field 'jurisdiction' is equal to
-    the 'field_value' parameter and returns the extracted rows as a pandas dataframe. 
-    Since the 'field_value' parameter in this case is a string, it should be passed to the function
-    as a string representation, i.e., if the field value is "uk" it should be given as "'uk'",
-    because we need the single quotes when creting the SELECT query.
-    One can do that with 'repr' python function
+    This function extracts all the rows from 'table_name', whose field 'jurisdiction' is one of
+    the given jurisdictions, and returns the extracted rows as a pandas dataframe.
 
     Input: 'info_db' - dictionary containing the database parameters needed
                        for creating a connection; the dictionary is the one
                        given in the configuration file
            'table_name' - string object containing the table name from
                                 where the query will extract rows
-           'field_value' - string representation object that specifies on which jurisdiction 
-                            the query is based on. It is used in the WHERE clause and that's why
-                            it needs the string to be enclosed in quotes.
-                            E.g.: SELECT id FROM table_name WHERE jurisdiction = field_value
-                            and field_value = repr("uk")
+           'jurisdictions' - list of string objects containing the jurisdictions of the extracted rows
     """
     # create database connection
     db_connection = create_database_connection(info_db)
     db_cursor = db_connection.cursor()
 
-    select_statement = sql_statement_for_selecting_companies_by_a_given_field(
-        "*",
-        'jurisdiction',
-        field_value,
-        table_name)
-    db_cursor.execute(select_statement)
+    db_cursor.execute("SELECT * FROM " + table_name.split()[0] + " WHERE jurisdiction = ANY(%s)",
+                      (list(jurisdictions),))
 
     resulted_dict = db_cursor.fetchall()
 
@@ -145,6 +567,211 @@ def extract_rows_by_jurisdiction_from_table_and_return_as_df(info_db, table_name
     return pd.DataFrame(resulted_dict, dtype='object')
 
 
+@metrics.timed_db_call
+def extract_one_row_per_cluster_by_jurisdictions_and_return_as_dfs(info_db, jurisdictions):
+    """
+    This function queries, only once, all the tables from the database that store datasets
+    from providers and extracts all the rows that have one of the given jurisdictions.
+    Then, it merges all the extracted rows into a single pandas dataframe, keeping only
+    the fields that are common across the resulted rows, and splits it by jurisdiction.
+    From each jurisdiction, it keeps only one (random) row from each cluster.
+    It returns a dictionary having as keys the given jurisdictions and as values the
+    dataframes with their rows; the dataframes still have the 'cluster_id' column, and
+    a jurisdiction that has no rows in the database has an empty dataframe.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'jurisdictions' - list of string objects containing the jurisdictions of the extracted rows
+    """
+    # get the names of all the tables that contain datasets from different providers   
+    table_names = get_all_table_names_from_schema(info_db, 'public')
+
+    # list of dataframes; each dataframe is composed of all the rows that are extracted 
+    # from a table with the SELECT query (they are extracted based on their jurisdiction)
+    list_of_dataframes_resulted_from_select_query = []
+    for table_name in table_names:
+        df = extract_rows_by_jurisdictions_from_table_and_return_as_df(info_db, table_name, jurisdictions)
+
+        # a table without rows from these jurisdictions has no columns either
+        if len(df.index):
+            list_of_dataframes_resulted_from_select_query.append(df)
+
+    if not list_of_dataframes_resulted_from_select_query:
+        return dict((jurisdiction, pd.DataFrame(dtype='object')) for jurisdiction in jurisdictions)
+
+    column_names_of_each_dataframe = []
+    for df in list_of_dataframes_resulted_from_select_query:
+        column_names_of_each_dataframe.append(set(df.columns.values))
+
+    # we'll keep only the common columns of the rows previously extracted from the tables
+    common_columns_across_dataframes = set.intersection(*column_names_of_each_dataframe)
+
+    # the hashes of the rows are only needed for finding the rows that changed
+    common_columns_across_dataframes.discard('row_hash')
+
+    # new list of dataframes, where each dataframe was reduced to only having the common columns
+    list_of_dataframes_resulted_from_select_query_with_common_fields = []
+    for df in list_of_dataframes_resulted_from_select_query:
+        df = df[list(common_columns_across_dataframes)]
+        list_of_dataframes_resulted_from_select_query_with_common_fields.append(df)
+
+    # merge/concatenate all dataframes that we have so far into a big one 
+    big_df = pd.concat(list_of_dataframes_resulted_from_select_query_with_common_fields, axis=0).reset_index(
+        drop=True)
+
+    # shuffle (rearrange in random order) the examples from the dataframe
+    big_df = big_df.sample(frac=1).reset_index(drop=True)
+
+    # Keep only one example from a cluster. This is neccessary because our Dedupe
+    # algorithm makes one-to-one matches between the two input files, i.e., the clusters
+    # that Dedupe creates contain maximum 2 elements, where one element is from input file 1
+    # and the other is from input file 2. If we would have two or more examples from the same
+    # cluster in this file, at most one would get matched and the remaining ones will be put
+    # in their own clusters and later on inserted into the database AGAIN.
+    big_df.drop_duplicates(subset=['jurisdiction', 'cluster_id'], inplace=True)
+
+    dfs = {}
+    for jurisdiction in jurisdictions:
+        dfs[jurisdiction] = big_df[big_df['jurisdiction'] == jurisdiction].reset_index(drop=True)
+
+    return dfs
+
+
+def extract_one_row_per_cluster_by_jurisdiction_and_return_as_df(info_db, jurisdiction):
+    """
+    This function queries all the tables from the database that store datasets
+    from providers and extracts all the rows that have the given 'jurisdiction'.
+    Then, it merges all the extracted rows into a single pandas dataframe, keeping only
+    the fields that are common across the resulted rows, and keeps only one (random)
+    row from each cluster. The dataframe still has the 'cluster_id' column.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'jurisdiction' - string object containing the jurisdiction of the extracted rows
+    """
+    return extract_one_row_per_cluster_by_jurisdictions_and_return_as_dfs(info_db, [jurisdiction])[jurisdiction]
+
+
+@metrics.timed_db_call
+def extract_one_row_per_cluster_by_jurisdictions_and_write_to_csv_files(info_db, file_names_by_jurisdiction,
+                                                                        chunk_size):
+    """
+    This function extracts the same rows as 'extract_one_row_per_cluster_by_jurisdictions_and_return_as_dfs',
+    but without keeping them in memory: the rows are fetched from the database in chunks, with a server-side
+    cursor, and written directly into one csv file per jurisdiction. The tables are read in a random order
+    and the first row read from a cluster is the one that is kept. The 'cluster_id' and 'link_score' columns
+    are written as 'cluster_id_from_db' and 'link_score_from_db', like the 2nd input dataset needs them.
+    It returns a dictionary having as keys the jurisdictions and as values the number of rows written.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'file_names_by_jurisdiction' - dictionary having as keys the jurisdictions of the extracted rows
+                                          and as values the names of the csv files they are written into
+           'chunk_size' - the number of rows fetched from the database at once
+    """
+    jurisdictions = list(file_names_by_jurisdiction)
+    nr_of_rows_by_jurisdiction = dict((jurisdiction, 0) for jurisdiction in jurisdictions)
+
+    table_names = get_all_table_names_from_schema(info_db, 'public')
+    random.shuffle(table_names)
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    # like in the dataframes, only the columns of the tables that have rows from these jurisdictions count
+    column_names_of_tables = []
+    for table_name in table_names:
+        db_cursor.execute("SELECT EXISTS (SELECT 1 FROM " + table_name.split()[0] +
+                          " WHERE jurisdiction = ANY(%s)) AS has_rows", (jurisdictions,))
+        if db_cursor.fetchone()['has_rows']:
+            column_names_of_tables.append((table_name, get_column_names_of_table(db_cursor, table_name)))
+
+    db_cursor.close()
+
+    if not column_names_of_tables:
+        db_connection.close()
+        return nr_of_rows_by_jurisdiction
+
+    common_columns = set.intersection(*[set(column_names) for table_name, column_names in column_names_of_tables])
+    common_columns.discard('row_hash')
+    column_names = [column_name for column_name in column_names_of_tables[0][1] if column_name in common_columns]
+
+    renamed_columns = {'cluster_id': 'cluster_id_from_db', 'link_score': 'link_score_from_db'}
+    heading_row = [renamed_columns.get(column_name, column_name) for column_name in column_names]
+
+    output_files = dict((jurisdiction, open(file_name, 'w')) for jurisdiction, file_name
+                        in file_names_by_jurisdiction.items())
+    try:
+        writers = dict((jurisdiction, csv.writer(output_file)) for jurisdiction, output_file in output_files.items())
+        for writer in writers.values():
+            writer.writerow(heading_row)
+
+        # read more about keeping only one row from each cluster in
+        # 'extract_one_row_per_cluster_by_jurisdictions_and_return_as_dfs'
+        seen_cluster_ids_by_jurisdiction = dict((jurisdiction, set()) for jurisdiction in jurisdictions)
+
+        # a server-side cursor can only be used inside a transaction
+        db_connection.autocommit = False
+
+        for table_name, table_column_names in column_names_of_tables:
+            db_cursor = db_connection.cursor(name='extraction_cursor')
+            db_cursor.itersize = chunk_size
+            db_cursor.execute("SELECT " + ','.join(column_names) + " FROM " + table_name.split()[0] +
+                              " WHERE jurisdiction = ANY(%s)", (jurisdictions,))
+
+            nr_of_rows_read = 0
+            for row in db_cursor:
+                nr_of_rows_read += 1
+
+                jurisdiction = row['jurisdiction']
+                seen_cluster_ids = seen_cluster_ids_by_jurisdiction[jurisdiction]
+                if row['cluster_id'] in seen_cluster_ids:
+                    continue
+
+                seen_cluster_ids.add(row['cluster_id'])
+                writers[jurisdiction].writerow([row[column_name] for column_name in column_names])
+                nr_of_rows_by_jurisdiction[jurisdiction] += 1
+
+            db_cursor.close()
+            metrics.count_db_rows(nr_of_rows_read)
+
+        db_connection.rollback()
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
+
+        db_connection.close()
+
+    return nr_of_rows_by_jurisdiction
+
+
+@metrics.timed_db_call
+def get_size_of_provider_tables(info_db):
+    """
+    This function returns the size, in bytes, of all the tables that store datasets from providers
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+    """
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    db_cursor.execute("SELECT COALESCE(SUM(pg_relation_size(c.oid)), 0) AS size FROM pg_class c "
+                      "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                      "WHERE n.nspname = 'public' AND c.relkind = 'r' AND c.relname LIKE 'bi\\_%'")
+    size = int(db_cursor.fetchone()['size'])
+
+    db_cursor.close()
+    db_connection.close()
+
+    return size
+
+
+@metrics.timed_db_call
 def get_all_table_names_from_schema(info_db, table_schema_name):
     """
     This function returns all the names of tables from a given schema name
@@ -224,92 +851,77 @@ def sql_statement_for_copying_values_from_file(columns, table_name):
     return sql_copy_statement + ") FROM STDIN CSV HEADER"
 
 
-def get_names_of_columns_that_are_numeric_but_start_with_0(csv_file_name):
-    """
-    This function returns a list containing all the column names in the csv file,
-    whose values are numeric (only digits), but have some values that start with 0 (zero).
-    
-    E.g.: postCode column has postcodes that start with zero (0273), but pandas will read
-    this column as a float and eliminate the starting 0s. We don't want this behaviour, so
-    we will force pandas to read the column as 'object' (string), but first we need to
-    find that postCode column has these types of values, that start with 0s
-
-    Input: 'csv_file_name' - the name of the csv file in which we search for
-                            columns that are numeric, but have values that start with 0
-
-    """
-    # read all the columns of the csv file as being string (object)
-    df = pd.read_csv(csv_file_name, dtype=object)
-
-    # get the names of the columns
-    column_names = df.columns.values
-
-    columns_starting_with_0_and_are_numeric = []
-    for column_name in column_names:
-        # we use a RegEx which states that the string should start with 0 should have one or more extra digits 
-        if (df[column_name].str.contains('^0[0-9]+$', regex=True)).sum() != 0:
-            columns_starting_with_0_and_are_numeric.append(column_name)
-
-    return columns_starting_with_0_and_are_numeric
-
-
-def get_columns_and_their_datatypes(df):
+def get_statements_for_creating_table_with_fk_and_for_copying_data_into_table(input_file_name, provider_name,
+                                                                                heading_row, table_name):
     """
-    This function receives as input a pandas dataframe and will return
-    a dictionary having as keys the names of columns in the dataframe
-    and the values will be the corresponding datatypes that work
-    for SQL
-
-    Input: 'df' - pandas dataframe 
-    """
-    column_datatypes = {}
-
-    for k, v in dict(df.dtypes).items():
-        if v == 'int64':
-            column_datatypes[k] = 'INT'
-        elif v == 'float64':
-            column_datatypes[k] = 'FLOAT'
-        else:
-            column_datatypes[k] = 'VARCHAR(500)'
-
-    return column_datatypes
-
-
-def get_statements_for_creating_table_with_fk_and_for_copying_data_into_table_from_csv(dataset_file_name, table_name):
-    """
-    This function uses returns a tuple made of 2 SQL statements: one is for creating a new table (which will have a 
+    This function returns a tuple made of 2 SQL statements: one is for creating a new table (which will have a
     FK constraint on the 'cluster_id' column and references the 'idx' column from backbone_index table) and the other
-    SQL statement is for copying values from a csv file into a table
-
-    Input: 'dataset_file_name' - name of the csv file which contains the dataset and also has the 'cluster_id' column
+    SQL statement is for copying rows, that have the columns from the given heading row, into a table.
+    The datatypes of the columns are inferred from the input dataset that was given to Dedupe (read more
+    about this in the 'schema_inference' module), while the 'cluster_id' and 'link_score' columns, which
+    Dedupe added, are always an INTEGER and a DOUBLE PRECISION column, and the 'row_hash' column
+    (read more about it in the 'get_row_hash' function) is a CHAR(32) column.
+
+    Input: 'input_file_name' - name of the csv file which contains the input dataset given to Dedupe
+           'provider_name' - string containing the name of the company that gave us the dataset
+           'heading_row' - list of string objects containing the names of the columns of the rows that
+                           will be copied into the table (the columns of the input dataset, together with
+                           'cluster_id', 'link_score' and 'row_hash')
            'table_name' - name of the table where the dataset will be inserted
     """
-    # get the column names of numeric columns that have values starting with digit 0
-    numeric_col_names_that_start_with_0 = get_names_of_columns_that_are_numeric_but_start_with_0(dataset_file_name)
+    # get a dictionary where the keys are column names and their values are the SQL datatypes
+    input_column_names_and_datatypes = schema_inference.infer_datatypes_of_csv_file(input_file_name, provider_name)
+    input_column_names_and_datatypes['cluster_id'] = 'INTEGER'
+    input_column_names_and_datatypes['link_score'] = 'DOUBLE PRECISION'
+    input_column_names_and_datatypes['row_hash'] = 'CHAR(32)'
 
-    # put all these column names in a dictionary, where the keys are the column names and
-    # their values will be 'object'
-    data_types = {}
-    for column in numeric_col_names_that_start_with_0:
-        data_types[column] = object
-
-    # read the csv and force the numeric columns that have values starting with 0 to be read as object (string)
-    result_df = pd.read_csv(dataset_file_name, dtype=data_types)
-
-    # get a dictionary where the keys are column names and their values are the SQL corresponding datatypes
-    column_names_and_datatypes = get_columns_and_their_datatypes(result_df)
+    # keep the columns in the same order as they are in the rows
+    column_names_and_datatypes = collections.OrderedDict(
+        (column, input_column_names_and_datatypes[column]) for column in heading_row)
 
     # get the SQL statement for creating a new table with the given fields and which has a foreign key on
     # 'cluster_id' column
     create_table_stmt = sql_statement_for_creating_new_table_with_fk_on_cluster_id(column_names_and_datatypes,
                                                                                    table_name)
 
-    # get the SQL statement for copying values from a csv file into a table
-    copy_into_table_stmt = sql_statement_for_copying_values_from_file(result_df.columns, table_name)
+    # get the SQL statement for copying the rows into a table
+    copy_into_table_stmt = sql_statement_for_copying_values_from_file(heading_row, table_name)
 
     return create_table_stmt, copy_into_table_stmt
 
 
+class InstrumentedCursor(psycopg2.extras.RealDictCursor):
+    """
+    Cursor that returns the rows as dictionaries (like RealDictCursor) and counts the statements and
+    the rows returned or changed by every statement, for the metrics of the database call that runs the
+    statement. Every statement is also traced (read more about this in the 'sql_tracing' module).
+    """
+
+    def execute(self, query, vars=None):
+        metrics.count_db_statement()
+        start_time = time.perf_counter()
+        is_failed = True
+        try:
+            result = super().execute(query, vars)
+            is_failed = False
+            return result
+        finally:
+            metrics.count_db_rows(self.rowcount)
+            sql_tracing.trace_statement(self, query, vars, time.perf_counter() - start_time, self.rowcount, is_failed)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.count_db_statement()
+        start_time = time.perf_counter()
+        is_failed = True
+        try:
+            result = super().copy_expert(sql, file, size)
+            is_failed = False
+            return result
+        finally:
+            metrics.count_db_rows(self.rowcount)
+            sql_tracing.trace_statement(self, sql, None, time.perf_counter() - start_time, self.rowcount, is_failed)
+
+
 def create_database_connection(info_db):
     """
     This function creates a database connection, sets the autocommit to 'True' and returns the created connection
@@ -325,11 +937,13 @@ def create_database_connection(info_db):
         password=info_db['password'],
         host=info_db['host'],
         port=info_db['port'],
-        cursor_factory=psycopg2.extras.RealDictCursor
+        cursor_factory=InstrumentedCursor
     )
 
     connection.autocommit = True
 
+    metrics.count_db_connection()
+
     return connection
 
 
@@ -357,153 +971,348 @@ def sql_statement_for_selecting_companies_by_a_given_field(columns, field, value
     return select_sql_statement
 
 
-def insert_new_cluster_ids_into_backbone_index_table(info_db, output_file_1, output_file_2, last_cluster_id):
+@metrics.timed_db_call
+def insert_cluster_id_range_into_backbone_index_table(info_db, first_cluster_id, last_cluster_id):
     """
-    This function will insert the new cluster_ids that were created by Dedupe into the backbone_index table
+    This function will insert the new cluster_ids that were created by Dedupe into the backbone_index table.
+    The new cluster_ids are consecutive, so they are all inserted with one statement.
 
     Input: 'info_db' - dictionary containing the database parameters needed
                        for creating a connection; the dictionary is the one
                        given in the configuration file
-            'output_file_1' - name of the 1st csv output file that resulted from dedupe
-            'output_file_2' - name of the 2nd csv output file that resulted from dedupe;
-                            if this csv file contains examples that were previously extracted
-                            from the database, this parameter will be 'None'
-            'last_cluster_id' - the last known cluster_id (the maximum one that currently exists
-                                in the backbone_index table)
-            
+            'first_cluster_id' - the first new cluster_id
+            'last_cluster_id' - the last new cluster_id (if it is smaller than the first one,
+                                there are no new cluster_ids)
     """
-    df_output_1 = pd.read_csv(output_file_1)
+    if last_cluster_id < first_cluster_id:
+        return
 
-    # creating an empty set
-    cluster_ids = set()
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
 
-    if output_file_2:
-        df_output_2 = pd.read_csv(output_file_2)
+    db_cursor.execute("INSERT INTO backbone_index SELECT generate_series(%s, %s)",
+                      (int(first_cluster_id), int(last_cluster_id)))
 
-        # get all the cluster_ids and keep only 1 value of each one
-        cluster_ids = set(pd.concat([df_output_1["cluster_id"], df_output_2["cluster_id"]], axis=0))
+    db_cursor.close()
+    db_connection.close()
 
-        # keep only the new cluster_ids, i.e., the ones that are greater than the last known cluster_id
-        cluster_ids = [c_id for c_id in cluster_ids if c_id > last_cluster_id]
-    else:
-        cluster_ids = list(df_output_1[df_output_1['cluster_id'] > last_cluster_id].cluster_id)
+
+class RowsAsCsvFile:
+    """
+    File-like object that turns rows (lists of values) into csv text, a few rows at a time,
+    when it is read. It is given to 'copy_expert', so that the rows resulted from Dedupe are
+    streamed directly into the database, without writing them into a file first.
+    None values are written as empty (unquoted) values, which COPY reads as NULL.
+    """
+
+    def __init__(self, rows):
+        """
+        Constructor
+
+        :param rows: iterable of lists, where each list is a row
+        """
+        self.__rows = iter(rows)
+        self.__buffer = StringIO()
+        self.__writer = csv.writer(self.__buffer)
+
+    def read(self, size=8192):
+        """
+        Returns the csv text of the next rows; its length is at least 'size' characters,
+        unless there are no more rows. An empty string means that all the rows were read.
+        """
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+
+        for row in self.__rows:
+            self.__writer.writerow(row)
+
+            if self.__buffer.tell() >= size:
+                break
+
+        return self.__buffer.getvalue()
+
+
+def generate_rows_and_write_them_to_csv_file(rows, file_name):
+    """
+    This function is a generator that gives the same rows it receives and, at the same time,
+    writes them into a csv file. It is used for exporting the rows resulted from Dedupe while
+    they are streamed into the database.
+
+    Input: 'rows' - iterable of lists, where each list is a row
+           'file_name' - name of the csv file
+    """
+    with open(file_name, 'w') as f:
+        writer = csv.writer(f)
+
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+@metrics.timed_db_call
+def create_table_and_insert_rows_resulted_from_dedupe(info_db, provider_name, input_file_name, rows):
+    """
+    This function creates a new table (which will have a FK constraint on the 'cluster_id' column
+    and references the 'idx' column from backbone_index table) and streams the given rows into
+    the created table with the COPY protocol. The table's name will be composed of
+    the prefix 'bi_' (which stands for (b)ackbone (i)ndex) and the name of the provider (the name
+    of the company that gave us the dataset)
+    The dataset will be made of the dataset given by the provider + 3 extra columns: cluster_id,
+    link_score and row_hash
+
+    Input:  'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+            'provider_name' - string containing the name of the company that
+                            gave us the dataset
+            'input_file_name' - the name of the csv file with the dataset given by the provider;
+                                it is used for finding the datatypes of the columns
+            'rows' - iterable of lists, where the first list is the heading row and the
+                     next ones are the rows resulted from Dedupe
+    """
+    rows = generate_rows_with_row_hash(rows)
+    heading_row = next(rows)
+
+    provider_table_name = 'bi_' + provider_name
+
+    create_stmt, copy_stmt = get_statements_for_creating_table_with_fk_and_for_copying_data_into_table(
+        input_file_name, provider_name, heading_row, provider_table_name)
 
     db_connection = create_database_connection(info_db)
     db_cursor = db_connection.cursor()
 
-    cluster_ids_as_list_of_tuples = [tuple([x]) for x in cluster_ids]
-    db_cursor.executemany("INSERT INTO backbone_index VALUES (%s)", cluster_ids_as_list_of_tuples)
+    db_cursor.execute("DROP TABLE IF EXISTS " + provider_table_name)
+    db_cursor.execute(create_stmt)
+
+    # stream the rows into the table in the database; the COPY statement expects a heading row
+    db_cursor.copy_expert(copy_stmt, RowsAsCsvFile(itertools.chain([heading_row], rows)))
 
     db_cursor.close()
     db_connection.close()
 
 
-def create_table_and_insert_dataset_resulted_from_dedupe(info_db, provider_name, file_name):
+def get_row_hash(values):
     """
-    This function creates a new table (which will have a FK constraint on the 'cluster_id' column 
-    and references the 'idx' column from backbone_index table) and inserts the values from
-    the given csv file into the created table. The table's name will be composed of
-    the prefix 'bi_' (which stands for (b)ackbone (i)ndex) and the name of the provider (the name
-    of the company that gave us the dataset)
-    The dataset will be made of the dataset given by the provider + 2 extra columns: cluster_id and
-    link_score
+    This function returns the hash (the md5 hexdigest) of a row of a dataset given by a provider.
+    The rows of the provider tables keep the hash of the row they were created from, so that,
+    when the provider sends its dataset again, the rows that did not change can be found
+    without comparing them column by column.
+
+    Input: 'values' - list of string objects, the values of the row as they are in the csv file
+    """
+    return hashlib.md5('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+def generate_rows_with_row_hash(rows):
+    """
+    This function is a generator that adds the 'row_hash' column to the rows resulted from Dedupe.
+    The hash is computed from the values that were in the input dataset, i.e., without the first
+    two columns ('cluster_id' and 'link_score'), which Dedupe added.
+
+    Input: 'rows' - iterable of lists, where the first list is the heading row and the
+                    next ones are the rows resulted from Dedupe
+    """
+    rows = iter(rows)
+    yield next(rows) + ['row_hash']
+
+    for row in rows:
+        yield row + [get_row_hash(row[2:])]
+
+
+@metrics.timed_db_call
+def get_row_hashes_of_provider_table(info_db, provider_name, column_names):
+    """
+    This function returns a Counter having as keys the hashes of the rows from the table of the
+    given provider and as values how many rows have that hash. It returns None if the table doesn't
+    exist, if it was created before the rows had hashes, or if the dataset has other columns than
+    the ones of the table; in these cases the whole dataset has to be matched again.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'provider_name' - string containing the name of the company that
+                             gave us the dataset
+           'column_names' - list of string objects, the names of the columns of the dataset
+    """
+    provider_table_name = ('bi_' + provider_name).split()[0]
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    table_column_names = get_column_names_of_table(db_cursor, provider_table_name)
+
+    row_hashes = None
+    if set(table_column_names) == set(column_names).union(['company_id', 'cluster_id', 'link_score', 'row_hash']):
+        db_cursor.execute("SELECT row_hash, count(*) AS nr_of_rows FROM " + provider_table_name +
+                          " GROUP BY row_hash")
+
+        row_hashes = collections.Counter()
+        for row in db_cursor:
+            row_hashes[row['row_hash']] = row['nr_of_rows']
+
+    db_cursor.close()
+    db_connection.close()
+
+    return row_hashes
+
+
+@metrics.timed_db_call
+def delete_rows_with_row_hashes(info_db, provider_name, row_hashes):
+    """
+    This function deletes, from the table of the given provider, the rows that are no longer in
+    the dataset given by the provider, i.e., the rows that were removed or changed.
+
+    Input: 'info_db' - dictionary containing the database parameters needed
+                       for creating a connection; the dictionary is the one
+                       given in the configuration file
+           'provider_name' - string containing the name of the company that
+                             gave us the dataset
+           'row_hashes' - Counter having as keys the hashes of the rows that have to be
+                          deleted and as values how many rows with that hash have to be deleted
+    """
+    if not row_hashes:
+        return
+
+    provider_table_name = ('bi_' + provider_name).split()[0]
+
+    db_connection = create_database_connection(info_db)
+    db_cursor = db_connection.cursor()
+
+    db_cursor.execute("SELECT company_id, row_hash FROM " + provider_table_name + " WHERE row_hash = ANY(%s)",
+                      (list(row_hashes),))
+
+    # the dataset can have identical rows, so only as many rows as the Counter says are deleted
+    nr_of_rows_to_delete = row_hashes.copy()
+    company_ids = []
+    for row in db_cursor.fetchall():
+        if nr_of_rows_to_delete[row['row_hash']] > 0:
+            nr_of_rows_to_delete[row['row_hash']] -= 1
+            company_ids.append(row['company_id'])
+
+    db_cursor.execute("DELETE FROM " + provider_table_name + " WHERE company_id = ANY(%s)", (company_ids,))
+
+    db_cursor.close()
+    db_connection.close()
+
+
+@metrics.timed_db_call
+def insert_rows_resulted_from_dedupe_into_existing_table(info_db, provider_name, input_file_name, rows):
+    """
+    This function streams the given rows into the (already existing) table of the given provider,
+    with the COPY protocol. It is used when only the new and the changed rows of a dataset were
+    matched by Dedupe. If some of the new values don't fit the datatypes of the columns of the table,
+    those columns are changed to wider datatypes first (e.g. from INTEGER to BIGINT).
 
     Input:  'info_db' - dictionary containing the database parameters needed
                        for creating a connection; the dictionary is the one
                        given in the configuration file
             'provider_name' - string containing the name of the company that
                             gave us the dataset
-            'file_name' - the name of the csv file where the dataset is stored
+            'input_file_name' - the name of the csv file with the rows given to Dedupe;
+                                it is used for finding the datatypes of the columns
+            'rows' - iterable of lists, where the first list is the heading row and the
+                     next ones are the rows resulted from Dedupe
     """
+    rows = generate_rows_with_row_hash(rows)
+    heading_row = next(rows)
+
+    provider_table_name = ('bi_' + provider_name).split()[0]
+
+    column_names_and_datatypes = schema_inference.infer_datatypes_of_csv_file(input_file_name, provider_name)
+
     db_connection = create_database_connection(info_db)
     db_cursor = db_connection.cursor()
 
-    provider_table_name = 'bi_' + provider_name
+    db_cursor.execute("SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = 'public' "
+                      "AND table_name = %s", (provider_table_name,))
 
-    create_stmt, copy_stmt = get_statements_for_creating_table_with_fk_and_for_copying_data_into_table_from_csv(
-        file_name, provider_table_name)
+    for row in db_cursor.fetchall():
+        datatype = column_names_and_datatypes.get(row['column_name'])
 
-    db_cursor.execute("DROP TABLE IF EXISTS " + provider_table_name)
-    db_cursor.execute(create_stmt)
+        if datatype and schema_inference.is_wider_datatype(datatype, row['data_type'].upper()):
+            db_cursor.execute("ALTER TABLE " + provider_table_name + " ALTER COLUMN " + row['column_name'] +
+                              " TYPE " + datatype + " USING " + row['column_name'] + "::" + datatype)
 
-    # copy the rows from the csv file into the table in the database
-    with open(file_name, 'r') as f:
-        db_cursor.copy_expert(copy_stmt, f)
+    # stream the rows into the table in the database; the COPY statement expects a heading row
+    copy_stmt = sql_statement_for_copying_values_from_file(heading_row, provider_table_name)
+    db_cursor.copy_expert(copy_stmt, RowsAsCsvFile(itertools.chain([heading_row], rows)))
 
     db_cursor.close()
     db_connection.close()
 
 
-def update_cluster_ids_of_output_file_1(output_file_1, output_file_2, input_file_2):
-    """
-    This function updates the cluster_ids given by Dedupe to the first input dataset,
-    in the case when the user only gave 1 new dataset as input and the other dataset
-    was extracted from thew database. In this case, the examples extracted from the
-    database already have a cluster_id (backbone_index). After Dedupe is run, it
-    creates 2 output files which are exactly like the input ones, just that
-    they have 2 additional fields: cluster_id and link_score, and these cluster_ids
-    are unique compared to the ones that already exist in the database. So, to the
-    clusters that contain examples from the second dataset (the one that was extracted
-    from the DB), since they already had cluster_ids assigned to them, we want to
-    reassign those old cluster_ids. And then, for the examples that are in their
-    own cluster, we want to update their cluster_ids, so that when we put then
-    new cluster_ids in the backbone_index table, they will be consecutive,
+def get_cluster_ids_from_database_of_matched_rows(rows, cluster_ids_from_database=None):
+    """
+    This function is used when the 2nd dataset given to Dedupe contained rows extracted from the
+    database. Those rows already had a cluster_id (the 'cluster_id_from_db' column), but Dedupe gave
+    new cluster_ids to all the clusters it created. This function returns a dictionary where the keys
+    are the cluster_ids given by Dedupe to the clusters that contain a row from the database (i.e.,
+    the rows that have a link score) and the values are the cluster_ids these rows have in the database.
+
+    Input: 'rows' - iterable of lists, where the first list is the heading row and the
+                    next ones are the rows resulted from Dedupe for the 2nd dataset
+           'cluster_ids_from_database' - the (dictionary like) object the cluster_ids are added to, e.g.,
+                                         a map kept on disk, or None for a new dictionary
+    """
+    rows = iter(rows)
+    heading_row = next(rows)
+
+    idx_cluster_id = heading_row.index('cluster_id')
+    idx_link_score = heading_row.index('link_score')
+    idx_cluster_id_from_db = heading_row.index('cluster_id_from_db')
+
+    if cluster_ids_from_database is None:
+        cluster_ids_from_database = {}
+
+    for row in rows:
+        if row[idx_link_score] is not None:
+            cluster_ids_from_database[int(row[idx_cluster_id])] = int(float(row[idx_cluster_id_from_db]))
+
+    return cluster_ids_from_database
+
+
+def generate_rows_with_cluster_ids_from_database(rows, cluster_ids_from_database, last_cluster_id):
+    """
+    This function is a generator that updates the cluster_ids given by Dedupe to the rows of the
+    first input dataset, in the case when the user only gave 1 new dataset as input and the other
+    dataset was extracted from the database. In this case, the examples extracted from the
+    database already have a cluster_id (backbone_index), but the cluster_ids given by Dedupe
+    are unique compared to the ones that already exist in the database. So, to the clusters
+    that contain examples from the second dataset (the one that was extracted from the DB),
+    since they already had cluster_ids assigned to them, we want to reassign those old cluster_ids.
+    And then, for the examples that are in their own cluster, we want to update their cluster_ids,
+    so that when we put the new cluster_ids in the backbone_index table, they will be consecutive,
     and no value is skipped.
 
-    E.g.: if the first four examples from output file 1 have the cluster_ids
+    E.g.: if the first four examples from the first dataset have the cluster_ids
     100,101,102,103 and the first two examples are clusters that also have an
     example from the database with cluster_ids 14 and 55, and the last two
     examples are individual clusters the output will be: the first two
     examples will have cluster_ids 14 and 55 and the last two examples
-    will have cluster_ids 100 and 101
-
-    The function iterates over the rows of the 1st output file (after they
-    were sorted by cluster_id - this way the first 'n' cluster_ids belong
-    to clusters that also have an example from the database and the next
-    clusters are individual clusters) --> We change the cluster_ids of
-    the first 'n' clusters and then we update the cluster_ids of the
-    remaining individual clusters
-
-    Input - output_file_1 - string containing the name of the output file
-                            belonging to the first input dataset
-            output_file_2 - string containing the name of the output file
-                            belonging to the second input dataset
-            input_file_1 - string containing the name of the input file,
-                            whose examples were extracted from the database
-    """
-    # read the csv files into pandas dataframes, where all cells are treated as
-    # objects (strings)
-    df_output_1 = pd.read_csv(output_file_1, dtype=object)
-    df_output_2 = pd.read_csv(output_file_2, dtype=object)
-    df_input_2 = pd.read_csv(input_file_2, dtype=object)
-
-    # convert the 'cluster_id' column datatype to 'int64' to all dataframes
-    df_output_1['cluster_id'] = df_output_1.cluster_id.astype('int64')
-    df_output_2['cluster_id'] = df_output_2.cluster_id.astype('int64')
-    df_input_2['cluster_id_from_db'] = df_input_2.cluster_id_from_db.astype('int64')
-
-    # sort by 'cluster_id' the 1st dataframe's rows
-    df_output_1 = df_output_1.sort_values(by=['cluster_id']).reset_index(drop=True)
-
-    # number of clusters found by Dedupe (clusters that contain 2 examples - 1 from the 1st dataset
-    # and 1 from the 2nd input dataset)
-    nr_of_clusters_found = len(set(df_output_1['cluster_id']).intersection(set(df_output_2['cluster_id'])))
-    nr_of_changed_cluster_ids = 0
-
-    # give to all the existing clusters (of 2 elements) the cluster_id belonging to the example 
-    # that was extracted already from the database
-    for i in range(0, nr_of_clusters_found):
-        cluster_id_in_output_1 = df_output_1.iloc[i]['cluster_id']
-
-        row_index_of_cluster_in_output_2 = np.where(df_output_2['cluster_id'] == cluster_id_in_output_1)[0][0]
-
-        cluster_id_in_input_2 = df_input_2.iloc[row_index_of_cluster_in_output_2]['cluster_id_from_db']
-
-        df_output_1.at[i, 'cluster_id'] = cluster_id_in_input_2
-        nr_of_changed_cluster_ids += 1
-
-    # update the cluster_id of all individual clusters
-    for i in range(nr_of_clusters_found, len(df_output_1)):
-        df_output_1.at[i, 'cluster_id'] = df_output_1.iloc[i]['cluster_id'] - nr_of_changed_cluster_ids
-
-    df_output_1.to_csv(output_file_1, index=False)
+    will have cluster_ids 100 and 101 (if 99 is the last cluster_id in the database)
+
+    Input - 'rows' - iterable of lists, where the first list is the heading row and the
+                     next ones are the rows resulted from Dedupe for the 1st dataset
+            'cluster_ids_from_database' - dictionary returned by the
+                                          'get_cluster_ids_from_database_of_matched_rows' function
+            'last_cluster_id' - the last known cluster_id (the maximum one that currently exists
+                                in the backbone_index table)
+    """
+    rows = iter(rows)
+    heading_row = next(rows)
+    yield heading_row
+
+    idx_cluster_id = heading_row.index('cluster_id')
+
+    next_cluster_id = last_cluster_id + 1
+
+    for row in rows:
+        cluster_id_from_database = cluster_ids_from_database.get(int(row[idx_cluster_id]))
+
+        if cluster_id_from_database is None:
+            row[idx_cluster_id] = next_cluster_id
+            next_cluster_id += 1
+        else:
+            row[idx_cluster_id] = cluster_id_from_database
+
+        yield row